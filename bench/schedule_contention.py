@@ -0,0 +1,75 @@
+"""
+Measures the throughput of the adaptive profiling scheduler when many client
+threads schedule tasks at once. The peers are synthetic and performing a task
+at a peer is simulated by sleeping, so no surrogates need to be running.
+The scheduler modules are imported directly, so the Scavenger singleton is
+not created, and the profiles are kept in a temporary HOME directory.
+"""
+
+from threading import Thread
+from time import time
+import os
+import sys
+import shutil
+import tempfile
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test'))
+
+from fakes import FakeScavenger, LocalActivity
+from context import Context, ScavengerPeer
+from adaptiveprofilingscheduler import AdaptiveProfScheduler
+from scheduler import ScheduleError
+from task import AdaptiveProfTaskInvokation
+
+PEERS = 200
+TASKS_PER_THREAD = 200
+PERFORM_TIME = 0.005
+
+class SleepingScavenger(FakeScavenger):
+    """Tasks are 'performed' by sleeping."""
+    perform_time = PERFORM_TIME
+
+def run(scheduler, threads):
+    activity = LocalActivity()
+    def client():
+        for i in range(TASKS_PER_THREAD):
+            task = AdaptiveProfTaskInvokation('daimi.test.bench', (i, i), output_size = '1',
+                                              complexity_relation = '#0')
+            try:
+                scheduler.schedule(task, 1.0, 100000, activity, prefer_remote = True)
+            except ScheduleError:
+                activity.decrement()
+
+    workers = [Thread(target=client) for i in range(threads)]
+    start = time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return threads * TASKS_PER_THREAD / (time() - start)
+
+def main():
+    # Keep the synthetic profiles away from those of the user.
+    os.environ['HOME'] = tempfile.mkdtemp()
+    os.mkdir(os.path.join(os.environ['HOME'], '.scavenger'))
+    try:
+        random.seed(0)
+        context = Context(timeout = 3600.0)
+        for i in range(PEERS):
+            context.add(ScavengerPeer('peer%i'%i, ('127.0.0.1', 10000 + i), random.uniform(10, 500),
+                                      random.choice([1, 2, 4]), 0, random.choice([100000, 500000, 2500000])))
+        scheduler = AdaptiveProfScheduler(context, SleepingScavenger, engine = 'python')
+
+        print "%i peers, %i tasks per thread, %.3f seconds per task"%(PEERS, TASKS_PER_THREAD, PERFORM_TIME)
+        for threads in (1, 2, 4, 8, 16, 32):
+            print "%2i threads: %8.1f tasks/s"%(threads, run(scheduler, threads))
+
+        scheduler.lprofile.close()
+        scheduler.gprofile.close()
+        scheduler.links.close()
+    finally:
+        shutil.rmtree(os.environ['HOME'], True)
+
+if __name__ == '__main__':
+    main()
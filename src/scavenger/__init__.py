@@ -1,2 +1,5 @@
 from scavenger import shutdown, Scavenger
 from decorators import scavenge
+from pipeline import Pipeline
+from schedule.futures import Future, FutureTimeout, as_completed, wait
+from chunked import ChunkedDataHandle, TransferInterrupted, map_file
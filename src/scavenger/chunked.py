@@ -0,0 +1,260 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Chunked transfer of large data to and from the data stores of the
+surrogates. The data is split into chunks that are stored as separate data
+items, so only a few chunks are held in memory at any time no matter how
+large the data is, and a transfer that is interrupted can be resumed from
+the first chunk that was not transferred."""
+
+from __future__ import with_statement
+from Queue import Queue, Full
+from threading import Thread
+from schedule.failover import RETRYABLE_ERRORS
+import mmap
+import sys
+
+CHUNK_SIZE = 1024 * 1024 # The default chunk size in bytes.
+WINDOW = 4 # The default number of chunks read ahead of the transfer.
+RETRIES = 3 # The default number of times the transfer of a chunk is retried.
+
+class TransferInterrupted(Exception):
+    """Raised when a chunked transfer fails. The transfer attribute holds the
+    interrupted transfer, which may be given back to Scavenger.store_data_chunked
+    or Scavenger.fetch_data_chunked to resume it."""
+    def __init__(self, transfer, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+        self.transfer = transfer
+
+_END = object()
+
+class _Failure(object):
+    def __init__(self, exc_info):
+        super(_Failure, self).__init__()
+        self.exc_info = exc_info
+
+def _pipe(produce, consume, window):
+    """
+    Consumes the items of an iterable while it is being iterated in another
+    thread. The items are passed through a queue of at most window items, and
+    the producing thread blocks while the queue is full.
+    @type produce: iterable
+    @param produce: The items.
+    @type consume: function
+    @param consume: The function called with each item.
+    @type window: int
+    @param window: The size of the queue.
+    """
+    queue = Queue(window)
+    stopped = [False]
+    def put(item):
+        while not stopped[0]:
+            try:
+                queue.put(item, True, 0.1)
+                return True
+            except Full:
+                pass
+        return False
+    def run():
+        try:
+            for item in produce:
+                if not put(item):
+                    return
+            put(_END)
+        except:
+            put(_Failure(sys.exc_info()))
+    producer = Thread(target=run)
+    producer.setDaemon(True)
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+            consume(item)
+    finally:
+        # Make the producer give up if the consumer failed.
+        stopped[0] = True
+
+def _retry(function, argument, retries):
+    """Calls the function, retrying it if the surrogate could not be used."""
+    for attempt in range(retries + 1):
+        try:
+            return function(argument)
+        except RETRYABLE_ERRORS:
+            if attempt == retries:
+                raise
+
+def map_file(filename):
+    """
+    Memory-maps a file for use as the source of a chunked upload. Only the
+    chunks being transferred are read into memory.
+    @type filename: str
+    @param filename: The name of the file.
+    @rtype: mmap.mmap
+    """
+    with open(filename, 'rb') as infile:
+        infile.seek(0, 2)
+        if infile.tell() == 0:
+            # Empty files can not be mapped.
+            return ''
+        return mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+
+class _Source(object):
+    """Random access to the bytes of an upload source."""
+    def __init__(self, source):
+        super(_Source, self).__init__()
+        if hasattr(source, 'read'):
+            # A file.
+            self._file = source
+            self._start = source.tell()
+            self._view = None
+        else:
+            # Anything supporting the buffer interface: strings, arrays,
+            # memory-mapped files... The view does not copy the data.
+            self._file = None
+            self._view = buffer(source)
+
+    def read(self, offset, length):
+        if self._file == None:
+            return self._view[offset:offset + length]
+        self._file.seek(self._start + offset)
+        return self._file.read(length)
+
+class ChunkedDataHandle(object):
+    """A handle to data that is stored as a list of chunks. Each chunk is a
+    separate data item, held by the surrogate given by its RemoteDataHandle.
+    The surrogates only resolve plain data handles, so tasks given chunked 
+    data as input are always performed locally."""
+    def __init__(self, handles, size, chunk_size):
+        """
+        Constructor.
+        @type handles: list
+        @param handles: The RemoteDataHandle of each chunk, in order.
+        @type size: int
+        @param size: The total size of the data.
+        @type chunk_size: int
+        @param chunk_size: The size of every chunk but the last.
+        """
+        super(ChunkedDataHandle, self).__init__()
+        self.handles = handles
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.handles)
+
+class ChunkedUpload(object):
+    """A chunked upload of data, possibly interrupted."""
+    def __init__(self, source, chunk_size = CHUNK_SIZE, window = WINDOW, retries = RETRIES):
+        """
+        Constructor.
+        @type source: object
+        @param source: The data. This may be a string, an array or anything
+        else supporting the buffer interface (e.g., a memory-mapped file, see
+        map_file), or a seekable file object.
+        @type chunk_size: int
+        @param chunk_size: The size of the chunks.
+        @type window: int
+        @param window: The number of chunks that are read ahead of the upload.
+        @type retries: int
+        @param retries: The number of times the upload of a chunk is retried.
+        """
+        super(ChunkedUpload, self).__init__()
+        self._source = _Source(source)
+        self._chunk_size = chunk_size
+        self._window = window
+        self._retries = retries
+        self.handles = []
+        self.size = 0
+
+    def _chunks(self):
+        offset = self.size
+        while True:
+            chunk = self._source.read(offset, self._chunk_size)
+            if len(chunk) == 0:
+                return
+            yield chunk
+            offset += len(chunk)
+
+    def run(self, store):
+        """
+        Uploads the chunks that have not been uploaded yet.
+        @type store: function
+        @param store: A function storing a chunk, returning its RemoteDataHandle.
+        @rtype: ChunkedDataHandle
+        @raise TransferInterrupted: If a chunk could not be uploaded.
+        """
+        def upload(chunk):
+            self.handles.append(_retry(store, chunk, self._retries))
+            self.size += len(chunk)
+        try:
+            _pipe(self._chunks(), upload, self._window)
+        except RETRYABLE_ERRORS, e:
+            raise TransferInterrupted(self, 'Upload interrupted after %i bytes: %s'%(self.size, e))
+        return ChunkedDataHandle(list(self.handles), self.size, self._chunk_size)
+
+class ChunkedDownload(object):
+    """A chunked download of data, possibly interrupted."""
+    def __init__(self, handle, sink = None, window = WINDOW, retries = RETRIES):
+        """
+        Constructor.
+        @type handle: ChunkedDataHandle
+        @param handle: The data.
+        @type sink: file
+        @param sink: The file-like object the data is written to. If None the
+        data is collected in memory.
+        @type window: int
+        @param window: The number of chunks that are fetched ahead of the sink.
+        @type retries: int
+        @param retries: The number of times the download of a chunk is retried.
+        """
+        super(ChunkedDownload, self).__init__()
+        self._handle = handle
+        self._sink = sink
+        self._parts = []
+        self._window = window
+        self._retries = retries
+        self.position = 0 # The number of chunks written to the sink.
+
+    def _chunks(self, fetch):
+        for handle in self._handle.handles[self.position:]:
+            yield _retry(fetch, handle, self._retries)
+
+    def run(self, fetch):
+        """
+        Downloads the chunks that have not been downloaded yet.
+        @type fetch: function
+        @param fetch: A function fetching the data of a RemoteDataHandle.
+        @rtype: str
+        @return: The data if no sink was given, otherwise None.
+        @raise TransferInterrupted: If a chunk could not be downloaded.
+        """
+        def write(chunk):
+            if self._sink == None:
+                self._parts.append(chunk)
+            else:
+                self._sink.write(chunk)
+            self.position += 1
+        try:
+            _pipe(self._chunks(fetch), write, self._window)
+        except RETRYABLE_ERRORS, e:
+            raise TransferInterrupted(self, 'Download interrupted after %i of %i chunks: %s'%
+                                      (self.position, len(self._handle), e))
+        if self._sink == None:
+            return ''.join(self._parts)
+        return None
@@ -89,6 +89,129 @@ class Config(SafeConfigParser):
         if not self.has_option('cpu', 'cores'):
             self.set('cpu', 'cores', '1')
 
+        # Context information.
+        if not self.has_section('context'):
+            self.add_section('context')
+        if not self.has_option('context', 'timeout'):
+            self.set('context', 'timeout', '5.0')
+        if not self.has_option('context', 'cleanup_at'):
+            self.set('context', 'cleanup_at', '100')
+        if not self.has_option('context', 'publish_interval'):
+            self.set('context', 'publish_interval', '1.0')
+
+        # Connection pool information.
+        if not self.has_section('connections'):
+            self.add_section('connections')
+        if not self.has_option('connections', 'max_idle_per_peer'):
+            self.set('connections', 'max_idle_per_peer', '4')
+        if not self.has_option('connections', 'max_idle_time'):
+            self.set('connections', 'max_idle_time', '30.0')
+        if not self.has_option('connections', 'max_per_peer'):
+            self.set('connections', 'max_per_peer', '8')
+        if not self.has_option('connections', 'acquire_timeout'):
+            self.set('connections', 'acquire_timeout', '30.0')
+
+        # Dispatcher information.
+        if not self.has_section('dispatcher'):
+            self.add_section('dispatcher')
+        if not self.has_option('dispatcher', 'workers'):
+            self.set('dispatcher', 'workers', '8')
+
+        # Scheduler information.
+        if not self.has_section('scheduler'):
+            self.add_section('scheduler')
+        if not self.has_option('scheduler', 'engine'):
+            self.set('scheduler', 'engine', 'auto')
+        if not self.has_option('scheduler', 'vector_threshold'):
+            self.set('scheduler', 'vector_threshold', '64')
+
+        # Hedging information.
+        if not self.has_section('hedging'):
+            self.add_section('hedging')
+        if not self.has_option('hedging', 'percentile'):
+            self.set('hedging', 'percentile', '0.95')
+        if not self.has_option('hedging', 'min_delay'):
+            self.set('hedging', 'min_delay', '0.5')
+
+        # Failover information.
+        if not self.has_section('failover'):
+            self.add_section('failover')
+        if not self.has_option('failover', 'deadline_factor'):
+            self.set('failover', 'deadline_factor', '3.0')
+        if not self.has_option('failover', 'deadline_slack'):
+            self.set('failover', 'deadline_slack', '5.0')
+        if not self.has_option('failover', 'max_retries'):
+            self.set('failover', 'max_retries', '2')
+        if not self.has_option('failover', 'retry_ratio'):
+            self.set('failover', 'retry_ratio', '0.1')
+        if not self.has_option('failover', 'retry_reserve'):
+            self.set('failover', 'retry_reserve', '10')
+
+        # Peer health information.
+        if not self.has_section('health'):
+            self.add_section('health')
+        if not self.has_option('health', 'error_threshold'):
+            self.set('health', 'error_threshold', '0.5')
+        if not self.has_option('health', 'min_calls'):
+            self.set('health', 'min_calls', '5')
+        if not self.has_option('health', 'open_time'):
+            self.set('health', 'open_time', '10.0')
+        if not self.has_option('health', 'max_open_time'):
+            self.set('health', 'max_open_time', '300.0')
+        if not self.has_option('health', 'probes'):
+            self.set('health', 'probes', '1')
+        if not self.has_option('health', 'slow_ratio'):
+            self.set('health', 'slow_ratio', '10.0')
+
+        # Result cache information (a ttl of 0 means no limit).
+        if not self.has_section('cache'):
+            self.add_section('cache')
+        if not self.has_option('cache', 'max_entries'):
+            self.set('cache', 'max_entries', '1024')
+        if not self.has_option('cache', 'max_bytes'):
+            self.set('cache', 'max_bytes', str(64 * 1024 * 1024))
+        if not self.has_option('cache', 'ttl'):
+            self.set('cache', 'ttl', '0')
+        if not self.has_option('cache', 'disk'):
+            self.set('cache', 'disk', 'false')
+
+        # Coalescing of identical invocations of the tasks that allow it.
+        if not self.has_section('coalescing'):
+            self.add_section('coalescing')
+        if not self.has_option('coalescing', 'enabled'):
+            self.set('coalescing', 'enabled', 'true')
+
+        # Compression of task input (an empty list of codecs disables it).
+        if not self.has_section('compression'):
+            self.add_section('compression')
+        if not self.has_option('compression', 'codecs'):
+            self.set('compression', 'codecs', 'zlib,bz2')
+        if not self.has_option('compression', 'min_size'):
+            self.set('compression', 'min_size', '1024')
+
+        # Chunked data transfers.
+        if not self.has_section('transfer'):
+            self.add_section('transfer')
+        if not self.has_option('transfer', 'chunk_size'):
+            self.set('transfer', 'chunk_size', str(1024 * 1024))
+        if not self.has_option('transfer', 'window'):
+            self.set('transfer', 'window', '4')
+        if not self.has_option('transfer', 'retries'):
+            self.set('transfer', 'retries', '3')
+
+        # Streaming of the results of generator tasks.
+        if not self.has_section('streaming'):
+            self.add_section('streaming')
+        if not self.has_option('streaming', 'chunk_size'):
+            self.set('streaming', 'chunk_size', '64')
+
+        # Local execution ('thread' performs local tasks in the calling
+        # thread, 'process' in a pool of cpu.cores worker processes).
+        if not self.has_section('local'):
+            self.add_section('local')
+        if not self.has_option('local', 'executor'):
+            self.set('local', 'executor', 'thread')
+
 class BogomipsMeasurer(Thread):
     def __init__(self):
         Thread.__init__(self)
@@ -0,0 +1,222 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A pool of SCProxy connections keyed by peer address. This allows
+back-to-back RPC calls to the same surrogate to reuse an already
+established connection instead of paying for a connection setup and
+teardown on every call."""
+
+from __future__ import with_statement
+from scrpc import SCProxy
+from contextlib import contextmanager
+from threading import Condition
+from time import time
+
+class ConnectionTimeout(IOError):
+    """Raised when no connection to a peer becomes available in time. This
+    is an IOError, so the peer is treated like one that can not be reached."""
+    def __init__(self, *args, **kwargs):
+        IOError.__init__(self, *args, **kwargs)
+
+class PooledConnection(object):
+    """Wraps an SCProxy object along with some bookkeeping information."""
+    def __init__(self, proxy):
+        super(PooledConnection, self).__init__()
+        self.proxy = proxy
+        self.created = time()
+        self.last_used = self.created
+
+class ConnectionPool(object):
+    MAX_IDLE_PER_PEER = 4
+    MAX_IDLE_TIME = 30.0
+    MAX_PER_PEER = 8
+    ACQUIRE_TIMEOUT = 30.0
+
+    def __init__(self, max_idle_per_peer = MAX_IDLE_PER_PEER,
+                 max_idle_time = MAX_IDLE_TIME, max_per_peer = MAX_PER_PEER,
+                 acquire_timeout = ACQUIRE_TIMEOUT):
+        """
+        Constructor.
+        @type max_idle_per_peer: int
+        @param max_idle_per_peer: The maximum number of idle connections that
+        are kept around for a single peer.
+        @type max_idle_time: float
+        @param max_idle_time: The number of seconds a connection may sit idle
+        in the pool before it is evicted.
+        @type max_per_peer: int
+        @param max_per_peer: The maximum number of connections open to a 
+        single peer, idle or not.
+        @type acquire_timeout: float
+        @param acquire_timeout: The number of seconds to wait for a connection
+        when max_per_peer connections to the peer are already in use.
+        """
+        super(ConnectionPool, self).__init__()
+        self._max_idle_per_peer = max_idle_per_peer
+        self._max_idle_time = max_idle_time
+        self._max_per_peer = max(1, max_per_peer)
+        self._acquire_timeout = acquire_timeout
+        self._idle = {}
+        # The number of connections open to each address, idle or not.
+        self._open = {}
+        self._next_eviction = time() + max_idle_time
+        self._condition = Condition()
+
+    def _close(self, pooled):
+        try: pooled.proxy.close()
+        except: pass
+
+    def _forget(self, address, count = 1):
+        """Accounts for closed connections to the given address. Must be 
+        called with the lock held."""
+        left = self._open.get(address, 0) - count
+        if left > 0:
+            self._open[address] = left
+        else:
+            self._open.pop(address, None)
+        self._condition.notifyAll()
+
+    def acquire(self, address, timeout = None):
+        """
+        Get a connection to the given address. An idle connection is reused
+        if one is available - otherwise a new connection is established, 
+        unless max_per_peer connections are open to the address already in
+        which case one of them is waited for.
+        @type address: ( str, int ) - tuple
+        @param address: The RPC address of the peer.
+        @type timeout: float
+        @param timeout: The number of seconds to wait for a connection (None
+        for the acquire_timeout of the pool).
+        @rtype: PooledConnection
+        @raise ConnectionTimeout: If no connection became available in time.
+        """
+        if timeout == None:
+            timeout = self._acquire_timeout
+        now = time()
+        deadline = now + timeout
+        stale = None
+        with self._condition:
+            while True:
+                idle = self._idle.get(address)
+                if idle:
+                    # Reuse the most recently used connection first.
+                    pooled = idle.pop()
+                    if not idle:
+                        del self._idle[address]
+                    if now - pooled.last_used <= self._max_idle_time:
+                        return pooled
+                    # The connection has been idle for too long - a new one 
+                    # takes its place.
+                    stale = pooled
+                    break
+                if self._open.get(address, 0) < self._max_per_peer:
+                    self._open[address] = self._open.get(address, 0) + 1
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise ConnectionTimeout('No connection to %s:%i became available within %.1f seconds.'%
+                                            (address[0], address[1], timeout))
+                self._condition.wait(remaining)
+                now = time()
+        if stale != None:
+            self._close(stale)
+        try:
+            return PooledConnection(SCProxy(address))
+        except:
+            with self._condition:
+                self._forget(address)
+            raise
+
+    def release(self, address, pooled, discard = False):
+        """
+        Return a connection to the pool. Connections that have been idle for
+        too long are closed every once in a while when this is called.
+        @type address: ( str, int ) - tuple
+        @param address: The RPC address that the connection goes to.
+        @type pooled: PooledConnection
+        @param pooled: The connection.
+        @type discard: bool
+        @param discard: If True the connection is closed instead of being
+        put back into the pool. This should be used if an error occurred
+        while the connection was in use.
+        """
+        now = time()
+        pooled.last_used = now
+        with self._condition:
+            idle = self._idle.setdefault(address, [])
+            if not discard and len(idle) < self._max_idle_per_peer:
+                idle.append(pooled)
+                self._condition.notifyAll()
+                pooled = None
+            else:
+                if not idle:
+                    del self._idle[address]
+                self._forget(address)
+            evict = now >= self._next_eviction
+        if pooled != None:
+            self._close(pooled)
+        if evict:
+            self.evict_idle()
+
+    @contextmanager
+    def connection(self, address):
+        """Context manager that yields a pooled SCProxy for the given address.
+        If the body raises an exception the connection is discarded."""
+        pooled = self.acquire(address)
+        try:
+            yield pooled.proxy
+        except:
+            self.release(address, pooled, True)
+            raise
+        else:
+            self.release(address, pooled)
+
+    def purge(self, address):
+        """Close all idle connections to the given address."""
+        with self._condition:
+            idle = self._idle.pop(address, [])
+            self._forget(address, len(idle))
+        for pooled in idle:
+            self._close(pooled)
+
+    def evict_idle(self):
+        """Close all connections that have been idle for too long."""
+        now = time()
+        stale = []
+        with self._condition:
+            self._next_eviction = now + self._max_idle_time
+            for address, idle in self._idle.items():
+                fresh = []
+                for pooled in idle:
+                    if now - pooled.last_used > self._max_idle_time:
+                        stale.append(pooled)
+                    else:
+                        fresh.append(pooled)
+                if fresh:
+                    self._idle[address] = fresh
+                else:
+                    del self._idle[address]
+                self._forget(address, len(idle) - len(fresh))
+        for pooled in stale:
+            self._close(pooled)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._condition:
+            idle, self._idle = self._idle, {}
+            for address, connections in idle.items():
+                self._forget(address, len(connections))
+        for connections in idle.values():
+            for pooled in connections:
+                self._close(pooled)
@@ -20,8 +20,8 @@ from __future__ import with_statement
 from presence import Presence
 import struct
 from time import time
-from copy import deepcopy
 from thread import allocate_lock
+from heapq import heappush, heappop, heapify
 
 class ScavengerPeer(object):
     def __init__(self, name, address, cpu_strength, cpu_cores, active_tasks, network_media):
@@ -73,70 +73,523 @@ class ScavengerPeer(object):
                                             self.active_tasks,
                                             self.net)
         
+class PeerTable(object):
+    """
+    An immutable snapshot of the peers known at some point in time. A new 
+    table is published every time the set of peers changes, so readers can
+    use a table without locking or copying. The peers in a table must be 
+    treated as read-only.
+    """
+    def __init__(self, peers, version):
+        super(PeerTable, self).__init__()
+        self._peers = peers
+        self._peer_list = tuple(peers.values())
+        self._version = version
+        self._by_media = None
+
+    def _get_version(self):
+        return self._version
+    version = property(_get_version, doc = """The version number of the table.""")
+
+    def _get_peers(self):
+        return self._peer_list
+    peers = property(_get_peers, doc = """A tuple of the peers in the table.""")
+
+    def get(self, name):
+        return self._peers[name]
+
+    def has(self, name):
+        return self._peers.has_key(name)
+
+    def __len__(self):
+        return len(self._peer_list)
+
+    def by_media(self):
+        """
+        Get the peers grouped by network media, each group sorted by 
+        descending CPU strength. The index is built the first time it is 
+        needed and is then shared by all users of this table.
+        @rtype: list
+        @return: A list of ( network_media, peers ) tuples.
+        """
+        if self._by_media == None:
+            groups = {}
+            for peer in self._peer_list:
+                groups.setdefault(peer.net, []).append(peer)
+            index = []
+            for net, peers in groups.items():
+                peers.sort(key=lambda peer: peer.cpu_strength, reverse=True)
+                index.append((net, tuple(peers)))
+            self._by_media = index
+        return self._by_media
+
+class ActivityCounters(object):
+    """Counts the tasks this client currently has running at each peer."""
+    def __init__(self):
+        super(ActivityCounters, self).__init__()
+        self._counters = {}
+        self._lock = allocate_lock()
+
+    def increment(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+    def decrement(self, name):
+        with self._lock:
+            count = self._counters.get(name, 0) - 1
+            # Small sanity check here.
+            if count <= 0:
+                self._counters.pop(name, None)
+            else:
+                self._counters[name] = count
+
+    def get(self, name):
+        return self._counters.get(name, 0)
+
+    def reserve(self, name, expected):
+        """Increments the counter of the given peer, but only if it has not
+        grown beyond the expected value. Returns True on success."""
+        with self._lock:
+            count = self._counters.get(name, 0)
+            if count > expected:
+                return False
+            self._counters[name] = count + 1
+            return True
+
+    def items(self):
+        with self._lock:
+            return self._counters.items()
+
+    def forget(self, name):
+        with self._lock:
+            self._counters.pop(name, None)
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of a single peer: its error rate, the number of timeouts
+    and how its observed running times compare to the predicted ones. When the
+    error rate gets too high the breaker opens and the peer is no longer used.
+    After a while the breaker becomes half-open, and a few probe tasks are sent
+    to the peer. If these succeed the breaker closes again - otherwise it is
+    opened for twice as long as the last time.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    WEIGHT = 0.2 # The weight given to a new outcome in the moving averages.
+
+    def __init__(self, policy):
+        super(CircuitBreaker, self).__init__()
+        self._policy = policy
+        self.state = CircuitBreaker.CLOSED
+        self.error_rate = 0.0
+        self.latency_ratio = 1.0
+        self.timeouts = 0
+        self._calls = 0
+        self._open_time = policy.open_time
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+
+    def available(self, now):
+        """Returns True if tasks may be sent to the peer."""
+        if self.state == CircuitBreaker.CLOSED:
+            return True
+        if self.state == CircuitBreaker.OPEN:
+            return now >= self._opened_at + self._open_time
+        return self._probes < self._policy.probes
+
+    def dispatch(self, now):
+        if self.state == CircuitBreaker.OPEN and now >= self._opened_at + self._open_time:
+            self.state = CircuitBreaker.HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self._probes += 1
+
+    def _open(self, now):
+        if self.state == CircuitBreaker.HALF_OPEN:
+            # The peer is still broken - leave it alone for longer this time.
+            self._open_time = min(self._policy.max_open_time, self._open_time * 2)
+        self.state = CircuitBreaker.OPEN
+        self._opened_at = now
+
+    def _close(self):
+        self.state = CircuitBreaker.CLOSED
+        self.error_rate = 0.0
+        self._calls = 0
+        self._open_time = self._policy.open_time
+
+    def success(self, now, elapsed, predicted = None):
+        if predicted != None and predicted > 0:
+            ratio = elapsed / predicted
+            self.latency_ratio += CircuitBreaker.WEIGHT * (ratio - self.latency_ratio)
+            if ratio > self._policy.slow_ratio:
+                # Far too slow counts as a failure.
+                self.failure(now)
+                return
+        self._outcome(now, 0.0)
+
+    def failure(self, now, timeout = False):
+        if timeout:
+            self.timeouts += 1
+        self._outcome(now, 1.0)
+
+    def _outcome(self, now, error):
+        self._calls += 1
+        self.error_rate += CircuitBreaker.WEIGHT * (error - self.error_rate)
+        if self.state == CircuitBreaker.HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if error > 0:
+                self._open(now)
+            else:
+                self._probe_successes += 1
+                if self._probe_successes >= self._policy.probes:
+                    self._close()
+        elif self.state == CircuitBreaker.CLOSED:
+            if self._calls >= self._policy.min_calls and self.error_rate >= self._policy.error_threshold:
+                self._open(now)
+
+class HealthPolicy(object):
+    """The thresholds used by the circuit breakers."""
+    def __init__(self, error_threshold = 0.5, min_calls = 5, open_time = 10.0, 
+                 max_open_time = 300.0, probes = 1, slow_ratio = 10.0):
+        """
+        Constructor.
+        @type error_threshold: float
+        @param error_threshold: The error rate (a moving average in [0;1]) at 
+        which the breaker of a peer opens.
+        @type min_calls: int
+        @param min_calls: The number of calls made to a peer before its breaker 
+        may open.
+        @type open_time: float
+        @param open_time: The number of seconds a breaker stays open the first time.
+        @type max_open_time: float
+        @param max_open_time: The longest time a breaker stays open.
+        @type probes: int
+        @param probes: The number of probe tasks that must succeed before a 
+        half-open breaker closes. Only this many probes are sent at a time.
+        @type slow_ratio: float
+        @param slow_ratio: A task taking this many times longer than predicted
+        counts as a failure.
+        """
+        super(HealthPolicy, self).__init__()
+        self.error_threshold = error_threshold
+        self.min_calls = min_calls
+        self.open_time = open_time
+        self.max_open_time = max_open_time
+        self.probes = probes
+        self.slow_ratio = slow_ratio
+
 class Context(object):
     TIMEOUT = 5.0
     CLEANUP_AT = 100
+    PUBLISH_INTERVAL = 1.0
     
-    def __init__(self):
+    def __init__(self, timeout = TIMEOUT, cleanup_at = CLEANUP_AT, health = None,
+                 publish_interval = PUBLISH_INTERVAL):
+        """
+        Constructor.
+        @type timeout: float
+        @param timeout: The number of seconds a peer is kept after its last 
+        announcement.
+        @type cleanup_at: int
+        @param cleanup_at: The expiry index is rebuilt when it holds more than 
+        this many entries and more than a few entries per peer.
+        @type health: HealthPolicy
+        @param health: The thresholds of the per-peer circuit breakers.
+        @type publish_interval: float
+        @param publish_interval: The peer table is republished at most this 
+        often when known peers announce themselves again. Peers that join or
+        leave are published right away.
+        """
         super(Context, self).__init__()
-        self.__peers = {}
+        self._timeout = timeout
+        self._cleanup_at = cleanup_at
+        self._publish_interval = publish_interval
+        # The current peers, the published peer table, and whether the two 
+        # differ in the set of peers (dirty) or only in what the peers have
+        # announced (updated).
+        self._peers = {}
+        self._table = PeerTable({}, 0)
+        self._dirty = False
+        self._updated = False
+        self._published = 0.0
+        self._next_publish = float('inf')
+        # A heap of ( timestamp, name ) tuples used for expiring peers. Entries 
+        # made obsolete by newer announcements are skipped when popped.
+        self._expiry = []
+        self._next_expiry = float('inf')
+        self._activity = ActivityCounters()
+        # The circuit breakers of the peers that have been used.
+        self._health_policy = health or HealthPolicy()
+        self._breakers = {}
+        self._unhealthy = set()
+        self._health_lock = allocate_lock()
         self._lock = allocate_lock()
+        self._removal_listeners = []
+        self.add_removal_listener(lambda peer: self._activity.forget(peer.name))
+        self.add_removal_listener(self._forget_health)
+
+    def add_removal_listener(self, listener):
+        """
+        Register a function that is called whenever a peer is dropped from the 
+        context because it has timed out.
+        @type listener: function
+        @param listener: A function accepting the removed ScavengerPeer.
+        """
+        self._removal_listeners.append(listener)
+
+    def _notify_removed(self, removed):
+        for peer in removed:
+            for listener in self._removal_listeners:
+                try:
+                    listener(peer)
+                except:
+                    pass
+
+    def _expire(self, now):
+        """Removes the peers that have timed out and returns them. Must be 
+        called with the lock held."""
+        removed = []
+        deadline = now - self._timeout
+        while self._expiry and self._expiry[0][0] < deadline:
+            timestamp, name = heappop(self._expiry)
+            peer = self._peers.get(name)
+            # Note: ScavengerPeer compares by strength, so test for None by identity.
+            if peer is not None and peer.timestamp == timestamp:
+                removed.append(self._peers.pop(name))
+                self._dirty = True
+        if self._expiry:
+            self._next_expiry = self._expiry[0][0] + self._timeout
+        else:
+            self._next_expiry = float('inf')
+        return removed
+
+    def _publish(self, now):
+        """Publishes a new peer table if the peers have changed. Must be 
+        called with the lock held."""
+        if self._dirty or (self._updated and now >= self._published + self._publish_interval):
+            self._table = PeerTable(dict(self._peers), self._table.version + 1)
+            self._dirty = False
+            self._updated = False
+            self._published = now
+        # The time at which snapshot must look again.
+        self._next_publish = self._next_expiry
+        if self._updated:
+            self._next_publish = min(self._next_publish, self._published + self._publish_interval)
 
     def add(self, peer):
         with self._lock:
-            # Add the peer.
-            self.__peers[peer.name] = peer
-            
-            # Check whether it is time to do some cleaning.
-            if len(self.__peers) > Context.CLEANUP_AT:
-                now = time()
-                for peer in self.__peers.values():
-                    if now - peer.timestamp > Context.TIMEOUT:
-                        self.__peers.pop(peer.name)
+            # Add the peer. A peer that is already known has only refreshed
+            # its announcement, and need not be published right away.
+            if self._peers.has_key(peer.name):
+                self._updated = True
+            else:
+                self._dirty = True
+            self._peers[peer.name] = peer
+            heappush(self._expiry, (peer.timestamp, peer.name))
+
+            # Check whether it is time to rebuild the expiry index.
+            if len(self._expiry) > max(self._cleanup_at, 4 * len(self._peers)):
+                self._expiry = [(p.timestamp, p.name) for p in self._peers.values()]
+                heapify(self._expiry)
+
+            now = time()
+            removed = self._expire(now)
+            if self._dirty:
+                self._next_publish = now
+            else:
+                self._next_publish = min(self._next_publish, self._next_expiry,
+                                         self._published + self._publish_interval)
+        self._notify_removed(removed)
+
+    def snapshot(self):
+        """
+        Get the current peer table. The table is rebuilt when peers have 
+        joined or expired since it was last published, and at most once per
+        publish interval when known peers have announced themselves again, 
+        so most calls return without locking or copying.
+        @rtype: PeerTable
+        """
+        now = time()
+        if now < self._next_publish:
+            return self._table
+        with self._lock:
+            removed = self._expire(now)
+            self._publish(now)
+            table = self._table
+        self._notify_removed(removed)
+        return table
     
     def get_peer(self, name):
-        with self._lock:
-            return self.__peers[name]
+        """
+        Get the peer with the given name.
+        @rtype: ScavengerPeer
+        @return: The peer, or None if it is not (or no longer) in the context.
+        """
+        table = self.snapshot()
+        if not table.has(name):
+            return None
+        return table.get(name)
                 
     def get_peers(self):
-        now = time()
-        peers = []
-        with self._lock:
-            for peer in self.__peers.values():
-                # Cleanout stale entries.
-                if now - peer.timestamp > Context.TIMEOUT:
-                    self.__peers.pop(peer.name)
-                else:
-                    peers.append(deepcopy(peer))
-        return peers
+        """
+        Get the peers that have not timed out.
+        @rtype: tuple
+        @return: The peers. These are shared with the peer table and must 
+        not be modified.
+        """
+        return self.snapshot().peers
     
     def has_peer(self, name):
-        with self._lock:
-            return self.__peers.has_key(name)
+        return self.snapshot().has(name)
 
     def resolve(self, name):
-        with self._lock:
-            return self.__peers[name].address
+        return self.snapshot().get(name).address
+
+    def get_active_tasks(self, peer):
+        """
+        Get the number of tasks that are active at the given peer. This is the
+        number announced by the peer itself or the number of tasks this client
+        has running at the peer, whichever is larger.
+        @type peer: ScavengerPeer
+        @param peer: The peer.
+        @rtype: int
+        """
+        return max(peer.active_tasks, self._activity.get(peer.name))
+
+    def get_local_activity(self):
+        """
+        Get the number of tasks this client has running at each peer.
+        @rtype: dict
+        @return: A dict mapping peer names to task counts. Peers without 
+        running tasks are left out.
+        """
+        return dict(self._activity.items())
 
     def increment_peer_activity(self, name):
-        with self._lock:
-            if self.__peers.has_key(name):
-                self.__peers[name].active_tasks += 1
+        self._activity.increment(name)
+
+    def reserve_peer(self, name, expected):
+        """
+        Atomically reserves a task slot at the given peer. The reservation 
+        fails if other tasks have been started at the peer since the number 
+        of active tasks was read.
+        @type name: str
+        @param name: The name of the peer.
+        @type expected: int
+        @param expected: The number of tasks this client had running at the
+        peer when the scheduling decision was made.
+        @rtype: bool
+        @return: True if the slot was reserved. The reservation is released
+        with decrement_peer_activity.
+        """
+        return self._activity.reserve(name, expected)
         
     def decrement_peer_activity(self, name):
-        with self._lock:
-            if self.__peers.has_key(name):
-                self.__peers[name].active_tasks -= 1
-                # Small sanity check here.
-                if self.__peers[name].active_tasks < 0:
-                    self.__peers[name].active_tasks = 0
+        self._activity.decrement(name)
+
+    def _breaker(self, name):
+        """Get the circuit breaker of a peer. Must be called with the health lock held."""
+        breaker = self._breakers.get(name)
+        if breaker == None:
+            breaker = CircuitBreaker(self._health_policy)
+            self._breakers[name] = breaker
+        return breaker
+
+    def _update_health(self, name, breaker, now):
+        if breaker.available(now):
+            self._unhealthy.discard(name)
+        else:
+            self._unhealthy.add(name)
+
+    def _forget_health(self, peer):
+        with self._health_lock:
+            self._breakers.pop(peer.name, None)
+            self._unhealthy.discard(peer.name)
+
+    def get_unavailable_peers(self):
+        """
+        Get the peers that should not be sent any tasks right now because 
+        their circuit breakers are open (or half-open with the maximum number
+        of probes in flight).
+        @rtype: set
+        @return: The names of the peers.
+        """
+        if not self._unhealthy:
+            return set()
+        now = time()
+        with self._health_lock:
+            for name in list(self._unhealthy):
+                self._update_health(name, self._breakers[name], now)
+            return set(self._unhealthy)
+
+    def is_available(self, name):
+        return not name in self.get_unavailable_peers()
+
+    def get_health(self, name):
+        """
+        Get the health of a peer.
+        @rtype: dict
+        @return: The breaker state, error rate, number of timeouts and the ratio
+        of observed to predicted running times of the peer.
+        """
+        with self._health_lock:
+            breaker = self._breaker(name)
+            return {'state' : breaker.state, 'error_rate' : breaker.error_rate,
+                    'timeouts' : breaker.timeouts, 'latency_ratio' : breaker.latency_ratio}
+
+    def try_dispatch(self, name):
+        """
+        Atomically checks that a task may be sent to the given peer and 
+        records that it is sent, so concurrent clients can not take more 
+        probes of a half-open circuit breaker than it allows.
+        @type name: str
+        @param name: The name of the peer.
+        @rtype: bool
+        @return: True if the task may be sent. Its outcome must then be 
+        recorded with record_success or record_failure.
+        """
+        now = time()
+        with self._health_lock:
+            breaker = self._breaker(name)
+            available = breaker.available(now)
+            if available:
+                breaker.dispatch(now)
+            self._update_health(name, breaker, now)
+            return available
+
+    def record_success(self, name, elapsed, predicted = None):
+        """
+        Records that a task was performed by the given peer.
+        @type elapsed: float
+        @param elapsed: The number of seconds it took.
+        @type predicted: float
+        @param predicted: The predicted number of seconds (if known).
+        """
+        now = time()
+        with self._health_lock:
+            breaker = self._breaker(name)
+            breaker.success(now, elapsed, predicted)
+            self._update_health(name, breaker, now)
+
+    def record_failure(self, name, timeout = False):
+        """Records that a task could not be performed by the given peer, either
+        because it could not be reached or because it missed its deadline."""
+        now = time()
+        with self._health_lock:
+            breaker = self._breaker(name)
+            breaker.failure(now, timeout)
+            self._update_health(name, breaker, now)
 
 class ContextMonitor(object):
-    def __init__(self, presence = None):
+    def __init__(self, presence = None, timeout = Context.TIMEOUT, cleanup_at = Context.CLEANUP_AT,
+                 health = None, publish_interval = Context.PUBLISH_INTERVAL):
         super(ContextMonitor, self).__init__()
 
         # Create the local context.
-        self._context = Context()
+        self._context = Context(timeout, cleanup_at, health, publish_interval)
         
         # Subscribe to Presence announcements.
         if presence == None:
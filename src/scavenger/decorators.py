@@ -1,7 +1,12 @@
 from task import AdaptiveProfTaskInvokation
 from scavenger import Scavenger
-from inspect import getsource, getmodule
-from functools import partial
+from resultcache import ResultCache
+from schedule.futures import Future
+from config import Config
+from streaming import stream_source
+from inspect import getsource, getmodule, getargspec, isgeneratorfunction
+from functools import update_wrapper
+from copy import copy
 import re
 import hashlib
 
@@ -17,12 +22,18 @@ def decorator_with_args(decorator):
 
 # This decorator is used when invoking the Adaptive Profiling Scheduler.
 @decorator_with_args
-def scavenge(fn, output_size, complexity_relation = None, store = False):
+def scavenge(fn, output_size, complexity_relation = None, store = False, hedge = None, cache = None,
+             coalesce = False):
     # Modify the source to remove the decorator and rename the method
-    # to 'perform'.
+    # to 'perform'. Generator functions are renamed to '_generate' and
+    # wrapped in a 'perform' function streaming their results.
     source = getsource(fn)
     source = source[source.find('def'):]
-    source = re.sub(r'def\s+([a-zA-Z_][a-zA-Z_0-9]*)', r'def perform', source, 1)
+    generator = isgeneratorfunction(fn)
+    if generator:
+        source = stream_source(re.sub(r'def\s+([a-zA-Z_][a-zA-Z_0-9]*)', r'def _generate', source, 1))
+    else:
+        source = re.sub(r'def\s+([a-zA-Z_][a-zA-Z_0-9]*)', r'def perform', source, 1)
 
     # Find a suitable name for the task.
     module_name = re.sub(r'[\._]', r'', getmodule(fn).__name__)
@@ -32,9 +43,123 @@ def scavenge(fn, output_size, complexity_relation = None, store = False):
     # Build a service invokation object.
     service_invokation = AdaptiveProfTaskInvokation(name = task_name, 
                                                     code = source, 
-                                                    store = store,
+                                                    store = store and not generator,
                                                     output_size = output_size,
-                                                    complexity_relation = complexity_relation)
+                                                    complexity_relation = complexity_relation,
+                                                    argnames = getargspec(fn)[0],
+                                                    hedge = hedge,
+                                                    coalesce = coalesce)
 
-    return partial(Scavenger.scavenge_partial, service_invokation, fn)
+    if generator:
+        return ScavengedGenerator(fn, service_invokation)
+    return ScavengedFunction(fn, service_invokation, _make_cache(cache))
 
+def _make_cache(cache):
+    """Creates the result cache given to the decorator. This may be True for
+    a cache using the configured defaults, a dict of ResultCache parameters,
+    or a ResultCache (which may then be shared by several functions)."""
+    if cache == None or cache is False:
+        return None
+    if isinstance(cache, ResultCache):
+        return cache
+    config = Config.get_instance()
+    ttl = config.getfloat('cache', 'ttl')
+    parameters = {'max_entries' : config.getint('cache', 'max_entries'),
+                  'max_bytes' : config.getint('cache', 'max_bytes'),
+                  'ttl' : ttl > 0 and ttl or None,
+                  'disk' : config.getboolean('cache', 'disk')}
+    if type(cache) == dict:
+        parameters.update(cache)
+    return ResultCache(**parameters)
+
+class ScavengedFunction(object):
+    """The callable returned by the scavenge decorator. Calling it performs
+    the task synchronously, while submit() returns a Future. If the function
+    is pure its results may be cached - this is done by giving the decorator
+    a cache, and the cache is then available as the cache attribute."""
+    def __init__(self, fn, invocation, cache = None):
+        super(ScavengedFunction, self).__init__()
+        self._fn = fn
+        self._invocation = invocation
+        # Results of tasks that store their output are data handles that may 
+        # expire, so these are never cached.
+        self.cache = None
+        if not invocation.store:
+            self.cache = cache
+        update_wrapper(self, fn)
+
+    def _lookup(self, args):
+        """Returns the cache key of the arguments and the cached result if any."""
+        if self.cache == None:
+            return None, False, None
+        key = self.cache.key(self._invocation.name, args)
+        if key == None:
+            return None, False, None
+        found, result = self.cache.get(key)
+        return key, found, result
+
+    def invoke(self, args, store = None):
+        """
+        Performs the task on the given arguments, bypassing the result cache.
+        @type args: tuple
+        @param args: The positional arguments.
+        @type store: bool
+        @param store: Whether the result should be kept at the surrogate 
+        (None means as given in the decorator).
+        """
+        invocation = self._invocation
+        if store != None and store != invocation.store:
+            invocation = copy(invocation)
+            invocation.store = store
+        return Scavenger.scavenge_partial(invocation, self._fn, *args)
+
+    def __call__(self, *args, **kwargs):
+        key, found, result = self._lookup(args)
+        if found:
+            return result
+        result = Scavenger.scavenge_partial(self._invocation, self._fn, *args, **kwargs)
+        if key != None:
+            self.cache.put(key, result)
+        return result
+
+    def submit(self, *args, **kwargs):
+        key, found, result = self._lookup(args)
+        if found:
+            future = Future()
+            future.set_result(result)
+            return future
+        future = Scavenger.scavenge_partial_async(self._invocation, self._fn, *args, **kwargs)
+        if key != None:
+            def store(future):
+                if future.exception() == None:
+                    self.cache.put(key, future.result())
+            future.add_done_callback(store)
+        return future
+
+    def map(self, *iterables, **kwargs):
+        """
+        Performs the task on each set of arguments taken from the given 
+        iterables, like the builtin map. The keyword arguments chunksize and
+        ordered are passed on to Scavenger.scavenge_map. The result cache 
+        is not used for batches.
+        @rtype: generator
+        @return: A generator yielding the results.
+        """
+        return Scavenger.scavenge_map(self._invocation, zip(*iterables), self._fn,
+                                      kwargs.get('chunksize'), kwargs.get('ordered', True))
+
+
+class ScavengedGenerator(object):
+    """The callable returned by the scavenge decorator for generator 
+    functions. Calling it returns a generator yielding the results, which
+    are streamed back from the surrogate as they are produced. If the task
+    is performed locally the function itself is used as the generator. 
+    Results of generator tasks are neither stored, hedged nor cached."""
+    def __init__(self, fn, invocation):
+        super(ScavengedGenerator, self).__init__()
+        self._fn = fn
+        self._invocation = invocation
+        update_wrapper(self, fn)
+
+    def __call__(self, *args):
+        return Scavenger.scavenge_stream(self._invocation, self._fn, *args)
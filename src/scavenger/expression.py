@@ -0,0 +1,154 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compiled input expressions. These are the expressions given in the
+decorator that relate the input of a task to its complexity or to the
+size of its output, e.g., '#0 * len(#1)'.
+
+The expression language is restricted to arithmetic on numbers, a few
+builtin functions, subscripts and attribute lookups. #0, #1, ... refer to
+the positional arguments of the task and #name refers to the argument
+called name. Expressions are validated and compiled once and the compiled
+form is shared by all invocations."""
+
+import ast
+import math
+import re
+
+class ExpressionError(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+# The functions that may be called from an expression.
+FUNCTIONS = {
+    'abs'   : abs,
+    'float' : float,
+    'int'   : int,
+    'len'   : len,
+    'max'   : max,
+    'min'   : min,
+    'pow'   : pow,
+    'ceil'  : math.ceil,
+    'floor' : math.floor,
+    'log'   : math.log,
+    'log2'  : lambda x: math.log(x, 2),
+    'sqrt'  : math.sqrt,
+    }
+
+# The syntax tree nodes that may appear in an expression.
+ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Num, ast.Str,
+                 ast.Call, ast.Name, ast.Load, ast.Attribute, ast.Subscript,
+                 ast.Index, ast.operator, ast.unaryop)
+
+class InputExpression(object):
+    def __init__(self, expression, argnames = None):
+        """
+        Constructor.
+        @type expression: str
+        @param expression: The expression.
+        @type argnames: list
+        @param argnames: The names of the arguments of the task (if known).
+        This is needed for mixing positional references with keyword input
+        and vice versa.
+        @raise ExpressionError: If the expression is invalid.
+        """
+        super(InputExpression, self).__init__()
+        self._expression = expression
+        self._argnames = list(argnames or [])
+        self._positions = dict([(name, i) for i, name in enumerate(self._argnames)])
+
+        source = re.sub(r'#(\d+)', r'_arg(\1)', expression)
+        source = re.sub(r'#([a-zA-Z_][a-zA-Z_0-9]*)', r"_arg('\1')", source)
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError, e:
+            raise ExpressionError('Invalid expression: %s'%expression, e)
+        self._validate(tree)
+        self._code = compile(tree, '<expression>', 'eval')
+
+        # Expressions not referring to the input are evaluated right away.
+        self._constant = None
+        if not '_arg' in source:
+            self._constant = self._evaluate(None)
+
+    def _validate(self, tree):
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED_NODES):
+                raise ExpressionError('%s is not allowed in expressions: %s'%
+                                      (type(node).__name__, self._expression))
+            if isinstance(node, ast.Name) and not (node.id == '_arg' or FUNCTIONS.has_key(node.id)):
+                raise ExpressionError('Unknown name %s in expression: %s'%(node.id, self._expression))
+            if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+                raise ExpressionError('Private attributes are not allowed in expressions: %s'%self._expression)
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.keywords or node.starargs or node.kwargs:
+                    raise ExpressionError('Only simple function calls are allowed in expressions: %s'%self._expression)
+
+    def _lookup(self, task_input, key):
+        """Finds the argument referred to by key (a position or a name) in the input."""
+        if type(task_input) == dict:
+            if type(key) == int:
+                if key >= len(self._argnames):
+                    raise ExpressionError('Argument #%i can not be found in keyword input.'%key)
+                key = self._argnames[key]
+            return task_input[key]
+        if type(key) != int:
+            if not self._positions.has_key(key):
+                raise ExpressionError('Unknown argument #%s.'%key)
+            key = self._positions[key]
+        if type(task_input) in (tuple, list):
+            return task_input[key]
+        if key != 0:
+            raise ExpressionError('Argument #%i can not be found in single-argument input.'%key)
+        return task_input
+
+    def _evaluate(self, task_input):
+        namespace = dict(FUNCTIONS)
+        namespace['__builtins__'] = {}
+        namespace['_arg'] = lambda key: self._lookup(task_input, key)
+        try:
+            return eval(self._code, namespace)
+        except ExpressionError:
+            raise
+        except Exception, e:
+            raise ExpressionError('Error evaluating expression: %s'%self._expression, e)
+
+    def __call__(self, task_input):
+        """Evaluates the expression for the given task input."""
+        if self._constant != None:
+            return self._constant
+        return self._evaluate(task_input)
+
+    def __deepcopy__(self, memo):
+        # Compiled expressions are immutable.
+        return self
+
+    def __str__(self):
+        return self._expression
+
+_cache = {}
+
+def compile_expression(expression, argnames = None):
+    """
+    Returns the compiled form of the given expression. Compiled expressions
+    are cached so each expression is only compiled once.
+    @rtype: InputExpression
+    """
+    key = (expression, tuple(argnames or []))
+    compiled = _cache.get(key)
+    if compiled == None:
+        compiled = InputExpression(expression, argnames)
+        _cache[key] = compiled
+    return compiled
@@ -0,0 +1,120 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A pool of worker processes for performing tasks locally, so CPU-bound
+tasks performed locally are not serialized on the interpreter lock. The
+local function is sent to the workers by reference if possible - otherwise
+the workers perform the task code, like the surrogates do. Tasks that can
+be performed neither way are performed in the calling thread."""
+
+from __future__ import with_statement
+from cPickle import dumps, PicklingError
+from thread import allocate_lock
+from taskregistry import code_hash
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+# The task code installed in this (worker) process, by task name and code
+# hash, so changed code is installed anew.
+_installed = {}
+
+def _call(function, task_input):
+    if type(task_input) == dict:
+        return function(**task_input)
+    elif type(task_input) in (tuple, list):
+        return function(*task_input)
+    else:
+        return function(task_input)
+
+def _perform_function(function, task_input):
+    return _call(function, task_input)
+
+def _perform_code(task_name, task_code, task_input):
+    key = (task_name, code_hash(task_code))
+    perform = _installed.get(key)
+    if perform == None:
+        namespace = {}
+        exec task_code in namespace
+        perform = _installed[key] = namespace['perform']
+    return _call(perform, task_input)
+
+def _by_reference(function):
+    """Returns True if the function can be sent to the workers by reference.
+    Functions of the main module are not, as the workers only know those
+    that were defined before they were started - and a worker failing to
+    unpickle its task is never replaced."""
+    if getattr(function, '__module__', None) == '__main__':
+        return False
+    try:
+        dumps(function, 2)
+        return True
+    except (PicklingError, TypeError, AttributeError):
+        return False
+
+def available():
+    """Returns True if local tasks can be performed by worker processes."""
+    return multiprocessing != None
+
+class LocalPool(object):
+    def __init__(self, processes):
+        """
+        Constructor. The worker processes are started right away: forking a
+        process with other threads running may leave locks held by those
+        threads locked for good in the workers, so the pool must be created
+        before any threads are started.
+        @type processes: int
+        @param processes: The number of worker processes.
+        """
+        super(LocalPool, self).__init__()
+        self._pool = multiprocessing.Pool(processes)
+        self._lock = allocate_lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool == None:
+                raise IOError('The local pool has been closed.')
+            return self._pool
+
+    def can_perform(self, task, local_code):
+        """Returns True if the task can be performed by a worker process,
+        i.e., if the pool is open and the local function can be sent to the
+        workers or task code is given."""
+        if self._pool == None:
+            return False
+        return task.code != None or _by_reference(local_code)
+
+    def perform(self, task, local_code, task_input):
+        """
+        Performs a task in a worker process, blocking until it is done.
+        @type task: TaskInvokation
+        @param task: The task.
+        @type local_code: function
+        @param local_code: The local function. This is used if it can be
+        sent by reference, otherwise the task code is performed.
+        @type task_input: object
+        @param task_input: The input (with all data handles resolved).
+        """
+        if _by_reference(local_code):
+            return self._get_pool().apply(_perform_function, (local_code, task_input))
+        return self._get_pool().apply(_perform_code, (task.name, task.code, task_input))
+
+    def close(self):
+        with self._lock:
+            if self._pool != None:
+                self._pool.terminate()
+                self._pool = None
@@ -0,0 +1,68 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pipelines of scavenged functions. The intermediate results of a pipeline
+are stored at the surrogates and passed on to the next step as data
+handles, so they move directly between surrogates - or not at all when the
+next step is scheduled at the surrogate holding its input. The input is 
+thus uploaded once and only the final result is downloaded."""
+
+from scavenger import Scavenger
+from datastore import RemoteDataHandle
+
+class Pipeline(object):
+    def __init__(self, *steps):
+        """
+        Constructor.
+        @type steps: ScavengedFunction
+        @param steps: The functions of the pipeline. The first function is 
+        called with the arguments given to the pipeline, and each of the
+        following functions is called with the result of the previous one
+        as its only argument.
+        """
+        super(Pipeline, self).__init__()
+        if len(steps) == 0:
+            raise ValueError('A pipeline must have at least one step.')
+        self._steps = steps
+
+    def __call__(self, *args):
+        handle = None
+        for step in self._steps[:-1]:
+            result = step.invoke(args, store = True)
+            self._expire(handle)
+            handle = result
+            args = (result,)
+        result = self._steps[-1].invoke(args, store = False)
+        self._expire(handle)
+        return result
+
+    def _expire(self, handle):
+        """Frees an intermediate result held by a surrogate. This is only an
+        optimization, so failures are ignored - the data expires by itself."""
+        if type(handle) != RemoteDataHandle:
+            # The step was performed locally.
+            return
+        try:
+            Scavenger.expire_data(handle)
+        except Exception:
+            pass
+
+    def submit(self, *args):
+        """Asynchronous version of calling the pipeline.
+        @rtype: Future"""
+        return Scavenger.INSTANCE._dispatcher.submit(self, *args)
+
+    def __len__(self):
+        return len(self._steps)
@@ -0,0 +1,243 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of task results for pure tasks, i.e., tasks whose result only
+depends on their input. Results are kept in an in-process LRU cache bounded
+by the number of entries and their total size, and optionally in an on-disk
+tier that survives restarts of the client."""
+
+from __future__ import with_statement
+from cPickle import dumps, loads, PicklingError
+from thread import allocate_lock
+from time import time
+import hashlib
+import os
+
+def _canonical(obj):
+    """Converts the object into a form that pickles the same way for equal
+    objects, i.e., dicts and sets are sorted."""
+    kind = type(obj)
+    if kind == dict:
+        return ('dict', tuple(sorted([(_canonical(key), _canonical(value))
+                                      for key, value in obj.items()])))
+    if kind in (set, frozenset):
+        return ('set', tuple(sorted([_canonical(item) for item in obj])))
+    if kind == list:
+        return ('list', tuple([_canonical(item) for item in obj]))
+    if kind == tuple:
+        return tuple([_canonical(item) for item in obj])
+    return obj
+
+def fingerprint(task_input):
+    """
+    Finds a stable fingerprint of a task input. Equal inputs give equal
+    fingerprints, also across runs of the client.
+    @rtype: str
+    @return: The fingerprint, or None if the input can not be fingerprinted
+    (i.e., if it can not be pickled).
+    """
+    try:
+        return hashlib.md5(dumps(_canonical(task_input), 2)).hexdigest()
+    except (PicklingError, TypeError, AttributeError):
+        return None
+
+class _Entry(object):
+    """An entry of the LRU list."""
+    __slots__ = ('key', 'value', 'size', 'expires', 'prev', 'next')
+
+class ResultCache(object):
+    MAX_ENTRIES = 1024
+    MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_entries = MAX_ENTRIES, max_bytes = MAX_BYTES, ttl = None, disk = False):
+        """
+        Constructor.
+        @type max_entries: int
+        @param max_entries: The maximum number of results kept in memory.
+        @type max_bytes: int
+        @param max_bytes: The maximum total (pickled) size of the results kept
+        in memory. Larger results are not cached.
+        @type ttl: float
+        @param ttl: The number of seconds a result is valid (None for no limit).
+        @type disk: bool
+        @param disk: Whether results are also kept on disk, below
+        ~/.scavenger/cache.
+        """
+        super(ResultCache, self).__init__()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._directory = None
+        if disk:
+            self._directory = os.path.join(os.environ['HOME'], '.scavenger', 'cache')
+            if not os.path.isdir(self._directory):
+                os.makedirs(self._directory)
+        self._entries = {}
+        # The LRU list is circular with the most recently used entry first.
+        self._head = _Entry()
+        self._head.prev = self._head.next = self._head
+        self._bytes = 0
+        self._lock = allocate_lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, task_name, task_input):
+        """Returns the cache key of the given invocation (None if the input
+        can not be fingerprinted, in which case it must not be cached)."""
+        digest = fingerprint(task_input)
+        if digest == None:
+            return None
+        return (task_name, digest)
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _link(self, entry):
+        entry.next = self._head.next
+        entry.prev = self._head
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+        self._bytes -= entry.size
+
+    def _filename(self, key):
+        return os.path.join(self._directory, hashlib.md5('%s:%s'%key).hexdigest())
+
+    def get(self, key):
+        """
+        Looks up a result.
+        @rtype: ( bool, object ) - tuple
+        @return: Whether the result was found, and the result.
+        """
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None:
+                if entry.expires == None or entry.expires > now:
+                    # Move the entry to the front of the LRU list.
+                    self._unlink(entry)
+                    self._link(entry)
+                    self.hits += 1
+                    return True, loads(entry.value)
+                self._remove(entry)
+        found, result = self._get_disk(key, now)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, result
+
+    def _get_disk(self, key, now):
+        if self._directory == None:
+            return False, None
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as infile:
+                data = infile.read()
+        except IOError:
+            return False, None
+        try:
+            stored_key, expires, value = loads(data)
+            if stored_key != key:
+                return False, None
+            if expires != None and expires <= now:
+                self._discard_file(filename)
+                return False, None
+            result = loads(value)
+        except Exception:
+            # Anything that can not be loaded - a truncated or corrupt file, or
+            # a result whose class no longer exists - is a miss, and the file
+            # is removed so it is not tried again.
+            self._discard_file(filename)
+            return False, None
+        # Bring the result back into memory.
+        self._put_memory(key, value, expires)
+        return True, result
+
+    def put(self, key, result):
+        """Caches the result of the invocation with the given key."""
+        try:
+            value = dumps(result, -1)
+        except (PicklingError, TypeError):
+            return
+        expires = None
+        if self._ttl != None:
+            expires = time() + self._ttl
+        self._put_memory(key, value, expires)
+        if self._directory != None:
+            filename = self._filename(key)
+            try:
+                with open(filename + '.tmp', 'wb') as outfile:
+                    outfile.write(dumps((key, expires, value), -1))
+                os.rename(filename + '.tmp', filename)
+            except (IOError, OSError):
+                # The disk tier is only a cache - never fail because of it.
+                pass
+
+    def _put_memory(self, key, value, expires):
+        if len(value) > self._max_bytes:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None:
+                self._remove(entry)
+            entry = _Entry()
+            entry.key = key
+            entry.value = value
+            entry.size = len(value)
+            entry.expires = expires
+            self._link(entry)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            # Evict the least recently used entries.
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                self._remove(self._head.prev)
+                self.evictions += 1
+
+    def _discard_file(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def clear(self):
+        """Removes all results from the cache (also from disk)."""
+        with self._lock:
+            self._entries.clear()
+            self._head.prev = self._head.next = self._head
+            self._bytes = 0
+        if self._directory != None:
+            for name in os.listdir(self._directory):
+                self._discard_file(os.path.join(self._directory, name))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Get the cache statistics.
+        @rtype: dict
+        @return: The number of hits, misses and evictions along with the number
+        of entries and bytes held in memory.
+        """
+        with self._lock:
+            return {'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions,
+                    'entries' : len(self._entries), 'bytes' : self._bytes}
@@ -16,16 +16,26 @@
 """The client side API needed to work with Scavenger hosts."""
 
 from __future__ import with_statement
-from context import ContextMonitor
-from scrpc import SCProxy
+from context import ContextMonitor, HealthPolicy
+from connectionpool import ConnectionPool
+from taskregistry import InstalledTaskRegistry
+from schedule.futures import DispatcherPool, SingleFlight, as_completed
+from chunked import ChunkedDataHandle, ChunkedUpload, ChunkedDownload, TransferInterrupted
+from streaming import stream
+import localpool
 from schedule import ScheduleError, AdaptiveProfScheduler
+from schedule.failover import FailoverPolicy, RETRYABLE_ERRORS
+from schedule.compression import CompressionModel
+from schedule.payload import estimate_size
 from config import Config
 from datastore import RemoteDataHandle
 from task import AdaptiveProfTaskInvokation
 from time import time
 from threading import Lock
-from copy import deepcopy
+from copy import copy, deepcopy
+from contextlib import contextmanager
 import os
+import sys
 
 def shutdown():
     Scavenger.shutdown()
@@ -79,15 +89,67 @@ class Scavenger(object):
         # Initialize the object.
         super(Scavenger, self).__init__()
 
+        # Load in the config.
+        self._config = Config.get_instance()
+
+        # Create the pool of processes used for local execution, if enabled.
+        # This must be done before any threads are started, as the worker
+        # processes are forked.
+        self._local_pool = None
+        if self._config.get('local', 'executor') == 'process' and localpool.available():
+            self._local_pool = localpool.LocalPool(max(1, self._config.getint('cpu', 'cores')))
+
         # Create a context monitor.
-        self._monitor = ContextMonitor()
+        health = HealthPolicy(self._config.getfloat('health', 'error_threshold'),
+                              self._config.getint('health', 'min_calls'),
+                              self._config.getfloat('health', 'open_time'),
+                              self._config.getfloat('health', 'max_open_time'),
+                              self._config.getint('health', 'probes'),
+                              self._config.getfloat('health', 'slow_ratio'))
+        self._monitor = ContextMonitor(timeout = self._config.getfloat('context', 'timeout'),
+                                       cleanup_at = self._config.getint('context', 'cleanup_at'),
+                                       health = health,
+                                       publish_interval = self._config.getfloat('context', 'publish_interval'))
 
         # Create the schedulers.
+        failover = FailoverPolicy(self._config.getfloat('failover', 'deadline_factor'),
+                                  self._config.getfloat('failover', 'deadline_slack'),
+                                  ScavengerDefines.TIMEOUT,
+                                  self._config.getint('failover', 'max_retries'),
+                                  self._config.getfloat('failover', 'retry_ratio'),
+                                  self._config.getint('failover', 'retry_reserve'))
+        codecs = [name.strip() for name in self._config.get('compression', 'codecs').split(',')]
+        compression = CompressionModel([name for name in codecs if name != ''],
+                                       self._config.getint('compression', 'min_size'))
         self._schedulers = {}
-        self._schedulers['aprofile'] = AdaptiveProfScheduler(self._monitor._context, Scavenger)
-
-        # Load in the config.
-        self._config = Config.get_instance()
+        self._schedulers['aprofile'] = AdaptiveProfScheduler(self._monitor._context, Scavenger,
+                                                             self._config.get('scheduler', 'engine'),
+                                                             self._config.getint('scheduler', 'vector_threshold'),
+                                                             self._config.getfloat('hedging', 'percentile'),
+                                                             self._config.getfloat('hedging', 'min_delay'),
+                                                             failover, compression)
+
+        # Create the connection pool. Idle connections to peers that leave
+        # the context are closed right away.
+        self._pool = ConnectionPool(self._config.getint('connections', 'max_idle_per_peer'),
+                                    self._config.getfloat('connections', 'max_idle_time'),
+                                    self._config.getint('connections', 'max_per_peer'),
+                                    self._config.getfloat('connections', 'acquire_timeout'))
+        self._monitor._context.add_removal_listener(lambda peer: self._pool.purge(peer.address))
+
+        # Create the registry of tasks known to be installed at the peers.
+        self._installed = InstalledTaskRegistry()
+        self._monitor._context.add_removal_listener(lambda peer: self._installed.forget_peer(peer.name))
+
+        # Create the pool of threads used for asynchronous scavenging.
+        self._dispatcher = DispatcherPool(self._config.getint('dispatcher', 'workers'))
+
+        # Create the registry of invocations in flight. Concurrent invocations
+        # of a task that allows coalescing share a single call if their input
+        # is equal.
+        self._flights = None
+        if self._config.getboolean('coalescing', 'enabled'):
+            self._flights = SingleFlight()
 
         # Set the local activity count.
         self._activity = LocalActivity()
@@ -105,7 +167,33 @@ class Scavenger(object):
         @rtype: list
         @return: A list of ScavengerPeer objects for the peers that are currently available.
         """
-        return self._monitor.get_peers()
+        return list(self._monitor.get_peers())
+
+    @classmethod
+    def local_cores(cls):
+        """Returns the number of local cores/CPUs available for performing tasks."""
+        return max(1, cls.INSTANCE._config.getint('cpu', 'cores'))
+
+    @classmethod
+    def connection(cls, peer):
+        return cls.INSTANCE._connection(peer)
+
+    @contextmanager
+    def _connection(self, peer, connection=None):
+        """
+        Context manager yielding a connection to the given peer. If a 
+        connection is given it is used as-is, otherwise one is taken from 
+        the connection pool and returned to it afterwards.
+        @type peer: ScavengerPeer
+        @param peer: The peer to connect to.
+        @type connection: SCProxy
+        @param connection: An initiated connection to a Scavenger peer.
+        """
+        if connection != None:
+            yield connection
+        else:
+            with self._pool.connection(peer.address) as proxy:
+                yield proxy
     
     @classmethod
     def perform_task(cls, peer, task_name, task_input, connection=None, 
@@ -140,12 +228,31 @@ class Scavenger(object):
             raise ScavengerException('No such peer is within range.')
         
         # Fire the RPC call.
-        proxy = connection if connection != None else SCProxy(peer.address)
         try:
-            return proxy.perform_task(task_name, task_input, timeout, store)
-        finally:
-            if connection == None:
-                proxy.close()
+            with self._connection(peer, connection) as proxy:
+                return proxy.perform_task(task_name, task_input, timeout, store)
+        except RETRYABLE_ERRORS:
+            # The surrogate may have been restarted without the task.
+            self._installed.discard(peer.name, task_name)
+            raise
+        except:
+            exc_info = sys.exc_info()
+            self._check_installed(peer, task_name, connection)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _check_installed(self, peer, task_name, connection=None):
+        """
+        Called when a task failed at a peer for other reasons than the 
+        connection failing. The task is forgotten as installed at the peer
+        if the peer no longer has it, or if that can not be checked.
+        """
+        try:
+            with self._connection(peer, connection) as proxy:
+                if proxy.has_task(task_name):
+                    return
+        except:
+            pass
+        self._installed.discard(peer.name, task_name)
     
 
     @classmethod
@@ -158,21 +265,35 @@ class Scavenger(object):
         # Check that the peer is still there.
         if not self._monitor.has_peer(peer.name):
             raise ScavengerException('No such peer is within range.')
+        if self._has_chunked_data(task.input):
+            raise ScavengerException('Chunked data can only be given to tasks performed locally.')
         
+        # Send the serialized input if the scheduler has already serialized it.
+        task_input = task.payload if task.payload != None else task.input
+        timeout = task.timeout if task.timeout != None else ScavengerDefines.TIMEOUT
+
         # Fire the RPC call.
-        proxy = connection if connection != None else SCProxy(peer.address)
         try:
-            if task.scheduler in ('aprofile'):
-                result, complexity = proxy.perform_task(task.name, task.input, ScavengerDefines.TIMEOUT, task.store, True)
-                if task.scheduler == 'aprofile':
-                    self._schedulers[task.scheduler].gprofile.register(task.name, complexity, task.complexity)
-                    self._schedulers[task.scheduler].lprofile.register((peer.name, task.name), complexity, task.complexity)
-                return result
-            else:
-                return proxy.perform_task(task.name, task.input, ScavengerDefines.TIMEOUT, task.store, False)
-        finally:
-            if connection == None:
-                proxy.close()
+            with self._connection(peer, connection) as proxy:
+                if task.scheduler in ('aprofile'):
+                    start = time()
+                    result, complexity = proxy.perform_task(task.name, task_input, timeout, task.store, True)
+                    self._measure_task(peer, task, result, complexity, start)
+                    # Only the winner of a hedged race is profiled, and streams are not.
+                    if task.scheduler == 'aprofile' and task.profiled and (task.race == None or task.race.claim(task)):
+                        self._schedulers[task.scheduler].gprofile.register(task.name, complexity, task.complexity)
+                        self._schedulers[task.scheduler].lprofile.register((peer.name, task.name), complexity, task.complexity)
+                    return result
+                else:
+                    return proxy.perform_task(task.name, task_input, timeout, task.store, False)
+        except RETRYABLE_ERRORS:
+            # The surrogate may have been restarted without the task.
+            self._installed.discard(peer.name, task.name)
+            raise
+        except:
+            exc_info = sys.exc_info()
+            self._check_installed(peer, task.name, connection)
+            raise exc_info[0], exc_info[1], exc_info[2]
 
 
     @classmethod
@@ -199,65 +320,122 @@ class Scavenger(object):
             raise ScavengerException('No such peer is within range.')
         
         # Fire the RPC call.
-        proxy = connection if connection != None else SCProxy(peer.address)
-        try:
+        with self._connection(peer, connection) as proxy:
+            start = time()
             proxy.install_task(task_name, task_code)
-        finally:
-            if connection == None:
-                proxy.close()
+            self._measure(peer.name, len(task_code), start)
+        self._installed.add(peer.name, task_name, task_code)
+
+    def _measure(self, peer_name, nbytes, start):
+        """Registers a transfer of nbytes bytes to or from the given peer
+        that was started at the given time with the link estimates used for
+        scheduling."""
+        self._schedulers['aprofile'].links.register(peer_name, nbytes, time() - start)
+
+    def _measure_task(self, peer, task, result, complexity, start):
+        """Registers the transfers of performing a task at the given peer with
+        the link estimates. The time spent performing the task is found from 
+        its complexity and the strength of the peer, taking into account the
+        other tasks sharing the cores of the peer, and the rest of the wall
+        time is the time it took to send the input and receive the output."""
+        if task.payload != None:
+            input_size = task.payload.size
+        else:
+            input_size = estimate_size(task.input)
+        output_size = estimate_size(result)
+        if input_size == None or output_size == None or peer.cpu_strength <= 0:
+            return
+        # The task itself is still counted as active at the peer.
+        others = max(0, self._monitor._context.get_active_tasks(peer) - 1)
+        activity_level = float(others) / max(1, peer.cpu_cores) + 1
+        elapsed = time() - start - activity_level * float(complexity) / peer.cpu_strength
+        if elapsed > 0:
+            self._schedulers['aprofile'].links.register(peer.name, input_size + output_size, elapsed)
 
     @classmethod
-    def has_task(cls, peer, task_name, connection=None):
-        return cls.INSTANCE._has_task(peer, task_name, connection)
+    def has_task(cls, peer, task_name, connection=None, task_code=None):
+        return cls.INSTANCE._has_task(peer, task_name, connection, task_code)
 
-    def _has_task(self, peer, task_name, connection=None):
+    def _has_task(self, peer, task_name, connection=None, task_code=None):
         """
-        Checks whether the given peer offers the named task.
+        Checks whether the given peer offers the named task. Tasks that 
+        have already been seen at the peer are answered from the local 
+        registry without contacting the peer.
         @type peer: ScavengerPeer
         @param peer: The peer that is to be checked.
         @type task_name: str
         @param task_name: The name of the task.
         @type connection: SCProxy
         @param connection: An initiated connection to a Scavenger peer.
+        @type task_code: str
+        @param task_code: The source code of the task (if known).
         @raise ScavengerException: If the peer can not be contacted, or if
         an error occurs at the remote peer.
         """
         # Check that the peer is still there.
         if not self._monitor.has_peer(peer.name):
             raise ScavengerException('No such peer is within range.')
+
+        # Check whether the task is already known to be installed.
+        if self._installed.has(peer.name, task_name, task_code):
+            return True
         
         # Fire the RPC call.
-        proxy = connection if connection != None else SCProxy(peer.address)
-        try:
-            return proxy.has_task(task_name)
-        finally:
-            if connection == None:
-                proxy.close()
+        with self._connection(peer, connection) as proxy:
+            start = time()
+            has_task = proxy.has_task(task_name)
+            self._measure(peer.name, 0, start)
+        if has_task:
+            self._installed.add(peer.name, task_name, task_code)
+        return has_task
     
     def _resolve_data_handles(self, task_input):
-        """Resolves any remote data handles in the input so that 
+        """Resolves any remote (or chunked) data handles in the input so that 
         local execution may be performed."""
         if type(task_input) == dict:
             for key, value in task_input.items():
-                if type(value) == RemoteDataHandle:
+                if type(value) == RemoteDataHandle or isinstance(value, ChunkedDataHandle):
                     task_input[key] = Scavenger.fetch_data(value)
         elif type(task_input) in (tuple, list):
             new_task_input = []
             for item in task_input:
-                if type(item) == RemoteDataHandle:
+                if type(item) == RemoteDataHandle or isinstance(item, ChunkedDataHandle):
                     new_task_input.append(Scavenger.fetch_data(item))
                 else:
                     new_task_input.append(item)
             task_input = new_task_input
         else:
-            if type(task_input) == RemoteDataHandle:
+            if type(task_input) == RemoteDataHandle or isinstance(task_input, ChunkedDataHandle):
                 task_input = Scavenger.fetch_data(task_input)
         return task_input
 
+    def _has_chunked_data(self, task_input):
+        """Checks whether the input holds chunked data handles. The surrogates
+        only resolve plain data handles, so such tasks are performed locally."""
+        if type(task_input) == dict:
+            task_input = task_input.values()
+        elif not type(task_input) in (tuple, list):
+            task_input = [task_input]
+        for item in task_input:
+            if isinstance(item, ChunkedDataHandle):
+                return True
+        return False
+
     @classmethod
     def scavenge(cls, task_name, task_input, task_code=None, local_code=None):
         task_invocation = AdaptiveProfTaskInvokation(task_name, task_input, task_code, output_size='0') 
         return cls.INSTANCE._scavenge(task_invocation, local_code)
+
+    @classmethod
+    def scavenge_async(cls, task_name, task_input, task_code=None, local_code=None):
+        """
+        Asynchronous version of scavenge. The task is performed by one of
+        the dispatcher threads.
+        @rtype: Future
+        @return: A future that will hold the result of the task.
+        """
+        task_invocation = AdaptiveProfTaskInvokation(task_name, task_input, task_code, output_size='0') 
+        return cls.INSTANCE._dispatcher.submit(cls.INSTANCE._scavenge, task_invocation, local_code)
     
     def _scavenge(self, task, local_code=None):
         """
@@ -276,6 +454,46 @@ class Scavenger(object):
         @return: The result of performing the task.
         @raise ScavengerException: For lots of reasons...
         """
+        # If the task is pure and an invocation with equal input is already
+        # in flight its result is shared. Results of tasks that store their
+        # output are data handles that are expired by their owner, so these
+        # are never shared.
+        if self._flights != None and task.coalesce and not task.store:
+            key = self._flight_key(task)
+            if key != None:
+                return self._flights.do(key, self._scavenge_task, task, local_code)
+        return self._scavenge_task(task, local_code)
+
+    def _flight_key(self, task):
+        """Finds the key of an invocation for coalescing. The input itself is
+        used, with the type of every value in it - also within nested tuples
+        and lists - so that, e.g., (1,) and (1.0,) are told apart. None is
+        returned if the input is not hashable."""
+        try:
+            key = (task.name, self._typed(task.input))
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _typed(self, value):
+        """Pairs the given value with its type, recursively for the items of
+        tuples and lists. Frozensets are refused, as their equal items of
+        different types can not be told apart."""
+        if type(value) in (tuple, list):
+            return (type(value), tuple([self._typed(item) for item in value]))
+        if isinstance(value, frozenset):
+            raise TypeError('Frozensets are not coalesced.')
+        return (type(value), value)
+
+    def _scavenge_task(self, task, local_code=None):
+        """Schedules and performs a single invocation. See _scavenge."""
+        if self._has_chunked_data(task.input):
+            if local_code == None:
+                raise ScavengerException('Chunked data can only be given to tasks performed locally.')
+            self._activity.increment()
+            return self._perform_local(task, local_code)
+
         # Schedule the task execution.
         try:
             # Ask the scheduler to schedule the task.
@@ -290,47 +508,144 @@ class Scavenger(object):
                 return self._schedulers[task.scheduler].schedule(task, 
                                                                  self._config.getfloat('cpu', 'strength'),
                                                                  self._config.getint('network', 'speed'),
-                                                                 self._activity)
+                                                                 self._activity,
+                                                                 local_code = local_code)
         except ScheduleError:
             # Remote execution was not possible. Do local execution if possible.
             if local_code != None:
-                print 'localhost', #DEBUG
-
-                # Resolve any remote data handles.
-                task.input = self._resolve_data_handles(task.input)
-
-                def perform_local_function(task_input):
-                    try:
-                        # Perform the local function.
-                        if type(task_input) == dict:
-                            return local_code(**task_input)
-                        elif type(task_input) in (tuple, list):
-                            return local_code(*task_input)
-                        else:
-                            return local_code(task_input)
-                    finally:
-                        self._activity.decrement()
-
-                
-                if task.scheduler in ('aprofile'):
-                    # We need to profile this task run.
-                    start = time()
-                    start_activity = self._activity.value
-                    result = perform_local_function(task.input)
-                    stop_activity = self._activity.value + 1
-                    stop = time()
-                    activity_level = float(start_activity + stop_activity) / 2
-                    complexity = ((stop-start) * self._config.getfloat('cpu', 'strength')) / activity_level
-                    if task.scheduler == 'aprofile':
-                        self._schedulers[task.scheduler].gprofile.register(task.name, complexity, task.complexity)
-                        self._schedulers[task.scheduler].lprofile.register(('localhost', task.name), complexity, task.complexity)
-                    return result
-                else:
-                    return perform_local_function(task.input)
-                    
+                return self._perform_local(task, local_code)
             else:
                 raise ScavengerException('No surrogates available.')
-         
+
+    @classmethod
+    def perform_local(cls, task, local_code):
+        return cls.INSTANCE._perform_local(task, local_code)
+
+    def _perform_local(self, task, local_code):
+        """
+        Performs the task locally using the given local code. The local 
+        activity count must have been incremented before calling this method.
+        @type task: AdaptiveProfileTaskInvokation
+        @param task: The task that must be invoked.
+        @type local_code: function
+        @param local_code: A local function that is capable of performing the task.
+        """
+        print 'localhost', #DEBUG
+
+        # Resolve any remote data handles.
+        task.input = self._resolve_data_handles(task.input)
+
+        def perform_local_function(task_input):
+            try:
+                # Perform the local function - in a worker process if possible.
+                if self._local_pool != None and self._local_pool.can_perform(task, local_code):
+                    return self._local_pool.perform(task, local_code, task_input)
+                if type(task_input) == dict:
+                    return local_code(**task_input)
+                elif type(task_input) in (tuple, list):
+                    return local_code(*task_input)
+                else:
+                    return local_code(task_input)
+            finally:
+                self._activity.decrement()
+
+        
+        if task.scheduler in ('aprofile'):
+            # We need to profile this task run.
+            start = time()
+            start_activity = self._activity.value
+            result = perform_local_function(task.input)
+            stop_activity = self._activity.value + 1
+            stop = time()
+            # The other tasks running locally share the cores with this one.
+            activity_level = (float(start_activity + stop_activity) / 2 - 1) / Scavenger.local_cores() + 1
+            complexity = ((stop-start) * self._config.getfloat('cpu', 'strength')) / activity_level
+            if task.scheduler == 'aprofile' and task.profiled and (task.race == None or task.race.claim(task)):
+                self._schedulers[task.scheduler].gprofile.register(task.name, complexity, task.complexity)
+                self._schedulers[task.scheduler].lprofile.register(('localhost', task.name), complexity, task.complexity)
+            return result
+        else:
+            return perform_local_function(task.input)
+
+    @classmethod
+    def scavenge_map(cls, task, inputs, local_code=None, chunksize=None, ordered=True):
+        return cls.INSTANCE._scavenge_map(task, inputs, local_code, chunksize, ordered)
+
+    def _scavenge_map(self, task, inputs, local_code=None, chunksize=None, ordered=True):
+        """
+        Performs a task on a whole batch of inputs. The scheduler makes a 
+        single assignment plan for the batch, and the resulting chunks of 
+        inputs are then performed in parallel by the dispatcher threads.
+        @type task: AdaptiveProfileTaskInvokation
+        @param task: The task that must be invoked. The input of the task
+        object is ignored.
+        @type inputs: iterable
+        @param inputs: The inputs, one for each invocation.
+        @type local_code: function
+        @param local_code: A local function that is capable of performing the task.
+        @type chunksize: int
+        @param chunksize: The number of inputs that are sent to the same peer 
+        in one go. If None the scheduler picks a chunk size.
+        @type ordered: bool
+        @param ordered: If True the results are yielded in input order, 
+        otherwise they are yielded as they become available.
+        @rtype: generator
+        @return: A generator yielding the results.
+        """
+        inputs = list(inputs)
+        plan = self._schedulers[task.scheduler].plan(task, inputs, chunksize,
+                                                     self._config.getfloat('cpu', 'strength'),
+                                                     self._config.getint('network', 'speed'),
+                                                     self._activity,
+                                                     local_code == None)
+        if self._dispatcher.in_worker():
+            # Waiting on the dispatcher from one of its own threads may 
+            # deadlock, so the chunks are performed in this thread.
+            return self._inline_results(task, local_code, plan, inputs)
+        futures = [self._dispatcher.submit(self._perform_chunk, task, local_code, peer, inputs[start:stop])
+                   for peer, start, stop in plan]
+        return self._chunk_results(futures, ordered)
+
+    def _inline_results(self, task, local_code, plan, inputs):
+        for peer, start, stop in plan:
+            for result in self._perform_chunk(task, local_code, peer, inputs[start:stop]):
+                yield result
+
+    def _chunk_results(self, futures, ordered):
+        if ordered:
+            for future in futures:
+                for result in future.result():
+                    yield result
+        else:
+            for future in as_completed(futures):
+                for result in future.result():
+                    yield result
+
+    def _perform_chunk(self, task, local_code, peer, inputs):
+        """Performs a chunk of invocations at the peer chosen when planning 
+        (None means local execution). Invocations that cannot be performed 
+        there are rescheduled one by one through the regular path."""
+        scheduler = self._schedulers[task.scheduler]
+        results = []
+        for task_input in inputs:
+            invocation = copy(task)
+            invocation.input = task_input
+            if peer is None and local_code != None:
+                scheduler.prepare(invocation)
+                self._activity.increment()
+                results.append(self._perform_local(invocation, local_code))
+                continue
+            if peer is not None and self._monitor.has_peer(peer.name) and not self._has_chunked_data(task_input):
+                scheduler.prepare(invocation)
+                try:
+                    results.append(scheduler.perform_remote(peer, invocation))
+                    continue
+                except RETRYABLE_ERRORS:
+                    # Give up on this peer for the rest of the chunk.
+                    peer = None
+            results.append(self._scavenge(invocation, local_code))
+        return results
+
     @classmethod
     def scavenge_partial(cls, task_invokation, local_function, *task_input, **kwargs):
         invocation = deepcopy(task_invokation)
@@ -339,6 +654,78 @@ class Scavenger(object):
             invocation.id = kwargs['id']
         return cls.INSTANCE._scavenge(invocation, local_function)
 
+    @classmethod
+    def scavenge_partial_async(cls, task_invokation, local_function, *task_input, **kwargs):
+        """Asynchronous version of scavenge_partial returning a Future."""
+        return cls.INSTANCE._dispatcher.submit(cls.scavenge_partial, task_invokation, 
+                                               local_function, *task_input, **kwargs)
+
+    @classmethod
+    def scavenge_stream(cls, task_invokation, local_function, *task_input):
+        """
+        Performs a generator task, returning a generator of its results. The
+        results of a remote invocation are streamed back in chunks.
+        @type task_invokation: AdaptiveProfTaskInvokation
+        @param task_invokation: The task, whose code must be stream code
+        (see streaming.stream_source).
+        @type local_function: function
+        @param local_function: A local generator function capable of 
+        performing the task.
+        @rtype: generator
+        """
+        invocation = deepcopy(task_invokation)
+        invocation.input = task_input
+        return cls.INSTANCE._scavenge_stream(invocation, local_function)
+
+    def _scavenge_stream(self, task, local_code=None):
+        # The whole stream is performed at the single peer that is expected 
+        # to perform the task the fastest.
+        scheduler = self._schedulers[task.scheduler]
+        if self._has_chunked_data(task.input):
+            if local_code == None:
+                raise ScavengerException('Chunked data can only be given to tasks performed locally.')
+            self._activity.increment()
+            return self._stream_local(task, local_code)
+        try:
+            peer = scheduler.select(task, 
+                                    self._config.getfloat('cpu', 'strength'), 
+                                    self._config.getint('network', 'speed'),
+                                    self._activity, local_code == None)
+        except ScheduleError:
+            if local_code == None:
+                raise ScavengerException('No surrogates available.')
+            return self._stream_local(task, local_code)
+        return self._stream_remote(scheduler, peer, task, local_code)
+
+    def _stream_remote(self, scheduler, peer, task, local_code):
+        """Streams the results of a generator task from the given peer, where
+        a task slot must have been reserved. If the stream can not be started
+        there it is performed locally instead, if possible."""
+        results = stream(scheduler, peer, task, self._config.getint('streaming', 'chunk_size'), True)
+        try:
+            first = results.next()
+        except StopIteration:
+            return
+        except (RETRYABLE_ERRORS + (ScavengerException,)):
+            # The surrogate could not be used - nothing has been yielded yet.
+            if local_code == None:
+                raise
+            self._activity.increment()
+            results = self._stream_local(task, local_code)
+        else:
+            yield first
+        for item in results:
+            yield item
+
+    def _stream_local(self, task, local_code):
+        """Performs a generator task locally. The local activity count must
+        have been incremented before calling this method."""
+        try:
+            for item in local_code(*self._resolve_data_handles(task.input)):
+                yield item
+        finally:
+            self._activity.decrement()
+
     @classmethod
     def shutdown(cls):
         cls.INSTANCE._shutdown()
@@ -346,9 +733,14 @@ class Scavenger(object):
     def _shutdown(self):
         """Make a clean break from Presence."""
         self._monitor.shutdown()
+        self._dispatcher.shutdown(False)
+        self._pool.close()
+        if self._local_pool != None:
+            self._local_pool.close()
         # Save the profiling data.
-        self._schedulers['aprofile'].lprofile.save()
-        self._schedulers['aprofile'].gprofile.save()
+        self._schedulers['aprofile'].lprofile.close()
+        self._schedulers['aprofile'].gprofile.close()
+        self._schedulers['aprofile'].links.close()
 #        self._schedulers['aprofile']._log.close()
 
     @classmethod
@@ -356,9 +748,54 @@ class Scavenger(object):
         """Recolves a peer name (presence id) to an ip,port tuple."""
         return cls.INSTANCE._monitor._context.resolve(peer_name)
 
+    @contextmanager
+    def _data_connection(self, rdh, connection=None):
+        """Yields a connection to the peer holding the given data handle. A 
+        pooled connection is used when the holder is known in the context,
+        otherwise the data handle is left to connect on its own."""
+        context = self._monitor._context
+        if connection != None or not context.has_peer(rdh.server_address):
+            yield connection
+        else:
+            with self._pool.connection(context.resolve(rdh.server_address)) as proxy:
+                yield proxy
+
     @classmethod
     def fetch_data(cls, rdh, connection=None):
-        return rdh.fetch(connection, cls.INSTANCE._monitor._context)
+        if isinstance(rdh, ChunkedDataHandle):
+            return cls.fetch_data_chunked(rdh)
+        with cls.INSTANCE._data_connection(rdh, connection) as proxy:
+            start = time()
+            data = rdh.fetch(proxy, cls.INSTANCE._monitor._context)
+            if proxy != None:
+                cls.INSTANCE._measure(rdh.server_address, rdh.size, start)
+            return data
+
+    @classmethod
+    def fetch_data_chunked(cls, rdh, sink=None):
+        """
+        Fetches chunked data, one chunk at a time.
+        @type rdh: ChunkedDataHandle
+        @param rdh: The data, or an interrupted download that should be resumed.
+        @type sink: file
+        @param sink: The file-like object the data is written to. If None the
+        data is returned.
+        @raise TransferInterrupted: If a chunk could not be fetched. The 
+        exception holds the download, which may be resumed.
+        """
+        if isinstance(rdh, ChunkedDownload):
+            download = rdh
+        else:
+            config = cls.INSTANCE._config
+            download = ChunkedDownload(rdh, sink, config.getint('transfer', 'window'), 
+                                       config.getint('transfer', 'retries'))
+        def fetch(handle):
+            try:
+                return cls.fetch_data(handle)
+            except ScavengerException, e:
+                # The holder has left - the download may be resumed later.
+                raise TransferInterrupted(download, 'Download interrupted after %i chunks: %s'%(download.position, e))
+        return download.run(fetch)
 
     @classmethod
     def store_data(cls, peer, data, connection=None):
@@ -367,20 +804,64 @@ class Scavenger(object):
             raise ScavengerException('No such peer is within range.')
         
         # Fire the RPC call.
-        proxy = connection if connection != None else SCProxy(peer.address)
-        try:
-            return proxy.store_data(data)
-        finally:
-            if connection == None:
-                proxy.close()
+        with cls.INSTANCE._connection(peer, connection) as proxy:
+            start = time()
+            rdh = proxy.store_data(data)
+            size = estimate_size(data)
+            if size != None:
+                cls.INSTANCE._measure(peer.name, size, start)
+            return rdh
+
+    @classmethod
+    def store_data_chunked(cls, peer, source, chunk_size=None):
+        """
+        Stores data at the given peer as a number of chunks. Only a few chunks
+        are held in memory at a time, so this is suitable for data larger than
+        the available memory.
+        @type peer: ScavengerPeer
+        @param peer: The peer.
+        @type source: object
+        @param source: The data: a string, an array, a memory-mapped file or 
+        a seekable file object - or an interrupted upload that should be 
+        resumed (possibly at another peer).
+        @type chunk_size: int
+        @param chunk_size: The size of the chunks in bytes.
+        @rtype: ChunkedDataHandle
+        @raise TransferInterrupted: If a chunk could not be stored. The 
+        exception holds the upload, which may be resumed.
+        """
+        if isinstance(source, ChunkedUpload):
+            upload = source
+        else:
+            config = cls.INSTANCE._config
+            upload = ChunkedUpload(source, chunk_size or config.getint('transfer', 'chunk_size'),
+                                   config.getint('transfer', 'window'), 
+                                   config.getint('transfer', 'retries'))
+        def store(chunk):
+            try:
+                return cls.store_data(peer, chunk)
+            except ScavengerException, e:
+                # The peer has left - the upload may be resumed at another peer.
+                raise TransferInterrupted(upload, 'Upload interrupted after %i bytes: %s'%(upload.size, e))
+        return upload.run(store)
 
     @classmethod
     def retain_data(cls, rdh, connection=None):
-        rdh.refresh(connection, cls.INSTANCE._monitor._context)
+        if isinstance(rdh, ChunkedDataHandle):
+            for handle in rdh.handles:
+                cls.retain_data(handle)
+            return
+        with cls.INSTANCE._data_connection(rdh, connection) as proxy:
+            rdh.refresh(proxy, cls.INSTANCE._monitor._context)
 
     @classmethod
     def expire_data(cls, rdh, connection=None):
-        rdh.expire(connection, cls.INSTANCE._monitor._context)
+        if isinstance(rdh, ChunkedDataHandle):
+            for handle in rdh.handles:
+                cls.expire_data(handle)
+            return
+        with cls.INSTANCE._data_connection(rdh, connection) as proxy:
+            rdh.expire(proxy, cls.INSTANCE._monitor._context)
 
 # Create the initial instance.
 Config(os.path.join(os.environ['HOME'], '.scavenger', 'config.ini'))
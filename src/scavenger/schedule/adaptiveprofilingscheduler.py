@@ -6,22 +6,89 @@ designate that running time varies with the size or value of one or more inputs.
 
 from __future__ import with_statement
 from scheduler import Scheduler, ScheduleError
-from scrpc import SCProxy
-from cPickle import dumps
 from datastore import RemoteDataHandle
-import re
-from profile_common import Profile
+from profile_common import Profile, normal_quantile
+from linkprofile import LinkProfile
+from payload import SerializedPayload, estimate_size, transfer_size
+from compression import CompressionModel, CompressedPayload
+import vectorcost
 from common import Candidate
-from threading import Lock
+from failover import FailoverPolicy, DeadlineExceeded, PeerUnavailable, RETRYABLE_ERRORS
+from futures import FutureTimeout, Race, spawn, as_completed
+from copy import copy
+from time import time
+import sys
+from heapq import heapify, heappop, heappush, heapreplace
+
+# The number of inputs used for estimating the cost of a batch of invocations.
+SAMPLE_SIZE = 8
+# The number of chunks each core is given when no chunk size is specified.
+CHUNKS_PER_CORE = 4
+# The number of times a scheduling decision is re-planned when the chosen
+# peer has been given other tasks in the meantime.
+MAX_REPLANS = 3
     
+class HedgeLost(Exception):
+    """Raised by a hedged run that finished after the winning run."""
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+def lower_bound(complexity, peer):
+    """Returns the time it takes the peer to perform a task of the given 
+    complexity when it is otherwise idle."""
+    if peer.cpu_strength <= 0:
+        return float('inf')
+    return complexity / peer.cpu_strength
+
 class AdaptiveProfScheduler(Scheduler):
-    def __init__(self, context, scavenger):
+    VECTOR_THRESHOLD = 64 # The number of peers from which the vectorized cost model is used.
+    HEDGE_PERCENTILE = 0.95 # The default percentile of the predicted time after which a task is hedged.
+    HEDGE_MIN_DELAY = 0.5 # The minimum number of seconds before a task is hedged.
+
+    def __init__(self, context, scavenger, engine = 'auto', vector_threshold = VECTOR_THRESHOLD,
+                 hedge_percentile = HEDGE_PERCENTILE, hedge_min_delay = HEDGE_MIN_DELAY,
+                 failover = None, compression = None):
+        """
+        Constructor.
+        @type context: Context
+        @param context: The context holding the known peers.
+        @type scavenger: class
+        @param scavenger: The Scavenger class.
+        @type engine: str
+        @param engine: The cost model used for evaluating candidates: 'python',
+        'numpy' or 'auto'. With 'auto' the vectorized NumPy cost model is used 
+        for peer sets of at least vector_threshold peers if NumPy is installed.
+        @type vector_threshold: int
+        @param vector_threshold: See engine.
+        @type hedge_percentile: float
+        @param hedge_percentile: The percentile used for hedged tasks that do 
+        not give their own.
+        @type hedge_min_delay: float
+        @param hedge_min_delay: The minimum number of seconds a hedged task is
+        given before it is started a second time.
+        @type failover: FailoverPolicy
+        @param failover: The deadlines and retry budget of remote invocations.
+        @type compression: CompressionModel
+        @param compression: The model used for deciding whether to compress 
+        task input.
+        """
         super(AdaptiveProfScheduler, self).__init__(context, scavenger)
         self._lprofile = Profile(filename='alprofile.dat')
         self._gprofile = Profile(filename='agprofile.dat')
+        self._links = LinkProfile(filename='alinks.dat')
+        self._vector = None
+        self._vector_threshold = vector_threshold
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_delay = hedge_min_delay
+        self._failover = failover or FailoverPolicy()
+        self._compression = compression or CompressionModel()
+        if engine != 'python' and vectorcost.available():
+            self._vector = vectorcost.VectorCostModel(context, self._lprofile, self._gprofile,
+                                                        self._compression, self._links)
+            if engine == 'numpy':
+                self._vector_threshold = 0
 #        self._log = open('/tmp/scavenger-aprofile.log', 'w')
 #        self._log_lock = Lock()
-        self._schedule_lock = Lock()
         
     def _get_datahandles(self, task_input):
         datahandles = []
@@ -50,101 +117,364 @@ class AdaptiveProfScheduler(Scheduler):
         return self._gprofile
     gprofile = property(_get_gprofile)
 
-    def schedule(self, task, local_cpu_strength, local_network_speed, local_activity, prefer_remote=False):
-        with self._schedule_lock:
-            # For profiling use we need to find the size/factor that relates input to task complexity.
-            if task.complexity_relation != None:
-                if not type(task.input) in (tuple, list):
-                    raise Exception('This only works on tasks with list-input for now...') 
-                expression = re.sub(r'#(\d+)', r'task.input[\1]', task.complexity_relation)
-                try:
-                    task.complexity = eval(expression)
-                except Exception, e:
-                    raise Exception('Error evaluating complexity expression.', e)
-
-            # If no peers are available raise an exception to signal that local
-            # execution should be performed.
-            peers = self._context.get_peers()
-            if len(peers) == 0:
-                local_activity.increment()
+    def _get_links(self):
+        return self._links
+    links = property(_get_links)
+
+    def _find_output_size(self, task, task_input):
+        """Finds the size of the output of performing the task on the given input."""
+        if task.store == True:
+            # If the output is not fetched we need not consider it here.
+            return 0
+        return task.find_output_size(task_input)
+
+    def _holder_net(self, datahandle, fallback):
+        """Returns the network speed of the peer holding the given data handle.
+        The fallback speed is used if the holder has left the context."""
+        holder = self._context.get_peer(datahandle.server_address)
+        if holder is None:
+            return fallback
+        return holder.net
+
+    def _handle_time(self, net, datahandles, holder = None):
+        """Estimates the time it takes to move the data of the given handles 
+        to a peer with the given network speed. Data already held by the peer
+        called holder need not be moved."""
+        time_to_transfer = 0
+        for datahandle in datahandles:
+            if datahandle.server_address != holder:
+                bandwidth = min(net, self._holder_net(datahandle, net))
+                time_to_transfer += (float(datahandle.size) / bandwidth)
+        return time_to_transfer
+
+    def _fetch_time(self, local_network_speed, datahandles):
+        """Estimates the time it takes to fetch the data of the given handles
+        to this client, using the measured links to their holders."""
+        time_to_transfer = 0
+        for datahandle in datahandles:
+            fallback = min(local_network_speed, self._holder_net(datahandle, local_network_speed))
+            bandwidth = self._links.get_bandwidth(datahandle.server_address, fallback)
+            time_to_transfer += (float(datahandle.size) / bandwidth)
+        return time_to_transfer
+
+    def _link(self, peer, local_network_speed):
+        """Returns the bandwidth and latency of the link to the given peer.
+        These are the measured ones if the link has been measured - otherwise
+        the bandwidth of the slowest network media and a default latency."""
+        return (self._links.get_bandwidth(peer.name, min(local_network_speed, peer.net)),
+                self._links.get_rtt(peer.name, vectorcost.LATENCY))
+
+    def _transfer_time(self, task_name, input_size, output_size, bandwidth, latency = vectorcost.LATENCY):
+        """Estimates the time it takes to send the input of a task and to 
+        receive its output over a link with the given bandwidth and latency.
+        The input is compressed if that is expected to be faster."""
+        time_to_transfer = self._compression.transfer_time(task_name, input_size, bandwidth)
+        return time_to_transfer + float(output_size) / bandwidth + latency
+
+    def _local_time(self, task_name, global_complexity, input_complexity, 
+                    local_cpu_strength, local_network_speed, local_activity, datahandles):
+        """Estimates the time it takes to perform a task locally. Like at the
+        remote peers, the running tasks are spread over the local cores."""
+        peer_strength = float(local_cpu_strength) / (local_activity / self._scavenger.local_cores() + 1)
+        task_complexity = self._lprofile.get_complexity(('localhost', task_name), global_complexity, input_complexity)
+        time_to_perform = task_complexity / peer_strength
+        time_to_transfer = self._fetch_time(local_network_speed, datahandles)
+        return time_to_perform + time_to_transfer
+
+    def _remote_time(self, peer, task_name, global_complexity, input_complexity, 
+                     input_size, output_size, local_network_speed, datahandles,
+                     activity = None):
+        """Estimates the time it takes to perform a task at the given peer. If
+        given, activity maps peer names to the number of tasks this client has
+        running at them - otherwise the current numbers are used."""
+        # Find out how long it would take for the peer to perform the task.
+        if activity != None:
+            active_tasks = max(peer.active_tasks, activity.get(peer.name, 0))
+        else:
+            active_tasks = self._context.get_active_tasks(peer)
+        peer_strength = float(peer.cpu_strength)/(active_tasks/peer.cpu_cores+1)
+        task_complexity = self._lprofile.get_complexity((peer.name, task_name), global_complexity, input_complexity)
+        time_to_perform = task_complexity / peer_strength
+
+        # Find out how long it would take to transfer the input to the peer.
+        bandwidth, latency = self._link(peer, local_network_speed)
+        time_to_transfer = self._transfer_time(task_name, input_size, output_size, bandwidth, latency)
+        time_to_transfer += self._handle_time(peer.net, datahandles, peer.name)
+
+        return time_to_perform + time_to_transfer
+
+    def perform_remote(self, surrogate, task, reserved = False, predicted = None):
+        """
+        Performs the given task at the given surrogate, installing the task
+        code first if necessary.
+        @type surrogate: ScavengerPeer
+        @param surrogate: The peer that should perform the task.
+        @type task: AdaptiveProfTaskInvokation
+        @param task: The task invocation.
+        @type reserved: bool
+        @param reserved: Whether a task slot has already been reserved at the
+        surrogate, and the dispatch claimed with its circuit breaker. The slot
+        is released when the task is done.
+        @type predicted: float
+        @param predicted: The predicted time of the task. This is used for 
+        tracking the health of the surrogate. If given, the timeout of the 
+        task is its deadline, and an error raised once the deadline has 
+        passed is taken to mean that the surrogate gave up on the task.
+        @raise DeadlineExceeded: If the task failed at its deadline.
+        @raise PeerUnavailable: If the circuit breaker of the surrogate does
+        not let the task through.
+        """
+        # Mark that the surrogate is now more busy :)
+        if not reserved:
+            if not self._context.try_dispatch(surrogate.name):
+                raise PeerUnavailable('%s is not accepting tasks right now.'%surrogate.name)
+            self._context.increment_peer_activity(surrogate.name)
+        start = time()
+        outcome = None
+        try:
+            # Borrow a connection from the connection pool.
+            with self._scavenger.connection(surrogate) as connection:
+                if not self._scavenger.has_task(surrogate, task.name, connection, task.code):
+                    self._scavenger.install_task(surrogate, task.name, task.code, connection)
+
                 # Log where the task will be performed.
 #                if task.id != None:
 #                    with self._log_lock:
-#                        self._log.write("%s -> %s\n"%('localhost', task.id))
-                raise ScheduleError('No usable surrogates found.') 
+#                        self._log.write("%s -> %s\n"%(surrogate.name, task.id))
 
-            # Find the input size. 
-            input_size = len(dumps(task.input, -1))
-            # If task code is given its size must be added to the total input size.
-            if task.code != None:
-                input_size += len(task.code)
+                # And perform the task.
+                result = self._scavenger.perform_scheduled_task(surrogate, task, connection)
+            outcome = 'success'
+            return result
+        except RETRYABLE_ERRORS:
+            outcome = 'failure'
+            raise
+        except:
+            if predicted != None and task.timeout != None and time() - start >= task.timeout:
+                outcome = 'timeout'
+                raise DeadlineExceeded('%s did not finish %s within %.1f seconds.'%
+                                       (surrogate.name, task.name, task.timeout))
+            raise
+        finally:
+            # Every dispatch must have its outcome recorded, or a probe of a
+            # half-open circuit breaker is never released. Errors raised by
+            # the task itself say nothing bad about the surrogate, but their
+            # running times are not comparable to the predicted ones.
+            if outcome == 'failure':
+                self._context.record_failure(surrogate.name)
+            elif outcome == 'timeout':
+                self._context.record_failure(surrogate.name, timeout = True)
+            elif outcome == 'success':
+                self._context.record_success(surrogate.name, time() - start, predicted)
+            else:
+                self._context.record_success(surrogate.name, time() - start)
+            # Decrement the activity count.
+            self._context.decrement_peer_activity(surrogate.name)
 
-            # Get a list of data handles in the input.
-            datahandles = self._get_datahandles(task.input)
+    def prepare(self, task):
+        """Finds the size/factor that relates the input of the task to its complexity."""
+        task.complexity = task.find_complexity(task.input)
 
-            # Find the size of the sevice output.
-            if task.store == True:
-                # If the output is not fetched we need not consider it here.
-                output_size = 0
+    def _best_candidates(self, task, table, count, input_size, output_size, datahandles, 
+                         local_cpu_strength, local_network_speed, local_activity, prefer_remote,
+                         activity = None):
+        """
+        Finds the count best candidates for performing the task, best first.
+        
+        Peers are visited in order of a cheap lower bound on their estimated 
+        time: the transfer time at the peer's network media (or over its 
+        measured link) plus the time to perform the task at full (unloaded) 
+        CPU strength. The search stops as soon as no remaining peer can beat
+        the count best candidates found so far. Peers with a per-peer profile
+        for the task may do better than the global profile, so these are 
+        always evaluated.
+        @type activity: dict
+        @param activity: The number of tasks this client has running at each
+        peer as seen when the search was started.
+        @rtype: list
+        @return: A list of Candidate objects.
+        """
+        if activity == None:
+            activity = self._context.get_local_activity()
+        # Peers with an open circuit breaker are not candidates.
+        unavailable = self._context.get_unavailable_peers()
+        global_complexity = self._gprofile.get_complexity(task.name, input_complexity = task.complexity)
+
+        # Keep the best candidates in a max-heap of ( -time, sequence, candidate ).
+        best = []
+        sequence = [0]
+        def consider(total_time, peer):
+            sequence[0] += 1
+            entry = (-total_time, sequence[0], Candidate(total_time, peer))
+            if len(best) < count:
+                heappush(best, entry)
+            elif total_time < -best[0][0]:
+                heapreplace(best, entry)
+        def threshold():
+            if len(best) < count:
+                return float('inf')
+            return -best[0][0]
+
+        # Start by adding the local peer.
+        if not prefer_remote:
+            consider(self._local_time(task.name, global_complexity, task.complexity, 
+                                      local_cpu_strength, local_network_speed, 
+                                      local_activity.value, datahandles), None)
+
+        # Large peer sets are evaluated in one go by the vectorized cost model.
+        if self._vector != None and len(table) >= self._vector_threshold:
+            for total_time, peer in self._vector.best(table, count + len(unavailable), task.name, 
+                                                      task.complexity, input_size, output_size, 
+                                                      local_network_speed, datahandles, activity):
+                if not peer.name in unavailable:
+                    consider(total_time, peer)
+            best.sort(reverse=True)
+            return [candidate for _, _, candidate in best]
+
+        # Then add the peers that already hold some of the input data, as 
+        # moving the task to the data is often far cheaper than moving the 
+        # data, and the peers that have been profiled for this task. The 
+        # lower bound below does not hold for these.
+        evaluated = self._lprofile.get_profiled(task.name)
+        evaluated.update([datahandle.server_address for datahandle in datahandles])
+        for name in evaluated:
+            if table.has(name) and not name in unavailable:
+                peer = table.get(name)
+                consider(self._remote_time(peer, task.name, global_complexity, task.complexity,
+                                           input_size, output_size, local_network_speed, datahandles,
+                                           activity), peer)
+
+        # Then visit the remaining peers in order of their lower bound. The
+        # transfer time of a peer whose link has been measured may differ from
+        # that of its network media, so such a peer gets a bound of its own.
+        frontier = []
+        measured = self._links.get_measured()
+        for name, (bandwidth, rtt) in measured.iteritems():
+            if table.has(name) and not (name in evaluated or name in unavailable):
+                peer = table.get(name)
+                if bandwidth == None:
+                    bandwidth = min(local_network_speed, peer.net)
+                if rtt == None:
+                    rtt = vectorcost.LATENCY
+                transfer = self._transfer_time(task.name, input_size, output_size, bandwidth, rtt)
+                transfer += self._handle_time(peer.net, datahandles)
+                frontier.append((transfer + lower_bound(global_complexity, peer), len(frontier), 0, 
+                                 transfer, [peer]))
+        own = len(frontier)
+        for net, peers in table.by_media():
+            transfer = self._transfer_time(task.name, input_size, output_size, min(local_network_speed, net))
+            transfer += self._handle_time(net, datahandles)
+            frontier.append((transfer + lower_bound(global_complexity, peers[0]), len(frontier), 0, 
+                             transfer, peers))
+        heapify(frontier)
+        while frontier and frontier[0][0] < threshold():
+            _, group, position, transfer, peers = frontier[0]
+            peer = peers[position]
+            if group >= own and measured.has_key(peer.name):
+                # The peer is visited by its own bound.
+                pass
+            elif not (peer.name in evaluated or peer.name in unavailable):
+                consider(self._remote_time(peer, task.name, global_complexity, task.complexity,
+                                           input_size, output_size, local_network_speed, datahandles,
+                                           activity), peer)
+            if position + 1 < len(peers):
+                bound = transfer + lower_bound(global_complexity, peers[position + 1])
+                heapreplace(frontier, (bound, group, position + 1, transfer, peers))
             else:
-                if type(task.output_size) in (int, float):
-                    # A constant is given - we simply adopt that number.
-                    output_size = task.output_size
-                else:
-                    # We now assume that task.output_size is a string containing a 
-                    # formula relating the output size to the input size.
-                    # Note: The DC scheduler only works on tasks with list-input for now...
-                    if not type(task.input) in (tuple, list):
-                        raise Exception('The scheduler only works on tasks with list-input for now...') 
-                    expression = re.sub(r'#(\d+)', r'task.input[\1]', task.output_size)
-                    try:
-                        output_size = eval(expression)
-                    except Exception, e:
-                        raise Exception('Error evaluating output complexity expression.', e)
-                
-            # Create the candidate list.
-            candidates = []
-
-            # Get the global complexity.
-            global_complexity = self._gprofile.get_complexity(task.name, input_complexity = task.complexity)
-
-            # Start by adding the local peer.
-            if not prefer_remote:
-                peer_strength = float(local_cpu_strength) / (local_activity.value + 1)
-                task_complexity = self._lprofile.get_complexity(('localhost', task.name), global_complexity, task.complexity)
-                time_to_perform = task_complexity / peer_strength
-
-                time_to_transfer = 0
-                for datahandle in datahandles:
-                    bandwidth = min(local_network_speed, self._context.get_peer(datahandle.server_address).net)
-                    time_to_transfer += (float(datahandle.size) / bandwidth)
-
-                total_time = time_to_perform + time_to_transfer
-                candidates.append(Candidate(total_time, None))
-
-            # Then add remote peers.
-            for peer in peers:
-                # Find out how long it would take for the peer to perform the task.
-                peer_strength = float(peer.cpu_strength)/(peer.active_tasks/peer.cpu_cores+1)
-                task_complexity = self._lprofile.get_complexity((peer.name, task.name), global_complexity, task.complexity)
-                time_to_perform = task_complexity / peer_strength
+                heappop(frontier)
 
-                # Find out how long it would take to transfer the input to the peer.
-                # 0.1 seconds of latency is added.
-                time_to_transfer = float(input_size + output_size) / min(local_network_speed, peer.net) + 0.1 
-                for datahandle in datahandles:
-                    if datahandle.server_address != peer.name:
-                        bandwidth = min(peer.net, self._context.get_peer(datahandle.server_address).net)
-                        time_to_transfer += (float(datahandle.size) / bandwidth)
+        best.sort(reverse=True)
+        return [candidate for _, _, candidate in best]
 
-                total_time = time_to_perform + time_to_transfer
-                candidates.append(Candidate(total_time, peer))
+    def schedule(self, task, local_cpu_strength, local_network_speed, local_activity, prefer_remote=False,
+                 local_code=None):
+        """
+        Schedules and performs the given task. The scheduling decision is made
+        without holding any lock: the best peer is found using a snapshot of 
+        the context, and a task slot is then reserved at that peer. If other 
+        tasks were started at the peer after the snapshot was taken the 
+        reservation fails and the decision is re-planned.
+        @type local_code: function
+        @param local_code: A local function capable of performing the task. 
+        This is used for hedging tasks locally.
+        @raise ScheduleError: If the task should be performed locally.
+        """
+        count = 1 + self._failover.max_retries
+        if task.hedge:
+            count = 2
+        candidates, input_size = self._choose(task, count, local_cpu_strength, local_network_speed, 
+                                              local_activity, prefer_remote)
+        self._learn(task, input_size)
+        # The codec is chosen for the link of each dispatch, as the task may
+        # be sent to other peers than the best one.
+        def compress(invocation, peer):
+            self._compress(invocation, input_size, self._link(peer, local_network_speed)[0])
+        if task.hedge:
+            backup = None
+            if len(candidates) > 1:
+                backup = candidates[1]
+            return self._perform_hedged(task, candidates[0], backup, local_activity, local_code, compress)
+        return self._perform_with_failover(task, candidates, local_activity, local_code, compress)
 
-            # Sort the peers by the time it would take for them to perform the task.
-            candidates.sort()
+    def select(self, task, local_cpu_strength, local_network_speed, local_activity, prefer_remote=False):
+        """
+        Finds the peer that is expected to perform the given task the fastest
+        and reserves a task slot there, without performing the task. This is
+        used for tasks that are performed in several calls (e.g., streams).
+        @rtype: ScavengerPeer
+        @return: The peer. The reserved slot is released by the first call to
+        perform_remote with reserved = True.
+        @raise ScheduleError: If the task should be performed locally.
+        """
+        candidates, _ = self._choose(task, 1, local_cpu_strength, local_network_speed, 
+                                     local_activity, prefer_remote)
+        return candidates[0].peer
 
-            # Perform the task.
-            surrogate = candidates[0].peer
+    def _choose(self, task, count, local_cpu_strength, local_network_speed, local_activity, prefer_remote):
+        """Finds the count best candidates for performing the task and reserves
+        a task slot at the best one, returning the candidates along with the
+        input size. If the task should be performed locally the local activity
+        is incremented and a ScheduleError is raised."""
+        # For profiling use we need to find the size/factor that relates input to task complexity.
+        self.prepare(task)
+
+        # If no peers are available raise an exception to signal that local
+        # execution should be performed.
+        table = self._context.snapshot()
+        if len(table) == 0:
+            local_activity.increment()
+            # Log where the task will be performed.
+#            if task.id != None:
+#                with self._log_lock:
+#                    self._log.write("%s -> %s\n"%('localhost', task.id))
+            raise ScheduleError('No usable surrogates found.') 
+
+        # Find the input size. If it can not be estimated cheaply the input 
+        # is serialized here, and the serialized form is then reused for 
+        # the transfer.
+        input_size = estimate_size(task.input)
+        if input_size == None:
+            task.payload = SerializedPayload(task.input)
+            input_size = task.payload.size
+        # If task code is given its size must be added to the total input size.
+        if task.code != None:
+            input_size += len(task.code)
+
+        # Get a list of data handles in the input.
+        datahandles = self._get_datahandles(task.input)
+
+        # Find the size of the sevice output.
+        output_size = self._find_output_size(task, task.input)
+            
+        for attempt in range(MAX_REPLANS + 1):
+            # Find the best candidate.
+            activity = self._context.get_local_activity()
+            candidates = self._best_candidates(task, table, count, input_size, output_size, datahandles, 
+                                               local_cpu_strength, local_network_speed, 
+                                               local_activity, prefer_remote, activity)
+            surrogate = None
+            if len(candidates) > 0:
+                surrogate = candidates[0].peer
 
             # Check whether this is local execution.
             if surrogate == None:
@@ -157,31 +487,274 @@ class AdaptiveProfScheduler(Scheduler):
 #                        self._log.write("%s -> %s\n"%('localhost', task.id))
                 raise ScheduleError('Do local execution.')
 
-            connection = SCProxy(surrogate.address)
+            # Reserve a slot at the surrogate. If this fails someone else has
+            # given it work since the decision was made, so try again using
+            # the new activity counts and health.
+            if self._claim(surrogate, activity):
+                break
+            if attempt == MAX_REPLANS:
+                if prefer_remote and self._context.try_dispatch(surrogate.name):
+                    # The task can only be performed remotely.
+                    self._context.increment_peer_activity(surrogate.name)
+                    break
+                # Rather than over-committing the surrogate the task is
+                # performed locally.
+                local_activity.increment()
+                raise ScheduleError('Do local execution.')
+            table = self._context.snapshot()
+        return candidates, input_size
+
+    def _claim(self, surrogate, activity):
+        """Reserves a task slot at the surrogate and claims the dispatch with
+        its circuit breaker, returning False if either fails."""
+        if not self._context.reserve_peer(surrogate.name, activity.get(surrogate.name, 0)):
+            return False
+        if self._context.try_dispatch(surrogate.name):
+            return True
+        # The probes of the surrogate were taken since the decision was made.
+        self._context.decrement_peer_activity(surrogate.name)
+        return False
+
+    def _learn(self, task, input_size):
+        """Learns how well the input of the task compresses. The first inputs
+        of every task (and then a few) are used for this."""
+        if self._compression.should_learn(task.name, input_size):
+            if task.payload == None:
+                task.payload = SerializedPayload(task.input)
+            self._compression.learn(task.name, task.payload.data)
+
+    def _compress(self, task, input_size, bandwidth):
+        """Compresses the input of the task if that is expected to make 
+        sending it over a link with the given bandwidth faster. The task must
+        be the copy made for a single dispatch, so the task it was copied 
+        from keeps the uncompressed input for dispatches over other links."""
+        codec, _ = self._compression.choose(task.name, input_size, bandwidth)
+        if codec != None:
+            if task.payload == None:
+                task.payload = SerializedPayload(task.input)
+            task.payload = CompressedPayload(task.payload, codec)
+
+    def _deadline(self, task, candidate):
+        """Finds the deadline for performing the task at the given candidate."""
+        _, confidence = self._lprofile.get_prediction((candidate.peer.name, task.name), 
+                                                      input_complexity = task.complexity)
+        if confidence == 0:
+            _, confidence = self._gprofile.get_prediction(task.name, input_complexity = task.complexity)
+        return self._failover.deadline(candidate.value, confidence)
+
+    def _perform_before_deadline(self, task, candidate, reserved, compress = None):
+        """Performs the task at the candidate, raising DeadlineExceeded if it
+        has not finished by its deadline. The deadline is sent along as the 
+        timeout of the task, so the surrogate gives up on the task and frees
+        its task slot and the connection instead of being waited for in the
+        background. If given, compress is called with the copy of the task 
+        that is sent and the peer, to compress its input."""
+        deadline, predicted = self._deadline(task, candidate)
+        invocation = copy(task)
+        invocation.timeout = deadline
+        if compress != None:
+            compress(invocation, candidate.peer)
+        if not predicted:
+            # Without a prediction the usual RPC timeout is all there is.
+            return self.perform_remote(candidate.peer, invocation, reserved)
+        return self.perform_remote(candidate.peer, invocation, reserved, candidate.value)
+
+    def _perform_with_failover(self, task, candidates, local_activity, local_code, compress = None):
+        """
+        Performs the task at the best candidate, where a task slot must have 
+        been reserved. If the surrogate can not be reached or misses the 
+        deadline the task is retried at the next candidates, as long as the
+        retry budget allows it. As a last resort a ScheduleError is raised to
+        have the task performed locally - unless there is no local code in 
+        which case the last error is raised. If given, compress is called
+        with each copy of the task sent to a peer and the peer.
+        """
+        self._failover.budget.deposit()
+        reserved = True
+        failure = None
+        for attempt, candidate in enumerate(candidates):
+            if candidate.peer is None:
+                # Local execution is the next best option.
+                break
+            if attempt > 0:
+                if not self._context.has_peer(candidate.peer.name):
+                    continue
+                if not self._failover.budget.withdraw():
+                    break
             try:
-                # Mark that the surrogate is now more busy :)
-                self._context.increment_peer_activity(surrogate.name)
-
-                # Release the scheduling lock here. Now others may schedule tasks while 
-                # this task is being performed.
-                self._schedule_lock.release()
-                try:
-                    if not self._scavenger.has_task(surrogate, task.name, connection):
-                        self._scavenger.install_task(surrogate, task.name, task.code, connection)
-
-                    # Log where the task will be performed.
-#                    if task.id != None:
-#                        with self._log_lock:
-#                            self._log.write("%s -> %s\n"%(surrogate.name, task.id))
-
-                    # And perform the task.
-                    result = self._scavenger.perform_scheduled_task(surrogate, task, connection)
-                finally:
-                    self._schedule_lock.acquire()
-
-                # Decrement the activity count.
-                self._context.decrement_peer_activity(surrogate.name)
-                return result
-            finally:
-                try: connection.close() 
-                except: pass
+                return self._perform_before_deadline(task, candidate, reserved, compress)
+            except RETRYABLE_ERRORS:
+                failure = sys.exc_info()
+                reserved = False
+
+        if local_code != None:
+            local_activity.increment()
+            raise ScheduleError('Remote execution failed.')
+        raise failure[0], failure[1], failure[2]
+
+    def _hedge_delay(self, task, candidate):
+        """
+        Finds the number of seconds after which a hedged task is started a
+        second time. This is the hedging percentile of the predicted running
+        time, taking the running time to be normally distributed with the
+        relative spread of the profile measurements.
+        """
+        percentile = task.hedge
+        if percentile is True:
+            percentile = self._hedge_percentile
+        spread = self._lprofile.get_spread((candidate.peer.name, task.name), task.complexity)
+        if spread == None:
+            spread = self._gprofile.get_spread(task.name, task.complexity) or 0.0
+        delay = candidate.value * (1.0 + normal_quantile(percentile) * spread)
+        return max(self._hedge_min_delay, delay)
+
+    def _perform_hedged(self, task, primary, backup, local_activity, local_code, compress = None):
+        """
+        Performs the task at the primary candidate. If it has not finished 
+        within the hedging delay the task is started at the backup candidate
+        as well (or locally if there is no remote backup), and the result of
+        the run that finishes first is returned. The other run is abandoned,
+        i.e., it is left to finish in the background and its result is thrown
+        away. Only the winning run is profiled.
+        @type primary: Candidate
+        @param primary: The best candidate. A task slot must have been 
+        reserved at this peer.
+        @type backup: Candidate
+        @param backup: The second best candidate (or None).
+        @type compress: function
+        @param compress: Called with each copy of the task sent to a peer and
+        the peer, to compress its input for the link to that peer.
+        """
+        race = Race()
+        def run(perform, invocation):
+            result = perform(invocation)
+            # Runs that are not profiled have not claimed the race yet.
+            if not race.claim(invocation):
+                raise HedgeLost()
+            return result
+
+        first = copy(task)
+        first.race = race
+        if compress != None:
+            compress(first, primary.peer)
+        runs = [spawn(run, lambda invocation: self.perform_remote(primary.peer, invocation, True), first)]
+        try:
+            return runs[0].result(self._hedge_delay(task, primary))
+        except FutureTimeout:
+            pass
+
+        # The task is running late - start it a second time.
+        second = copy(task)
+        second.race = race
+        if backup is not None and backup.peer is not None:
+            if compress != None:
+                compress(second, backup.peer)
+            runs.append(spawn(run, lambda invocation: self.perform_remote(backup.peer, invocation), second))
+        elif local_code != None:
+            local_activity.increment()
+            runs.append(spawn(run, lambda invocation: self._scavenger.perform_local(invocation, local_code), second))
+
+        # Return the first result. If every run fails the first failure is raised.
+        failed = None
+        for run_future in as_completed(runs):
+            exception = run_future.exception()
+            if exception == None:
+                return run_future.result()
+            if failed == None and not isinstance(exception, HedgeLost):
+                failed = run_future
+        return failed.result()
+
+    def plan(self, task, inputs, chunksize, local_cpu_strength, local_network_speed, 
+             local_activity, prefer_remote=False):
+        """
+        Makes one assignment plan for performing a task on a whole batch of 
+        inputs. The batch is cut into chunks of consecutive inputs and each 
+        chunk is assigned to the peer that is expected to finish it first, 
+        given the chunks it has already been assigned. The invocations of a 
+        chunk are performed one at a time, so a peer works on as many chunks
+        at once as it has cores. The cost estimate is based on a sample of the inputs so the 
+        planning cost does not grow with the number of inputs.
+        @type task: AdaptiveProfTaskInvokation
+        @param task: The task invocation (the input is ignored).
+        @type inputs: list
+        @param inputs: The input for each invocation.
+        @type chunksize: int
+        @param chunksize: The number of inputs in each chunk. If None a 
+        chunk size is chosen that gives each core a few chunks.
+        @rtype: list
+        @return: A list of ( peer, start, stop ) tuples, one for each chunk, 
+        where peer is None for local execution.
+        """
+        if len(inputs) == 0:
+            return []
+        table = self._context.snapshot()
+        unavailable = self._context.get_unavailable_peers()
+        peers = [peer for peer in table.peers if not peer.name in unavailable]
+
+        # Estimate the cost of a single invocation from a sample of the inputs.
+        step = max(1, len(inputs) / SAMPLE_SIZE)
+        sample = inputs[::step][:SAMPLE_SIZE]
+        complexities = [task.find_complexity(item) for item in sample]
+        if task.complexity_relation != None:
+            input_complexity = float(sum(complexities)) / len(complexities)
+        else:
+            input_complexity = None
+        input_size = float(sum([transfer_size(item) for item in sample])) / len(sample)
+        output_size = float(sum([self._find_output_size(task, item) for item in sample])) / len(sample)
+        datahandles = self._get_datahandles(sample[0])
+        global_complexity = self._gprofile.get_complexity(task.name, input_complexity = input_complexity)
+
+        # Find the time per invocation and the number of cores for each worker.
+        workers = []
+        if not prefer_remote or len(peers) == 0:
+            cores = self._scavenger.local_cores()
+            item_time = self._local_time(task.name, global_complexity, input_complexity, 
+                                         local_cpu_strength, local_network_speed, 
+                                         local_activity.value, datahandles)
+            workers.append((None, item_time, cores))
+        if self._vector != None and len(table) >= self._vector_threshold:
+            # Estimate every sampled invocation on every peer in one go.
+            times = self._vector.estimate_batch(table, task.name, 
+                                                [c if task.complexity_relation != None else None 
+                                                 for c in complexities],
+                                                [transfer_size(item) for item in sample],
+                                                [self._find_output_size(task, item) for item in sample],
+                                                local_network_speed, datahandles).mean(axis=0)
+            for peer, item_time in zip(table.peers, times):
+                if not peer.name in unavailable:
+                    workers.append((peer, float(item_time), max(1, peer.cpu_cores)))
+        else:
+            for peer in peers:
+                item_time = self._remote_time(peer, task.name, global_complexity, input_complexity,
+                                              input_size, output_size, local_network_speed, datahandles)
+                workers.append((peer, item_time, max(1, peer.cpu_cores)))
+        if len(workers) == 0:
+            return []
+
+        # Pick a chunk size giving every core a few chunks.
+        if chunksize == None:
+            total_cores = sum([cores for _, _, cores in workers])
+            chunksize = max(1, len(inputs) / (CHUNKS_PER_CORE * total_cores))
+
+        # Greedily assign each chunk to the core that will finish it first.
+        # The heap is keyed by the time each core would complete one more 
+        # full chunk, so a slow worker is only used once waiting for the fast
+        # ones would take longer.
+        def chunk_time(i, count):
+            return count * workers[i][1]
+        heap = [(chunk_time(i, chunksize), 0.0, i, core) 
+                for i in range(len(workers)) for core in range(workers[i][2])]
+        heapify(heap)
+        plan = []
+        for start in range(0, len(inputs), chunksize):
+            stop = min(start + chunksize, len(inputs))
+            if stop - start < chunksize:
+                # The last chunk is smaller, so another worker may finish it first.
+                _, _, i, _ = min([(finish + chunk_time(i, stop - start), finish, i, core)
+                                  for _, finish, i, core in heap])
+                plan.append((workers[i][0], start, stop))
+                break
+            completion, _, i, core = heap[0]
+            plan.append((workers[i][0], start, stop))
+            heapreplace(heap, (completion + chunk_time(i, chunksize), completion, i, core))
+        return plan
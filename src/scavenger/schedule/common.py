@@ -23,3 +23,7 @@ class Candidate(object):
     def _get_peer(self):
         return self._peer
     peer = property(_get_peer)
+
+    def _get_value(self):
+        return self._value
+    value = property(_get_value)
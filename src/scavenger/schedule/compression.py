@@ -0,0 +1,196 @@
+"""
+Adaptive compression of task input. For each task the compression ratio and
+the CPU cost of every codec is learned from samples of the serialized input,
+and a transfer is compressed only if sending the compressed bytes and
+running the codec is expected to be faster than sending the raw bytes over
+the link at hand.
+
+Compressed input is decompressed by the surrogate while unpickling it, using
+only the standard library, so the surrogates need no support for it.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+from cPickle import loads
+from time import time
+import zlib
+import bz2
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+class Codec(object):
+    def __init__(self, name, compress, decompress):
+        """
+        Constructor.
+        @type name: str
+        @param name: The name of the codec.
+        @type compress: function
+        @param compress: The compression function.
+        @type decompress: function
+        @param decompress: The decompression function. This must be a
+        module-level function of the standard library as it is pickled by
+        reference and called at the surrogate.
+        """
+        super(Codec, self).__init__()
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+# The known codecs. lzma is only known if it can be imported here, and it must
+# then be importable at the surrogates as well.
+CODECS = {'zlib' : Codec('zlib', zlib.compress, zlib.decompress),
+          'bz2' : Codec('bz2', bz2.compress, bz2.decompress)}
+if lzma != None:
+    CODECS['lzma'] = Codec('lzma', lzma.compress, lzma.decompress)
+
+class _Decompressed(object):
+    """Compressed bytes that unpickle as the decompressed bytes."""
+    def __init__(self, codec, data):
+        super(_Decompressed, self).__init__()
+        self._codec = codec
+        self._data = data
+
+    def __reduce__(self):
+        return (self._codec.decompress, (self._data,))
+
+class CompressedPayload(object):
+    """
+    Task input that has been pickled and compressed. When the payload is
+    pickled as part of an RPC call the compressed bytes are embedded as-is,
+    and unpickling it at the surrogate first decompresses the bytes and then
+    unpickles the original input.
+    """
+    def __init__(self, payload, codec):
+        """
+        Constructor.
+        @type payload: SerializedPayload
+        @param payload: The serialized input.
+        @type codec: Codec
+        @param codec: The codec used for compressing it.
+        """
+        super(CompressedPayload, self).__init__()
+        self._codec = codec
+        self._data = codec.compress(payload.data)
+
+    def _get_codec(self):
+        return self._codec
+    codec = property(_get_codec)
+
+    def _get_size(self):
+        return len(self._data)
+    size = property(_get_size)
+
+    def __reduce__(self):
+        return (loads, (_Decompressed(self._codec, self._data),))
+
+class CodecStats(object):
+    """The learned compression ratio and CPU cost of a codec for one task."""
+    ALPHA = 0.3 # The weight of new samples.
+
+    def __init__(self, ratio, cost):
+        super(CodecStats, self).__init__()
+        self.ratio = ratio
+        self.cost = cost
+
+    def update(self, ratio, cost):
+        self.ratio += CodecStats.ALPHA * (ratio - self.ratio)
+        self.cost += CodecStats.ALPHA * (cost - self.cost)
+
+class CompressionModel(object):
+    MIN_SIZE = 1024 # Inputs smaller than this many bytes are never compressed.
+    SAMPLE_SIZE = 64 * 1024 # The number of bytes compressed when learning.
+    LEARN_COUNT = 3 # The number of payloads per task that are always learned from...
+    LEARN_INTERVAL = 50 # ...after which only every this many payloads are.
+
+    def __init__(self, codecs = ('zlib', 'bz2'), min_size = MIN_SIZE):
+        """
+        Constructor.
+        @type codecs: list
+        @param codecs: The names of the codecs that may be used. Unknown codecs
+        are ignored, and with no codecs compression is disabled.
+        @type min_size: int
+        @param min_size: The size (in bytes) below which input is never compressed.
+        """
+        super(CompressionModel, self).__init__()
+        self._codecs = [CODECS[name] for name in codecs if CODECS.has_key(name)]
+        self.min_size = min_size
+        self._stats = {}
+        self._counts = {}
+        self._lock = allocate_lock()
+
+    def _get_enabled(self):
+        return len(self._codecs) > 0
+    enabled = property(_get_enabled)
+
+    def should_learn(self, task_name, size):
+        """Returns True if the serialized input of this invocation of the task
+        should be learned from."""
+        if not self.enabled or size < self.min_size:
+            return False
+        with self._lock:
+            count = self._counts.get(task_name, 0)
+            self._counts[task_name] = count + 1
+        return count < CompressionModel.LEARN_COUNT or count % CompressionModel.LEARN_INTERVAL == 0
+
+    def learn(self, task_name, data):
+        """
+        Measures the compression ratio and CPU cost of every codec on a
+        sample of the given serialized input of the task.
+        @type data: str
+        @param data: The serialized input.
+        """
+        sample = data[:CompressionModel.SAMPLE_SIZE]
+        if len(sample) == 0:
+            return
+        measurements = []
+        for codec in self._codecs:
+            start = time()
+            compressed = codec.compress(sample)
+            # The surrogate decompresses at roughly the same cost as we do.
+            codec.decompress(compressed)
+            cost = (time() - start) / len(sample)
+            measurements.append((codec.name, float(len(compressed)) / len(sample), cost))
+        with self._lock:
+            stats = self._stats.setdefault(task_name, {})
+            for name, ratio, cost in measurements:
+                if stats.has_key(name):
+                    stats[name].update(ratio, cost)
+                else:
+                    stats[name] = CodecStats(ratio, cost)
+
+    def costs(self, task_name):
+        """
+        Get the learned costs of compressing the input of the given task.
+        @rtype: list
+        @return: A list of ( codec, ratio, cost ) tuples where ratio is the
+        compressed size relative to the raw size and cost is the CPU time (in
+        seconds) per raw byte.
+        """
+        with self._lock:
+            stats = self._stats.get(task_name, {})
+            return [(CODECS[name], s.ratio, s.cost) for name, s in stats.items()]
+
+    def choose(self, task_name, size, bandwidth):
+        """
+        Chooses how to transfer input of the given size over a link with the
+        given bandwidth.
+        @rtype: ( Codec, float ) - tuple
+        @return: The codec to use (None for no compression) and the estimated
+        transfer time in seconds, including the time spent by the codec.
+        """
+        best, best_time = None, float(size) / bandwidth
+        if size < self.min_size:
+            return best, best_time
+        for codec, ratio, cost in self.costs(task_name):
+            transfer_time = size * ratio / bandwidth + size * cost
+            if transfer_time < best_time:
+                best, best_time = codec, transfer_time
+        return best, best_time
+
+    def transfer_time(self, task_name, size, bandwidth):
+        """Estimates the time it takes to transfer input of the given size
+        over a link with the given bandwidth, compressing it if that is faster."""
+        return self.choose(task_name, size, bandwidth)[1]
@@ -0,0 +1,113 @@
+"""
+Deadlines and retries for remote task invocations. The deadline of an
+invocation is derived from its predicted running time, and an invocation that
+misses its deadline or fails because the surrogate can not be reached is
+retried at another surrogate. Retries are drawn from a budget that is filled
+up as invocations are made, so a widespread failure does not multiply the
+load on the remaining surrogates.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+import socket
+
+class DeadlineExceeded(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+class PeerUnavailable(Exception):
+    """Raised when the circuit breaker of a surrogate does not let a task 
+    through, e.g., because its probes are all in flight."""
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+# The errors signalling that the surrogate could not be used, as opposed to
+# errors raised by the task itself.
+RETRYABLE_ERRORS = (socket.error, EOFError, IOError, DeadlineExceeded, PeerUnavailable)
+
+class RetryBudget(object):
+    """
+    A token bucket of retries. Every invocation deposits a fraction of a
+    token and every retry withdraws a whole token. The bucket starts out full.
+    """
+    def __init__(self, ratio, reserve):
+        """
+        Constructor.
+        @type ratio: float
+        @param ratio: The number of retries allowed per invocation.
+        @type reserve: int
+        @param reserve: The size of the bucket, i.e., the number of retries
+        allowed in a burst.
+        """
+        super(RetryBudget, self).__init__()
+        self._ratio = ratio
+        self._capacity = float(reserve)
+        self._tokens = float(reserve)
+        self._lock = allocate_lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._capacity, self._tokens + self._ratio)
+
+    def withdraw(self):
+        """Returns True if a retry may be made."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+class FailoverPolicy(object):
+    DEADLINE_FACTOR = 3.0 # The deadline is this many times the predicted time...
+    DEADLINE_SLACK = 5.0 # ...plus this many seconds.
+    MAX_DEADLINE = 600.0 # The deadline of invocations with no usable prediction.
+    MAX_RETRIES = 2 # The maximum number of retries of a single invocation.
+    RETRY_RATIO = 0.1
+    RETRY_RESERVE = 10
+
+    def __init__(self, deadline_factor = DEADLINE_FACTOR, deadline_slack = DEADLINE_SLACK,
+                 max_deadline = MAX_DEADLINE, max_retries = MAX_RETRIES,
+                 retry_ratio = RETRY_RATIO, retry_reserve = RETRY_RESERVE):
+        """
+        Constructor.
+        @type deadline_factor: float
+        @param deadline_factor: The deadline of an invocation is the predicted
+        time multiplied by this factor plus the deadline slack. A factor of 0
+        disables prediction-derived deadlines.
+        @type deadline_slack: float
+        @param deadline_slack: See deadline_factor.
+        @type max_deadline: float
+        @param max_deadline: The longest deadline given to any invocation.
+        @type max_retries: int
+        @param max_retries: The maximum number of times a single invocation is
+        retried at other surrogates.
+        @type retry_ratio: float
+        @param retry_ratio: The number of retries earned per invocation.
+        @type retry_reserve: int
+        @param retry_reserve: The number of retries that may be made in a burst.
+        """
+        super(FailoverPolicy, self).__init__()
+        self.deadline_factor = deadline_factor
+        self.deadline_slack = deadline_slack
+        self.max_deadline = max_deadline
+        self.max_retries = max_retries
+        self.budget = RetryBudget(retry_ratio, retry_reserve)
+
+    def deadline(self, predicted_time, confidence):
+        """
+        Finds the deadline of an invocation.
+        @type predicted_time: float
+        @param predicted_time: The predicted time (in seconds) of the invocation.
+        @type confidence: float
+        @param confidence: The confidence in the prediction. Without any
+        confidence the prediction is useless and the maximum deadline is used.
+        @rtype: ( float, bool ) - tuple
+        @return: The deadline in seconds and whether it was derived from the
+        prediction.
+        """
+        if self.deadline_factor <= 0 or confidence <= 0:
+            return self.max_deadline, False
+        deadline = self.deadline_factor * predicted_time + self.deadline_slack
+        if deadline >= self.max_deadline:
+            return self.max_deadline, False
+        return deadline, True
@@ -0,0 +1,345 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Futures and a bounded pool of dispatcher threads. These are used to
+offer an asynchronous scavenging API where a single client thread may
+keep several surrogates busy at once."""
+
+from __future__ import with_statement
+from threading import Thread, Condition, Lock, local
+from Queue import Queue
+from time import time
+import sys
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+FIRST_EXCEPTION = 'FIRST_EXCEPTION'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+class FutureTimeout(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+class Future(object):
+    """The pending result of an asynchronous task invocation."""
+    def __init__(self):
+        super(Future, self).__init__()
+        self._condition = Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._waiters = []
+
+    def done(self):
+        with self._condition:
+            return self._done
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise FutureTimeout('The result was not ready within %s seconds.'%timeout)
+
+    def result(self, timeout = None):
+        """
+        Get the result of the invocation. If the invocation raised an
+        exception it is re-raised here.
+        @type timeout: float
+        @param timeout: The number of seconds to wait for the result. If
+        None this method waits forever.
+        @raise FutureTimeout: If the result is not ready in time.
+        """
+        self._wait(timeout)
+        if self._exc_info != None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout = None):
+        """Get the exception raised by the invocation (None if it succeeded)."""
+        self._wait(timeout)
+        if self._exc_info != None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, callback):
+        """Register a function that is called with this future once it is done.
+        If the future is already done the function is called right away."""
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _add_waiter(self, waiter):
+        with self._condition:
+            if not self._done:
+                self._waiters.append(waiter)
+                return False
+        return True
+
+    def _remove_waiter(self, waiter):
+        with self._condition:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _complete(self, result, exc_info):
+        with self._condition:
+            if self._done:
+                return
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._condition.notifyAll()
+            callbacks, self._callbacks = self._callbacks, []
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.add(self)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except:
+                pass
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exc_info):
+        """Mark the future as failed.
+        @type exc_info: tuple
+        @param exc_info: The exception as returned by sys.exc_info()."""
+        self._complete(None, exc_info)
+
+class _Waiter(object):
+    """Collects futures as they complete."""
+    def __init__(self):
+        super(_Waiter, self).__init__()
+        self._condition = Condition()
+        self._finished = []
+
+    def add(self, future):
+        with self._condition:
+            self._finished.append(future)
+            self._condition.notify()
+
+    def take(self, timeout = None):
+        with self._condition:
+            if not self._finished:
+                self._condition.wait(timeout)
+            finished, self._finished = self._finished, []
+            return finished
+
+def as_completed(futures, timeout = None):
+    """
+    Iterate over the given futures as they complete.
+    @type futures: list
+    @param futures: The futures to wait for.
+    @type timeout: float
+    @param timeout: The total number of seconds to wait. If None there
+    is no limit.
+    @raise FutureTimeout: If not all futures complete in time.
+    """
+    deadline = None if timeout == None else time() + timeout
+    pending = set(futures)
+    waiter = _Waiter()
+    try:
+        for future in list(pending):
+            if future._add_waiter(waiter):
+                waiter.add(future)
+        while pending:
+            remaining = None
+            if deadline != None:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise FutureTimeout('%i futures did not complete in time.'%len(pending))
+            for future in waiter.take(remaining):
+                if future in pending:
+                    pending.remove(future)
+                    yield future
+    finally:
+        for future in pending:
+            future._remove_waiter(waiter)
+
+def wait(futures, timeout = None, return_when = ALL_COMPLETED):
+    """
+    Wait for the given futures to complete.
+    @type futures: list
+    @param futures: The futures to wait for.
+    @type timeout: float
+    @param timeout: The maximum number of seconds to wait.
+    @type return_when: str
+    @param return_when: One of FIRST_COMPLETED, FIRST_EXCEPTION or ALL_COMPLETED.
+    @rtype: ( set, set ) - tuple
+    @return: The futures that are done and those that are not.
+    """
+    done = set()
+    not_done = set(futures)
+    try:
+        for future in as_completed(futures, timeout):
+            done.add(future)
+            not_done.discard(future)
+            if return_when == FIRST_COMPLETED:
+                break
+            if return_when == FIRST_EXCEPTION and future.exception() != None:
+                break
+    except FutureTimeout:
+        pass
+    return done, not_done
+
+def spawn(fn, *args, **kwargs):
+    """
+    Executes fn(*args, **kwargs) in a new thread of its own. Unlike 
+    DispatcherPool.submit this never has to wait for a free worker, so it may
+    safely be used from within a dispatcher thread.
+    @rtype: Future
+    @return: A future holding the result of the call.
+    """
+    future = Future()
+    def run():
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except:
+            future.set_exception(sys.exc_info())
+    thread = Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+class Race(object):
+    """Decides which of several runs of the same invocation wins. The first 
+    run to claim the race is the winner - later claims by other runs fail."""
+    def __init__(self):
+        super(Race, self).__init__()
+        self._lock = Lock()
+        self._winner = None
+
+    def claim(self, runner):
+        """Claims the race for the given runner. Returns True if the runner 
+        is the winner (claiming again is harmless)."""
+        with self._lock:
+            if self._winner == None:
+                self._winner = runner
+            return self._winner is runner
+
+class SingleFlight(object):
+    """Coalesces concurrent identical calls: while a call with a given key 
+    is in flight, other calls with the same key wait for it and share its
+    result (or its exception) instead of making the call themselves."""
+    def __init__(self):
+        super(SingleFlight, self).__init__()
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) unless a call with the same key is already
+        in flight, in which case the result of that call is returned.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future == None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            with self._lock:
+                del self._calls[key]
+            future.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        with self._lock:
+            del self._calls[key]
+        future.set_result(result)
+        return result
+
+    def __len__(self):
+        return len(self._calls)
+
+class DispatcherPool(object):
+    """A bounded pool of worker threads executing functions asynchronously."""
+    def __init__(self, workers):
+        """
+        Constructor.
+        @type workers: int
+        @param workers: The maximum number of worker threads.
+        """
+        super(DispatcherPool, self).__init__()
+        self._max_workers = max(1, workers)
+        self._queue = Queue()
+        self._threads = []
+        self._idle = 0
+        self._lock = Lock()
+        self._shutdown = False
+        self._local = local()
+
+    def _worker(self):
+        self._local.worker = True
+        while True:
+            item = self._queue.get()
+            if item == None:
+                return
+            future, fn, args, kwargs = item
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
+            del item, future
+            # Signal that this worker is ready for more work.
+            with self._lock:
+                self._idle += 1
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedule fn(*args, **kwargs) for execution in the pool.
+        @rtype: Future
+        @return: A future holding the result of the call.
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('The dispatcher pool has been shut down.')
+            if self._idle > 0:
+                # Hand the work to an idle worker.
+                self._idle -= 1
+            elif len(self._threads) < self._max_workers:
+                # All workers are busy - start another one.
+                thread = Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def in_worker(self):
+        """Returns True if called from one of the worker threads. Work that
+        such a thread submits and then waits for may never get a worker, as
+        the pool is bounded."""
+        return getattr(self._local, 'worker', False)
+
+    def shutdown(self, wait = True):
+        """Stop the worker threads once the queued work is done."""
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
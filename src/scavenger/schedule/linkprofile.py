@@ -0,0 +1,137 @@
+"""
+Online estimates of the network link to each peer. The wall time and the
+number of bytes of the transfers made to and from a peer are measured, and
+exponentially weighted moving averages of the round-trip time and of the
+throughput are kept per peer. Small transfers measure the round-trip time,
+and larger ones measure the throughput once the round-trip time has been
+subtracted. The estimates are persisted next to the profiles.
+"""
+
+from __future__ import with_statement
+from persistence import JournaledFile, Compactor
+from thread import allocate_lock
+import os
+
+class LinkEstimate(object):
+    ALPHA = 0.2 # The weight of new measurements.
+    SMALL_TRANSFER = 4096 # Transfers of at most this many bytes measure the round-trip time.
+
+    def __init__(self):
+        super(LinkEstimate, self).__init__()
+        self.rtt = None
+        self.time_per_byte = None
+
+    def _get_bandwidth(self):
+        if self.time_per_byte == None:
+            return None
+        return 1.0 / self.time_per_byte
+    bandwidth = property(_get_bandwidth, doc = """The estimated throughput in bytes per second (None if unknown).""")
+
+    def _average(self, average, value):
+        if average == None:
+            return value
+        return average + LinkEstimate.ALPHA * (value - average)
+
+    def register(self, nbytes, elapsed):
+        """
+        Registers a transfer.
+        @type nbytes: int
+        @param nbytes: The number of bytes transferred.
+        @type elapsed: float
+        @param elapsed: The wall time of the transfer in seconds.
+        """
+        if nbytes <= LinkEstimate.SMALL_TRANSFER:
+            self.rtt = self._average(self.rtt, elapsed)
+            return
+        # The round-trip time is not part of the throughput - but a transfer
+        # is never assumed to take less than a tenth of its wall time.
+        transfer_time = max(elapsed - (self.rtt or 0.0), elapsed / 10)
+        if transfer_time > 0:
+            self.time_per_byte = self._average(self.time_per_byte, transfer_time / nbytes)
+
+class LinkProfile(object):
+    COMPACT_INTERVAL = 300.0 # Seconds between checks for compaction of the journal.
+
+    def __init__(self, filename = 'links.dat', compact_interval = COMPACT_INTERVAL):
+        super(LinkProfile, self).__init__()
+        self._filename = os.path.join(os.environ['HOME'], '.scavenger', filename)
+        self._lock = allocate_lock()
+        self._compact_lock = allocate_lock()
+
+        # Load in the estimates - the latest snapshot with the transfers
+        # made since then replayed on top.
+        self._store = JournaledFile(self._filename)
+        self._data = self._store.load(self._replay, {})
+        # The estimates as returned by get_measured - rebuilt after changes.
+        self._measured = None
+
+        # Compact the transfer journal into a new snapshot every once in a while.
+        self._compactor = Compactor(self._compact, compact_interval)
+        self._compactor.start()
+
+    def _replay(self, data, record):
+        peer_name, nbytes, elapsed = record
+        if not data.has_key(peer_name):
+            data[peer_name] = LinkEstimate()
+        data[peer_name].register(nbytes, elapsed)
+
+    def _compact(self):
+        # Only the in-memory serialization of the data is done while holding
+        # the lock - the snapshot is written to disk without it.
+        with self._compact_lock:
+            with self._lock:
+                if self._store.records == 0:
+                    return
+                snapshot = self._store.rotate(self._data)
+            self._store.write_snapshot(snapshot)
+
+    def register(self, peer_name, nbytes, elapsed):
+        """Registers a transfer of nbytes bytes to or from the given peer
+        that took elapsed seconds."""
+        with self._lock:
+            self._replay(self._data, (peer_name, nbytes, elapsed))
+            self._store.append((peer_name, nbytes, elapsed))
+            self._measured = None
+
+    def get_bandwidth(self, peer_name, default = None):
+        """Returns the estimated throughput of the link to the peer in bytes
+        per second, or the default if it has not been measured."""
+        with self._lock:
+            estimate = self._data.get(peer_name)
+            if estimate == None or estimate.bandwidth == None:
+                return default
+            return estimate.bandwidth
+
+    def get_rtt(self, peer_name, default = None):
+        """Returns the estimated round-trip time of the link to the peer in
+        seconds, or the default if it has not been measured."""
+        with self._lock:
+            estimate = self._data.get(peer_name)
+            if estimate == None or estimate.rtt == None:
+                return default
+            return estimate.rtt
+
+    def get_measured(self):
+        """
+        Get the estimates of all measured links.
+        @rtype: dict
+        @return: A dict mapping peer names to ( bandwidth, rtt ) tuples, where
+        either may be None if it has not been measured. The dict is shared by
+        the callers until the estimates change, so it must not be modified.
+        """
+        with self._lock:
+            if self._measured == None:
+                self._measured = dict([(name, (estimate.bandwidth, estimate.rtt))
+                                       for name, estimate in self._data.items()])
+            return self._measured
+
+    def save(self):
+        """Writes a new snapshot of the estimates."""
+        self._compact()
+
+    def close(self):
+        """Saves the estimates and stops the background compaction."""
+        self._compactor.stop()
+        self._compact()
+        with self._lock:
+            self._store.close()
@@ -0,0 +1,104 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers for finding the transfer size of task input without serializing
+it more than once."""
+
+from cPickle import dumps, loads
+from datastore import RemoteDataHandle
+from array import array
+
+# The approximate pickled size of scalars and of a data handle. The data
+# behind a handle is accounted for separately by the scheduler.
+SCALAR_SIZE = 10
+HANDLE_SIZE = 128
+# Containers larger than this are pickled instead of being estimated item
+# by item, as pickling is faster than estimating in Python.
+MAX_ESTIMATE_ITEMS = 64
+
+class SerializedPayload(object):
+    """
+    Task input that has been pickled exactly once. The pickled bytes are
+    used both for estimating the transfer size and for the transfer itself:
+    when the payload is pickled as part of an RPC call the bytes are
+    embedded as-is, and unpickling it at the surrogate yields the original
+    input.
+    """
+    def __init__(self, obj):
+        super(SerializedPayload, self).__init__()
+        self._data = dumps(obj, -1)
+
+    def _get_size(self):
+        return len(self._data)
+    size = property(_get_size)
+
+    def _get_data(self):
+        return self._data
+    data = property(_get_data)
+
+    def __reduce__(self):
+        return (loads, (self._data,))
+
+def estimate_size(obj, _budget = None):
+    """
+    Cheaply estimates the transfer size of the given object without
+    serializing it.
+    @rtype: int
+    @return: The estimated size in bytes, or None if the size can not be
+    estimated cheaply.
+    """
+    if _budget == None:
+        _budget = [MAX_ESTIMATE_ITEMS]
+    _budget[0] -= 1
+    if _budget[0] < 0:
+        return None
+
+    if type(obj) in (str, unicode, buffer, bytearray):
+        return len(obj) + SCALAR_SIZE
+    if type(obj) in (int, long, float, bool, type(None)):
+        return SCALAR_SIZE
+    if type(obj) == RemoteDataHandle:
+        return HANDLE_SIZE
+    if type(obj) == array:
+        return obj.itemsize * len(obj) + SCALAR_SIZE
+    if hasattr(obj, 'nbytes') and hasattr(obj, 'dtype'):
+        # A numeric (NumPy) array.
+        return int(obj.nbytes) + HANDLE_SIZE
+    if type(obj) in (tuple, list):
+        size = SCALAR_SIZE
+        for item in obj:
+            item_size = estimate_size(item, _budget)
+            if item_size == None:
+                return None
+            size += item_size
+        return size
+    if type(obj) == dict:
+        size = SCALAR_SIZE
+        for key, value in obj.iteritems():
+            key_size = estimate_size(key, _budget)
+            value_size = estimate_size(value, _budget)
+            if key_size == None or value_size == None:
+                return None
+            size += key_size + value_size
+        return size
+    return None
+
+def transfer_size(obj):
+    """Returns the transfer size of the given object, serializing it only
+    if the size can not be estimated cheaply."""
+    size = estimate_size(obj)
+    if size == None:
+        size = len(dumps(obj, -1))
+    return size
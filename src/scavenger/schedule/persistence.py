@@ -0,0 +1,195 @@
+"""
+Crash-safe persistence of scheduling data. The data is kept in a snapshot
+file along with an append-only journal of the changes made since the
+snapshot was written. The journal is compacted into a new snapshot every
+once in a while. Snapshots are written to a temporary file that is then
+renamed into place, so a crash never leaves a half-written snapshot behind.
+
+Compaction is split in two so that the owner of the data need only hold its
+lock while the data is serialized in memory: rotate() cuts the journal and
+serializes the data, and write_snapshot() then writes it to disk. The old
+journal is kept until the new snapshot is in place, so the records written
+on either side of the cut survive a crash in between.
+"""
+
+from __future__ import with_statement
+from cPickle import load, dump, dumps, UnpicklingError
+from threading import Thread, Event
+import os
+
+SNAPSHOT_TAG = 'scavenger-snapshot'
+JOURNAL_TAG = 'scavenger-journal'
+
+class JournaledFile(object):
+    def __init__(self, filename):
+        """
+        Constructor.
+        @type filename: str
+        @param filename: The path of the snapshot file. The journal is kept
+        next to it with the extension '.journal'.
+        """
+        super(JournaledFile, self).__init__()
+        self._filename = filename
+        self._journal_filename = filename + '.journal'
+        self._old_journal_filename = filename + '.journal.old'
+        self._generation = 0
+        self._journal = None
+        self._records = 0
+
+    def _get_records(self):
+        return self._records
+    records = property(_get_records, doc = """The number of records written to the journal since the last snapshot.""")
+
+    def load(self, replay, default):
+        """
+        Loads the snapshot and replays the journal on top of it.
+        @type replay: function
+        @param replay: A function accepting the data and a journal record. It
+        is called for each record in the journal.
+        @type default: object
+        @param default: The data to use if there is no valid snapshot.
+        @return: The loaded data.
+        """
+        data = default
+        if os.path.exists(self._filename):
+            try:
+                with open(self._filename, 'rb') as infile:
+                    snapshot = load(infile)
+                if type(snapshot) == tuple and len(snapshot) == 3 and snapshot[0] == SNAPSHOT_TAG:
+                    _, self._generation, data = snapshot
+                elif type(snapshot) == type(default):
+                    # A plain data file written before journaling was introduced.
+                    data = snapshot
+            except (EOFError, UnpicklingError, ValueError, AttributeError, ImportError, IOError):
+                # Silently ignore this for now - later on logging should be used.
+                data = default
+
+        # Replay the journals that belong to this snapshot. A journal from an
+        # older generation has already been compacted into the snapshot. If
+        # the client died while compacting, the old journal holds the records
+        # made before the cut and the journal of the next generation those 
+        # made after it.
+        replayed = self._replay(self._old_journal_filename, (self._generation,), data, replay)
+        replayed += self._replay(self._journal_filename, (self._generation, self._generation + 1), 
+                                 data, replay)
+        self._remove(self._old_journal_filename)
+
+        # Fold any replayed records into a new snapshot so that the journal 
+        # can be started afresh.
+        if replayed > 0:
+            self.compact(data)
+        else:
+            self._open_journal()
+        return data
+
+    def _replay(self, filename, generations, data, replay):
+        """Replays the journal in the given file if it belongs to one of the 
+        given generations, returning the number of records replayed."""
+        replayed = 0
+        if os.path.exists(filename):
+            with open(filename, 'rb') as infile:
+                try:
+                    header = load(infile)
+                    if header in [(JOURNAL_TAG, generation) for generation in generations]:
+                        while True:
+                            replay(data, load(infile))
+                            replayed += 1
+                except (EOFError, UnpicklingError, ValueError, AttributeError, ImportError, IndexError, TypeError):
+                    # The end of the journal - possibly a record that was
+                    # only partially written when the client died.
+                    pass
+        return replayed
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def _open_journal(self):
+        if self._journal != None:
+            self._journal.close()
+        self._journal = open(self._journal_filename, 'wb')
+        dump((JOURNAL_TAG, self._generation), self._journal, -1)
+        self._journal.flush()
+        self._records = 0
+
+    def append(self, record):
+        """Appends a record to the journal. The journal is opened by load 
+        and records appended after close are dropped."""
+        if self._journal == None:
+            return
+        dump(record, self._journal, -1)
+        self._journal.flush()
+        self._records += 1
+
+    def rotate(self, data):
+        """
+        Cuts the journal: the given data becomes the next snapshot and a new
+        journal is started for the records appended after it. The data must
+        not change while this is done, but it is only serialized in memory.
+        @type data: object
+        @param data: The complete data.
+        @rtype: str
+        @return: The serialized snapshot that must be given to write_snapshot.
+        """
+        snapshot = dumps((SNAPSHOT_TAG, self._generation + 1, data), -1)
+        if self._journal != None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self._journal_filename):
+            os.rename(self._journal_filename, self._old_journal_filename)
+        self._generation += 1
+        self._open_journal()
+        return snapshot
+
+    def write_snapshot(self, snapshot):
+        """Writes a snapshot made by rotate to disk, after which the journal
+        from before the cut is no longer needed."""
+        temp_filename = self._filename + '.tmp'
+        with open(temp_filename, 'wb') as outfile:
+            outfile.write(snapshot)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(temp_filename, self._filename)
+        self._remove(self._old_journal_filename)
+
+    def compact(self, data):
+        """
+        Writes the given data as a new snapshot and starts a new journal.
+        @type data: object
+        @param data: The complete data.
+        """
+        self.write_snapshot(self.rotate(data))
+
+    def close(self):
+        if self._journal != None:
+            self._journal.close()
+            self._journal = None
+
+class Compactor(Thread):
+    """A background thread that calls a compaction function periodically."""
+    def __init__(self, compact, interval):
+        super(Compactor, self).__init__()
+        self.daemon = True
+        self._compact = compact
+        self._interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        while True:
+            try:
+                self._stopped.wait(self._interval)
+                if self._stopped.isSet():
+                    return
+            except:
+                # The interpreter is shutting down.
+                return
+            try:
+                self._compact()
+            except:
+                # Silently ignore this for now - later on logging should be used.
+                pass
+
+    def stop(self):
+        self._stopped.set()
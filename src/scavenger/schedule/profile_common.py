@@ -1,68 +1,103 @@
 from __future__ import with_statement
 from thread import allocate_lock
-from cPickle import load, dump
-from math import fabs
+from persistence import JournaledFile, Compactor
+from math import fabs, log, sqrt
+from bisect import bisect_left
 import os
 
-def binary_search(l, x):
-    """Searches through the sorted list l for the value closest to x."""
-    lo = 0
-    hi = len(l)
-    mid = None
-    while lo < hi:
-        mid = (lo+hi)/2
-        if x > l[mid]:
-            # Go right (up).
-            lo = mid+1
-        elif x < l[mid]:
-            # Go left (down).
-            hi = mid
-        else:
-            return mid
-    return mid
-
-def sandwish(l, x):
-    """Returns the two positions that x lies between w.r.t. value in the sorted list l.
-    I.e., it returns the place where x could be inserted to maintain the ordering."""
-    pos = binary_search(l, x)
-    if pos == None:
-        return None
-    else:
-        if l[pos] == x:
-            return (pos, pos)
-        elif l[pos] < x:
-            if len(l) > pos+1:
-                return (pos, pos+1)
-            else:
-                return (pos, pos)
+def relative_difference(reference, value):
+    """Returns how much value differs from reference relative to reference."""
+    if reference == 0:
+        if value == 0:
+            return 0.0
+        return float('inf')
+    return fabs(float(reference - value) / reference)
+
+class RingBuffer(object):
+    """
+    A fixed size backlog of measurements. The sum and the sum of squares of 
+    the measurements are kept up to date as measurements are added, so the
+    mean and variance are found in constant time no matter how large the 
+    backlog is. An exponentially weighted moving average is kept as well.
+    """
+    EWMA_WEIGHT = 0.3 # The weight given to a new measurement in the EWMA.
+    RESUM_INTERVAL = 16 # Recompute the sums every this many wrap-arounds.
+
+    def __init__(self, size):
+        super(RingBuffer, self).__init__()
+        self._size = max(1, size)
+        self._values = []
+        self._next = 0
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+        self._ewma = None
+        self._wraps = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def append(self, value):
+        if len(self._values) < self._size:
+            self._values.append(value)
         else:
-            if pos > 0:
-                return (pos-1, pos)
-            else:
-                return (pos, pos)
-
-def closest_to_me(l, x):
-    yz = sandwish(l, x)
-    if yz == None:
-        return None
-    else:
-        y, z = yz
-        if y == z:
-            return y
+            # Overwrite the oldest entry.
+            old = self._values[self._next]
+            self._values[self._next] = value
+            self._sum -= old
+            self._sum_of_squares -= old * old
+        self._sum += value
+        self._sum_of_squares += value * value
+        self._next += 1
+        if self._next == self._size:
+            self._next = 0
+            self._wraps += 1
+            if self._wraps % RingBuffer.RESUM_INTERVAL == 0:
+                # Get rid of accumulated floating point errors.
+                self._sum = float(sum(self._values))
+                self._sum_of_squares = float(sum([x * x for x in self._values]))
+        if self._ewma == None:
+            self._ewma = float(value)
         else:
-            diff_to_y = x - l[y]._key
-            diff_to_z = l[z]._key - x
-            if diff_to_y <= diff_to_z:
-                return y
-            else:
-                return z
+            self._ewma += RingBuffer.EWMA_WEIGHT * (value - self._ewma)
+
+    def _get_mean(self):
+        return self._sum / len(self._values)
+    mean = property(_get_mean)
+
+    def _get_variance(self):
+        n = len(self._values)
+        mean = self._sum / n
+        return max(0.0, self._sum_of_squares / n - mean * mean)
+    variance = property(_get_variance)
+
+    def _get_ewma(self):
+        return self._ewma
+    ewma = property(_get_ewma)
+
+    def values(self):
+        """Returns the measurements in the backlog ordered from oldest to newest."""
+        return self._values[self._next:] + self._values[:self._next]
+
+    @classmethod
+    def from_list(cls, size, values):
+        """Creates a ring buffer holding the newest of the given values."""
+        ring = cls(size)
+        for value in values[-ring._size:]:
+            ring.append(value)
+        return ring
 
 class ProfileBucket(object):
     def __init__(self, key, backlog_size):
         super(ProfileBucket, self).__init__()
         self._key = key
         self._backlog_size = backlog_size
-        self._backlog = []
+        self._backlog = RingBuffer(backlog_size)
+
+    def __setstate__(self, state):
+        # Convert buckets saved with the old list-based backlog.
+        if type(state['_backlog']) == list:
+            state['_backlog'] = RingBuffer.from_list(state['_backlog_size'], state['_backlog'])
+        self.__dict__.update(state)
 
     def __cmp__(self, other):
         if type(other) == type(self):
@@ -71,16 +106,92 @@ class ProfileBucket(object):
             return cmp(self._key, other)
 
     def register(self, value):
-        # Prune out old entries if necessary.
-        if len(self._backlog) >= self._backlog_size:
-            self._backlog.pop(0)
-        # Add the new entry.
+        # Add the new entry. The oldest entry is pruned out if necessary.
         self._backlog.append(value)
 
     def get_complexity(self):
-        return reduce(lambda x, y: x + y, self._backlog) / len(self._backlog)
+        return self._backlog.mean
         
 
+def spread_of(ring):
+    """Returns the standard deviation of the given backlog relative to its mean."""
+    if len(ring) == 0 or ring.mean == 0:
+        return 0.0
+    return sqrt(ring.variance) / fabs(ring.mean)
+
+def confidence_of(ring):
+    """Returns a confidence value in [0;1] for the mean of the given backlog. 
+    The confidence grows with the number of measurements and shrinks with 
+    the relative spread of the measurements."""
+    n = len(ring)
+    if n == 0:
+        return 0.0
+    return (float(n) / (n + 1)) / (1.0 + spread_of(ring))
+
+def normal_quantile(p):
+    """Returns the p-quantile of the standard normal distribution, e.g., 1.64
+    for p = 0.95. This uses the rational approximation of Abramowitz and 
+    Stegun (26.2.23) which has an absolute error below 4.5e-4."""
+    p = min(max(p, 1e-9), 1 - 1e-9)
+    if p < 0.5:
+        return -normal_quantile(1 - p)
+    t = sqrt(-2.0 * log(1 - p))
+    return t - (2.515517 + 0.802853 * t + 0.010328 * t * t) / \
+        (1 + 1.432788 * t + 0.189269 * t * t + 0.001308 * t * t * t)
+
+class ScalingModel(object):
+    """
+    A curve relating input size to complexity, fitted by least squares to 
+    the buckets of a two-dimensional profile item. Several scaling functions
+    are tried and the one with the smallest residual is used.
+    """
+    FUNCTIONS = (
+        ('constant', lambda x: 0.0),
+        ('linear', lambda x: x),
+        ('nlogn', lambda x: x * log(x) if x > 1 else 0.0),
+        ('quadratic', lambda x: x * x),
+        )
+
+    def __init__(self, keys, values, weights):
+        super(ScalingModel, self).__init__()
+        self.name = 'constant'
+        self._function = ScalingModel.FUNCTIONS[0][1]
+        self._intercept = 0.0
+        self._slope = 0.0
+        best = None
+        for name, function in ScalingModel.FUNCTIONS:
+            fit = self._fit(function, keys, values, weights)
+            if fit == None:
+                continue
+            intercept, slope, residual = fit
+            if best == None or residual < best:
+                best = residual
+                self.name = name
+                self._function = function
+                self._intercept = intercept
+                self._slope = slope
+
+    def _fit(self, function, keys, values, weights):
+        xs = [function(key) for key in keys]
+        total = float(sum(weights))
+        mean_x = sum([w * x for w, x in zip(weights, xs)]) / total
+        mean_y = sum([w * y for w, y in zip(weights, values)]) / total
+        sxx = sum([w * (x - mean_x) ** 2 for w, x in zip(weights, xs)])
+        sxy = sum([w * (x - mean_x) * (y - mean_y) for w, x, y in zip(weights, xs, values)])
+        if sxx == 0:
+            slope = 0.0
+        else:
+            slope = sxy / sxx
+        if slope < 0:
+            # Complexity is not expected to drop as the input grows.
+            return None
+        intercept = mean_y - slope * mean_x
+        residual = sum([w * (y - intercept - slope * x) ** 2 for w, x, y in zip(weights, xs, values)])
+        return intercept, slope, residual
+
+    def predict(self, key):
+        return max(0.0, self._intercept + self._slope * self._function(key))
+
 class ProfileItem(object):
     DEFAULT_COMPLEXITY = 0.0
     COMPLEXITY_VARIATION = 0.2 # The complexity has to vary at least this much before we create a new bucket.
@@ -89,102 +200,232 @@ class ProfileItem(object):
     def __init__(self, backlog_size):
         super(ProfileItem, self).__init__()
         self._backlog_size = backlog_size
-        self._backlog = []
+        # The measurements of a single-dimensional item.
+        self._backlog = RingBuffer(backlog_size)
+        # The buckets of a two-dimensional item, sorted by key, along with their keys.
+        self._buckets = []
+        self._keys = []
+        # The scaling model fitted to the buckets (None if it must be refitted).
+        self._model = None
+
+    def __setstate__(self, state):
+        # Convert items saved with the old list-based backlog, where the
+        # buckets of two-dimensional items were kept in the backlog.
+        if type(state['_backlog']) == list:
+            backlog = state['_backlog']
+            if len(backlog) > 0 and type(backlog[0]) == ProfileBucket:
+                state['_buckets'] = backlog
+                backlog = []
+            else:
+                state['_buckets'] = []
+            state['_backlog'] = RingBuffer.from_list(state['_backlog_size'], backlog)
+        if not state.has_key('_keys'):
+            state['_keys'] = [bucket._key for bucket in state['_buckets']]
+        state['_model'] = None
+        self.__dict__.update(state)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_model'] = None
+        return state
+
+    def _closest(self, input_size):
+        """Returns the position of the bucket with the key closest to input_size 
+        (or None if there are no buckets)."""
+        if len(self._keys) == 0:
+            return None
+        pos = bisect_left(self._keys, input_size)
+        if pos == len(self._keys):
+            return pos - 1
+        if pos > 0 and input_size - self._keys[pos - 1] <= self._keys[pos] - input_size:
+            return pos - 1
+        return pos
+
+    def _get_model(self):
+        if self._model == None:
+            self._model = ScalingModel(self._keys, 
+                                       [bucket.get_complexity() for bucket in self._buckets],
+                                       [len(bucket._backlog) for bucket in self._buckets])
+        return self._model
 
     def register(self, value, input_size = None):
         if input_size != None:
             # This is a two-dimensional profile item.
             # When registering we first look for the bucket with the values closest to
             # this new value.
-            candidate_position = closest_to_me(self._backlog, input_size)
-            if candidate_position == None:
-#                print 'new bucket!!'
-                # There is nothing in the list.
-                # We must create a new bucket for this item.
-                new_bucket = ProfileBucket(input_size, self._backlog_size)
-                new_bucket.register(value)
-                self._backlog.insert(0, new_bucket)
-            else:
-                # We have found a candidate. Now continue to figure out where this item
-                # belongs.
-                candidate = self._backlog[candidate_position]
-                # Check how much that bucket's complexity value varies from this new one.
-                candidate_complexity = candidate.get_complexity()
-                complexity_variation = fabs((candidate_complexity - value) / candidate_complexity)
-                input_size_variation = fabs((float(candidate._key - input_size)) / candidate._key)
-#                print 'variations', complexity_variation, input_size_variation #DEBUG
-                if complexity_variation > ProfileItem.COMPLEXITY_VARIATION and input_size_variation > ProfileItem.SIZE_VARIATION:
-#                    print 'new bucket!' #DEBUG
-                    # We must create a new bucket for this item.
-                    new_bucket = ProfileBucket(input_size, self._backlog_size)
-                    new_bucket.register(value)
-                    if candidate > new_bucket:
-                        self._backlog.insert(candidate_position, new_bucket)
-                    else:
-                        self._backlog.insert(candidate_position + 1, new_bucket)
-                else:
-                    # The item fits inside this bucket.
+            self._model = None
+            candidate_position = self._closest(input_size)
+            if candidate_position != None:
+                # We have found a candidate. Now check whether the item fits inside 
+                # that bucket. This is the case unless both the complexity and the 
+                # input size vary too much from the bucket.
+                candidate = self._buckets[candidate_position]
+                complexity_variation = relative_difference(candidate.get_complexity(), value)
+                input_size_variation = relative_difference(candidate._key, input_size)
+                if complexity_variation <= ProfileItem.COMPLEXITY_VARIATION or \
+                        input_size_variation <= ProfileItem.SIZE_VARIATION:
                     candidate.register(value)
+                    return
+            # We must create a new bucket for this item.
+            new_bucket = ProfileBucket(input_size, self._backlog_size)
+            new_bucket.register(value)
+            position = bisect_left(self._keys, input_size)
+            self._keys.insert(position, input_size)
+            self._buckets.insert(position, new_bucket)
         else:
             # This is a standard, single-dimensional profile item.
-            # Prune out old entries if necessary.
-            if len(self._backlog) >= self._backlog_size:
-                self._backlog.pop(0)
-            # Add the new entry.
+            # Add the new entry. The oldest entry is pruned out if necessary.
             self._backlog.append(value)
 
-    def get_complexity(self, input_size = None):
-        if input_size != None:
-            # This is a two-dimensional thingy.
-            candidate_position = closest_to_me(self._backlog, input_size)
-            if candidate_position == None:
-                # The backlog is empty.
-                return ProfileItem.DEFAULT_COMPLEXITY
-            else:
-                return self._backlog[candidate_position].get_complexity()
-        else:
+    def get_prediction(self, input_size = None):
+        """
+        Predicts the complexity of a task.
+        @type input_size: float
+        @param input_size: The value of the complexity relation for the input
+        (None for single-dimensional items).
+        @rtype: ( float, float ) - tuple
+        @return: The predicted complexity and a confidence value in [0;1].
+        """
+        if input_size == None:
             # This is the regular single-dimensional backlog.
             # if no measurements are available we return the default.
             if len(self._backlog) == 0:
-                return ProfileItem.DEFAULT_COMPLEXITY
+                return ProfileItem.DEFAULT_COMPLEXITY, 0.0
             # Otherwise we return the average of the backlog. 
             # TODO: This could be varied to put more or less weight to new vs. old information.
-            return reduce(lambda x, y: x + y, self._backlog) / len(self._backlog)
+            return self._backlog.mean, confidence_of(self._backlog)
+
+        # This is a two-dimensional thingy.
+        if len(self._buckets) == 0:
+            # The backlog is empty.
+            return ProfileItem.DEFAULT_COMPLEXITY, 0.0
+        pos = bisect_left(self._keys, input_size)
+        if pos < len(self._keys) and self._keys[pos] == input_size:
+            # A direct hit.
+            bucket = self._buckets[pos]
+            return bucket.get_complexity(), confidence_of(bucket._backlog)
+        if 0 < pos < len(self._keys):
+            # Interpolate linearly between the neighbouring buckets.
+            lo, hi = self._buckets[pos - 1], self._buckets[pos]
+            weight = float(input_size - lo._key) / (hi._key - lo._key)
+            complexity = (1 - weight) * lo.get_complexity() + weight * hi.get_complexity()
+            confidence = (1 - weight) * confidence_of(lo._backlog) + weight * confidence_of(hi._backlog)
+            return complexity, confidence
+        
+        # Extrapolate beyond the measured input sizes. With a single bucket 
+        # there is nothing to fit a curve to so its value is used as-is.
+        nearest = self._buckets[min(pos, len(self._buckets) - 1)]
+        if len(self._buckets) == 1:
+            complexity = nearest.get_complexity()
+        else:
+            complexity = self._get_model().predict(input_size)
+        # The confidence drops as we move away from the measured sizes.
+        if nearest._key > 0 and input_size > 0:
+            distance = min(nearest._key, input_size) / float(max(nearest._key, input_size))
+        else:
+            distance = 0.5
+        return complexity, confidence_of(nearest._backlog) * distance
+
+    def get_complexity(self, input_size = None):
+        return self.get_prediction(input_size)[0]
+
+    def get_spread(self, input_size = None):
+        """Returns the relative standard deviation of the measurements that
+        the prediction for the given input size is based on."""
+        if input_size == None:
+            return spread_of(self._backlog)
+        position = self._closest(input_size)
+        if position == None:
+            return 0.0
+        return spread_of(self._buckets[position]._backlog)
 
 class Profile(object):
-    def __init__(self, backlog = 10, filename = 'profile.dat'):
+    COMPACT_INTERVAL = 300.0 # Seconds between checks for compaction of the journal.
+
+    def __init__(self, backlog = 10, filename = 'profile.dat', compact_interval = COMPACT_INTERVAL):
         super(Profile, self).__init__()
         self._backlog = backlog
         self._filename = os.path.join(os.environ['HOME'], '.scavenger', filename)
-        self._data = {}
         self._lock = allocate_lock()
+        self._compact_lock = allocate_lock()
 
-        # Try to load in profile data.
-        if os.path.exists(self._filename):
-            with open(self._filename, 'rb') as infile:
-                self._data = load(infile)
-            if type(self._data) != dict:
-                # Silently ignore this for now - later on logging should be used.
-                self._data = {}
+        # Load in the profile data - the latest snapshot with the measurements
+        # made since then replayed on top.
+        self._store = JournaledFile(self._filename)
+        self._data = self._store.load(self._replay, {})
+
+        # Index the peers that have been profiled for each task, i.e., the 
+        # (peer name, task name) keys of a per-peer profile.
+        self._profiled = {}
+        for key in self._data.keys():
+            self._index(key)
+
+        # Compact the measurement journal into a new snapshot every once in a while.
+        self._compactor = Compactor(self._compact, compact_interval)
+        self._compactor.start()
+
+    def _replay(self, data, record):
+        key, value, input_complexity = record
+        if not data.has_key(key):
+            data[key] = ProfileItem(self._backlog)
+        data[key].register(value, input_complexity)
+
+    def _index(self, key):
+        if type(key) == tuple and len(key) == 2:
+            self._profiled.setdefault(key[1], set()).add(key[0])
+
+    def get_profiled(self, task_name):
+        """Returns the names of the peers that have a per-peer profile for the 
+        given task, i.e., the peers whose profile key is (peer name, task name)."""
+        with self._lock:
+            return set(self._profiled.get(task_name, ()))
+
+    def _compact(self):
+        # Only the in-memory serialization of the data is done while holding
+        # the lock - the snapshot is written to disk without it.
+        with self._compact_lock:
+            with self._lock:
+                if self._store.records == 0:
+                    return
+                snapshot = self._store.rotate(self._data)
+            self._store.write_snapshot(snapshot)
         
     def register(self, key, value, input_complexity = None):
         with self._lock:
-            # Make sure that an entry for that key exists.
+            # Add the measurement and journal it.
             if not self._data.has_key(key):
-                self._data[key] = ProfileItem(self._backlog)
-        
-            # Add the measurement.
-            self._data[key].register(value, input_complexity)
+                self._index(key)
+            self._replay(self._data, (key, value, input_complexity))
+            self._store.append((key, value, input_complexity))
         
     def get_complexity(self, key, default = ProfileItem.DEFAULT_COMPLEXITY, input_complexity = None):
+        return self.get_prediction(key, default, input_complexity)[0]
+
+    def get_prediction(self, key, default = ProfileItem.DEFAULT_COMPLEXITY, input_complexity = None):
+        """Returns the expected complexity along with a confidence value in [0;1].
+        If nothing is known about the key the default is returned with confidence 0."""
         with self._lock:
             # Check whether an item for this service exists.
             if not self._data.has_key(key):
-                return default
+                return default, 0.0
             # We have run this service before - return the expected complexity.
-            return self._data[key].get_complexity(input_complexity)
+            return self._data[key].get_prediction(input_complexity)
+
+    def get_spread(self, key, input_complexity = None):
+        """Returns the relative standard deviation of the measurements behind 
+        the expected complexity (None if nothing is known about the key)."""
+        with self._lock:
+            if not self._data.has_key(key):
+                return None
+            return self._data[key].get_spread(input_complexity)
 
     def save(self):
+        """Writes a new snapshot of the profile data."""
+        self._compact()
+
+    def close(self):
+        """Saves the profile data and stops the background compaction."""
+        self._compactor.stop()
+        self._compact()
         with self._lock:
-            with open(self._filename, 'wb') as outfile:
-                dump(self._data, outfile, -1)
+            self._store.close()
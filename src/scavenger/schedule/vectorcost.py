@@ -0,0 +1,194 @@
+"""
+A vectorized cost model for evaluating many candidate peers at once. The
+attributes of the peers in a peer table are kept in column arrays, and the
+estimated time for every peer is computed in one batched NumPy operation.
+This is only used if NumPy is installed - otherwise the scheduler uses its
+pure Python cost model.
+"""
+
+from __future__ import with_statement
+from thread import allocate_lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The latency (in seconds) added to every remote dispatch.
+LATENCY = 0.1
+
+def available():
+    """Returns True if the vectorized cost model can be used."""
+    return numpy != None
+
+class PeerColumns(object):
+    """The attributes of the peers of a single peer table as column arrays."""
+    def __init__(self, table):
+        super(PeerColumns, self).__init__()
+        self.version = table.version
+        self.peers = table.peers
+        self.names = [peer.name for peer in self.peers]
+        self.positions = dict([(name, i) for i, name in enumerate(self.names)])
+        self.strength = numpy.array([peer.cpu_strength for peer in self.peers], dtype=float)
+        self.cores = numpy.array([max(1, peer.cpu_cores) for peer in self.peers], dtype=int)
+        self.active = numpy.array([peer.active_tasks for peer in self.peers], dtype=int)
+        self.net = numpy.array([peer.net for peer in self.peers], dtype=float)
+
+class VectorCostModel(object):
+    def __init__(self, context, lprofile, gprofile, compression = None, links = None):
+        super(VectorCostModel, self).__init__()
+        self._context = context
+        self._lprofile = lprofile
+        self._gprofile = gprofile
+        self._compression = compression
+        self._links = links
+        self._columns = None
+        self._lock = allocate_lock()
+
+    def columns(self, table):
+        """Get the column arrays for the given peer table. These are rebuilt
+        only when a new version of the peer table is published."""
+        columns = self._columns
+        if columns == None or columns.version != table.version:
+            columns = PeerColumns(table)
+            with self._lock:
+                self._columns = columns
+        return columns
+
+    def _perform_times(self, columns, task_name, input_complexities, activity = None):
+        """Returns a (tasks x peers) matrix of the time it takes each peer to
+        perform each task."""
+        # The complexity is the global one unless a peer has its own profile.
+        complexity = numpy.empty((len(input_complexities), len(columns.peers)))
+        for row, input_complexity in enumerate(input_complexities):
+            complexity[row, :] = self._gprofile.get_complexity(task_name, input_complexity = input_complexity)
+        for name in self._lprofile.get_profiled(task_name):
+            position = columns.positions.get(name)
+            if position != None:
+                for row, input_complexity in enumerate(input_complexities):
+                    complexity[row, position] = self._lprofile.get_complexity((name, task_name),
+                                                                              complexity[row, position],
+                                                                              input_complexity)
+
+        # Take the current load into account. The announced number of active
+        # tasks is overridden by the number of tasks this client has running at
+        # the peer if that is larger.
+        active = columns.active.copy()
+        if activity == None:
+            activity = self._context.get_local_activity()
+        for name, count in activity.items():
+            position = columns.positions.get(name)
+            if position != None and count > active[position]:
+                active[position] = count
+        strength = columns.strength / (active // columns.cores + 1)
+        return complexity / strength
+
+    def _holder_net(self, datahandle, fallback):
+        holder = self._context.get_peer(datahandle.server_address)
+        if holder is None:
+            return fallback
+        return holder.net
+
+    def _handle_times(self, columns, local_network_speed, datahandles):
+        """Returns a vector of the time it takes to move the given data handles
+        to each peer."""
+        times = numpy.zeros(len(columns.peers))
+        if len(datahandles) == 0:
+            return times
+        sizes = numpy.array([float(handle.size) for handle in datahandles])
+        # Data held by a peer that has left the context is assumed to move at
+        # the speed of the receiving peer.
+        holder_net = numpy.array([self._holder_net(handle, numpy.inf)
+                                  for handle in datahandles], dtype=float)
+        bandwidth = numpy.minimum(columns.net[numpy.newaxis, :], holder_net[:, numpy.newaxis])
+        matrix = sizes[:, numpy.newaxis] / bandwidth
+        # Data already held by a peer need not be moved.
+        for row, handle in enumerate(datahandles):
+            position = columns.positions.get(handle.server_address)
+            if position != None:
+                matrix[row, position] = 0.0
+        return matrix.sum(axis=0)
+
+    def estimate_batch(self, table, task_name, input_complexities, input_sizes, output_sizes,
+                       local_network_speed, datahandles, activity = None):
+        """
+        Estimates the time it takes each peer to perform each of a batch of
+        invocations of the same task.
+        @type table: PeerTable
+        @param table: The peers.
+        @type input_complexities: list
+        @param input_complexities: The value of the complexity relation of each
+        invocation (None for tasks without a complexity relation).
+        @type input_sizes: list
+        @param input_sizes: The input size of each invocation.
+        @type output_sizes: list
+        @param output_sizes: The output size of each invocation.
+        @type datahandles: list
+        @param datahandles: The data handles that are common to the invocations.
+        @type activity: dict
+        @param activity: The number of tasks this client has running at each
+        peer. If None the current numbers are used.
+        @rtype: numpy.ndarray
+        @return: A (invocations x peers) matrix of estimated times. The columns
+        are ordered like the peers of the table.
+        """
+        columns = self.columns(table)
+        perform = self._perform_times(columns, task_name, input_complexities, activity)
+        bandwidth, latency = self._links_of(columns, local_network_speed)
+        bandwidth = bandwidth[numpy.newaxis, :]
+        input_sizes = numpy.array(input_sizes, dtype=float)[:, numpy.newaxis]
+        output_sizes = numpy.array(output_sizes, dtype=float)[:, numpy.newaxis]
+        transfer = self._input_times(task_name, input_sizes, bandwidth) + output_sizes / bandwidth + latency
+        return perform + transfer + self._handle_times(columns, local_network_speed, datahandles)
+
+    def _links_of(self, columns, local_network_speed):
+        """Returns vectors of the bandwidth and latency of the link to each 
+        peer. Measured links override the network media speeds."""
+        bandwidth = numpy.minimum(columns.net, local_network_speed)
+        latency = numpy.empty(len(columns.peers))
+        latency.fill(LATENCY)
+        if self._links != None:
+            for name, (measured_bandwidth, rtt) in self._links.get_measured().items():
+                position = columns.positions.get(name)
+                if position != None:
+                    if measured_bandwidth != None:
+                        bandwidth[position] = measured_bandwidth
+                    if rtt != None:
+                        latency[position] = rtt
+        return bandwidth, latency
+
+    def _input_times(self, task_name, input_sizes, bandwidth):
+        """Returns a (tasks x peers) matrix of the time it takes to send the
+        input of each task to each peer, compressing it if that is faster."""
+        times = input_sizes / bandwidth
+        if self._compression == None:
+            return times
+        compressible = input_sizes >= self._compression.min_size
+        for codec, ratio, cost in self._compression.costs(task_name):
+            compressed = input_sizes * ratio / bandwidth + input_sizes * cost
+            times = numpy.minimum(times, numpy.where(compressible, compressed, numpy.inf))
+        return times
+
+    def estimate(self, table, task_name, input_complexity, input_size, output_size,
+                 local_network_speed, datahandles, activity = None):
+        """Estimates the time it takes each peer to perform a single invocation.
+        @rtype: numpy.ndarray
+        @return: A vector of estimated times ordered like the peers of the table."""
+        return self.estimate_batch(table, task_name, [input_complexity], [input_size], [output_size],
+                                   local_network_speed, datahandles, activity)[0]
+
+    def best(self, table, count, *args):
+        """
+        Finds the count peers with the lowest estimated time.
+        @rtype: list
+        @return: A list of ( time, peer ) tuples, best first.
+        """
+        times = self.estimate(table, *args)
+        count = min(count, len(times))
+        if count < len(times) and hasattr(numpy, 'argpartition'):
+            positions = numpy.argpartition(times, count - 1)[:count]
+            positions = positions[numpy.argsort(times[positions])]
+        else:
+            positions = numpy.argsort(times)[:count]
+        peers = self.columns(table).peers
+        return [(float(times[position]), peers[position]) for position in positions]
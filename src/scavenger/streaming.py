@@ -0,0 +1,113 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming of the results of generator tasks. The generator is installed
+at the surrogate wrapped in a perform function that keeps the running
+generators in module-level state, and the client then pulls the results in
+chunks: the first chunk holds a single result so it arrives as soon as
+possible, and the following chunks grow up to a maximum size. The next
+chunk is requested while the caller consumes the current one."""
+
+from schedule.futures import spawn
+from copy import copy
+from uuid import uuid4
+
+STREAM_TIMEOUT = 600 # Streams idle for this many seconds are dropped by the surrogate.
+
+# The code wrapping a generator (renamed to _generate) at the surrogate.
+STREAM_CODE = """
+
+import time as _time
+_streams = {}
+
+def perform(op, stream, count, args):
+    now = _time.time()
+    for name, (generator, used) in _streams.items():
+        if now - used > %(timeout)i:
+            _streams.pop(name, None)
+    if op == 'close':
+        entry = _streams.pop(stream, None)
+        if entry != None:
+            entry[0].close()
+        return [], True
+    if op == 'start':
+        _streams[stream] = [_generate(*args), now]
+    entry = _streams[stream]
+    entry[1] = now
+    items = []
+    try:
+        while len(items) < count:
+            items.append(entry[0].next())
+    except StopIteration:
+        _streams.pop(stream, None)
+        return items, True
+    return items, False
+"""%{'timeout' : STREAM_TIMEOUT}
+
+def stream_source(source):
+    """Wraps the source of a generator function (already renamed to
+    _generate) in the code performing streams at the surrogate."""
+    return source + STREAM_CODE
+
+def stream(scheduler, peer, task, chunk_size, reserved = False):
+    """
+    Performs a generator task at the given peer, yielding its results.
+    @type scheduler: AdaptiveProfScheduler
+    @param scheduler: The scheduler used for performing the task.
+    @type peer: ScavengerPeer
+    @param peer: The peer. All chunks are fetched from this peer.
+    @type task: AdaptiveProfTaskInvokation
+    @param task: The task invocation holding the arguments of the generator.
+    @type chunk_size: int
+    @param chunk_size: The maximum number of results fetched at a time.
+    @type reserved: bool
+    @param reserved: Whether a task slot has already been reserved at the 
+    peer for the first chunk (see AdaptiveProfScheduler.select).
+    @rtype: generator
+    """
+    name = uuid4().hex
+    invocation = copy(task)
+    # The chunks are not representative of the whole task.
+    invocation.profiled = False
+    invocation.input = ('start', name, 1, task.input)
+    count = 1
+    done = False
+    pending = spawn(scheduler.perform_remote, peer, invocation, reserved)
+    try:
+        while True:
+            items, done = pending.result()
+            pending = None
+            if not done:
+                # Fetch the next chunk while the results are consumed.
+                count = min(2 * count, chunk_size)
+                invocation = copy(invocation)
+                invocation.input = ('next', name, count, None)
+                pending = spawn(scheduler.perform_remote, peer, invocation)
+            for item in items:
+                yield item
+            if done:
+                return
+    finally:
+        if not done:
+            # The caller stopped early (or the stream failed) - drop the
+            # generator at the surrogate.
+            try:
+                if pending != None:
+                    pending.exception()
+                invocation = copy(invocation)
+                invocation.input = ('close', name, 0, None)
+                scheduler.perform_remote(peer, invocation)
+            except Exception:
+                pass
@@ -1,3 +1,5 @@
+from expression import compile_expression
+
 class TaskInvokation(object):
     def __init__(self, name, _input = None, code = None, store = False, scheduler = None):
         super(TaskInvokation, self).__init__()
@@ -7,6 +9,10 @@ class TaskInvokation(object):
         self._store = store
         self._scheduler = scheduler
         self._id = None
+        self._payload = None
+        self._race = None
+        self._timeout = None
+        self._profiled = True
 
     def name(): #@NoSelf
         doc = """Property for name."""
@@ -25,6 +31,8 @@ class TaskInvokation(object):
             return self._input
         def fset(self, value):
             self._input = value
+            # The serialized input is no longer valid.
+            self._payload = None
         def fdel(self):
             del self._input
         return locals()
@@ -74,14 +82,85 @@ class TaskInvokation(object):
         return locals()
     id = property(**id())
 
+    def payload(): #@NoSelf
+        doc = """Property for payload. This is the serialized input (if the 
+        input has been serialized) that should be sent instead of the input."""
+        def fget(self):
+            return self._payload
+        def fset(self, value):
+            self._payload = value
+        def fdel(self):
+            del self._payload
+        return locals()
+    payload = property(**payload())
+
+    def race(): #@NoSelf
+        doc = """Property for race. This is set when the invocation is one of
+        several hedged runs of the same task. Only the run that wins the race
+        is used for profiling."""
+        def fget(self):
+            return self._race
+        def fset(self, value):
+            self._race = value
+        def fdel(self):
+            del self._race
+        return locals()
+    race = property(**race())
+
+    def timeout(): #@NoSelf
+        doc = """Property for timeout. This is the number of seconds the 
+        surrogate is given to perform the task (None means the default)."""
+        def fget(self):
+            return self._timeout
+        def fset(self, value):
+            self._timeout = value
+        def fdel(self):
+            del self._timeout
+        return locals()
+    timeout = property(**timeout())
+
+    def profiled(): #@NoSelf
+        doc = """Property for profiled. This tells whether performing the
+        invocation is used for profiling the task."""
+        def fget(self):
+            return self._profiled
+        def fset(self, value):
+            self._profiled = value
+        def fdel(self):
+            del self._profiled
+        return locals()
+    profiled = property(**profiled())
+
 
 class AdaptiveProfTaskInvokation(TaskInvokation):
     def __init__(self, name, _input = None, code = None, store = False, scheduler = 'aprofile',
-                 output_size = None, complexity_relation = None):
+                 output_size = None, complexity_relation = None, argnames = None, hedge = None,
+                 coalesce = False):
         super(AdaptiveProfTaskInvokation, self).__init__(name, _input, code, store, scheduler)
-        self._output_size = output_size
-        self._complexity_relation = complexity_relation
+        self._argnames = argnames
+        self.output_size = output_size
+        self.complexity_relation = complexity_relation
         self._complexity = None
+        self._hedge = hedge
+        self._coalesce = coalesce
+
+    def _compile(self, expression):
+        if type(expression) in (str, unicode):
+            return compile_expression(expression, self._argnames)
+        return None
+
+    def find_complexity(self, task_input):
+        """Evaluates the complexity relation for the given input (None if the 
+        task has no complexity relation)."""
+        if self._complexity_function == None:
+            return None
+        return self._complexity_function(task_input)
+
+    def find_output_size(self, task_input):
+        """Evaluates the output size for the given input."""
+        if self._output_size_function == None:
+            return self._output_size
+        return self._output_size_function(task_input)
 
     def output_size(): #@NoSelf
         doc = """Property for output_size"""
@@ -89,6 +168,7 @@ class AdaptiveProfTaskInvokation(TaskInvokation):
             return self._output_size
         def fset(self, value):
             self._output_size = value
+            self._output_size_function = self._compile(value)
         def fdel(self):
             del self._output_size
         return locals()
@@ -100,6 +180,7 @@ class AdaptiveProfTaskInvokation(TaskInvokation):
             return self._complexity_relation
         def fset(self, value):
             self._complexity_relation = value
+            self._complexity_function = self._compile(value)
         def fdel(self):
             del self._complexity_relation
         return locals()
@@ -115,5 +196,33 @@ class AdaptiveProfTaskInvokation(TaskInvokation):
             del self._complexity
         return locals()
     complexity = property(**complexity())
+
+    def hedge(): #@NoSelf
+        doc = """Property for hedge. If set the task is hedged: when it has run
+        for longer than this percentile (a fraction, e.g., 0.95) of its 
+        predicted running time it is also started on the second best 
+        candidate, and the first result is used. True means the configured
+        default percentile."""
+        def fget(self):
+            return self._hedge
+        def fset(self, value):
+            self._hedge = value
+        def fdel(self):
+            del self._hedge
+        return locals()
+    hedge = property(**hedge())
+
+    def coalesce(): #@NoSelf
+        doc = """Property for coalesce. If set, concurrent invocations of the
+        task with equal input share a single call. This must only be set for
+        pure tasks, and it has no effect on tasks that store their output."""
+        def fget(self):
+            return self._coalesce
+        def fset(self, value):
+            self._coalesce = value
+        def fdel(self):
+            del self._coalesce
+        return locals()
+    coalesce = property(**coalesce())
     
     
\ No newline at end of file
@@ -0,0 +1,61 @@
+# Copyright (C) 2008, Mads D. Kristensen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A client side registry of the tasks that are known to be installed
+at the different surrogates. This saves a has_task round trip for tasks
+that have already been seen at a given peer."""
+
+from __future__ import with_statement
+from thread import allocate_lock
+import hashlib
+
+def code_hash(task_code):
+    """Returns a digest of the given task code (or None if no code is given)."""
+    if task_code == None:
+        return None
+    return hashlib.md5(task_code).hexdigest()
+
+class InstalledTaskRegistry(object):
+    def __init__(self):
+        super(InstalledTaskRegistry, self).__init__()
+        # Maps peer name -> set of (task name, code hash) tuples.
+        self._installed = {}
+        self._lock = allocate_lock()
+
+    def add(self, peer_name, task_name, task_code = None):
+        """Mark that the given task is installed at the given peer."""
+        with self._lock:
+            self._installed.setdefault(peer_name, set()).add((task_name, code_hash(task_code)))
+
+    def has(self, peer_name, task_name, task_code = None):
+        """Check whether the given task is known to be installed at the given peer."""
+        with self._lock:
+            tasks = self._installed.get(peer_name)
+            return tasks != None and (task_name, code_hash(task_code)) in tasks
+
+    def discard(self, peer_name, task_name):
+        """Forget that the named task is installed at the given peer. All
+        versions of the task code are forgotten."""
+        with self._lock:
+            tasks = self._installed.get(peer_name)
+            if tasks == None:
+                return
+            for entry in [entry for entry in tasks if entry[0] == task_name]:
+                tasks.discard(entry)
+
+    def forget_peer(self, peer_name):
+        """Forget everything known about the given peer."""
+        with self._lock:
+            self._installed.pop(peer_name, None)
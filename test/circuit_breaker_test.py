@@ -0,0 +1,131 @@
+"""
+Checks the state machine of the per-peer circuit breakers. Time is passed
+in explicitly, so no test has to wait for a breaker to become half-open.
+"""
+
+from threading import Thread
+import unittest
+
+import fakes # Puts the scavenger modules on the path.
+from context import Context, CircuitBreaker, HealthPolicy
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = HealthPolicy(error_threshold = 0.5, min_calls = 3, open_time = 10.0,
+                                   max_open_time = 30.0, probes = 2, slow_ratio = 10.0)
+        self.breaker = CircuitBreaker(self.policy)
+
+    def _fail(self, now, times = 1):
+        for i in range(times):
+            self.breaker.dispatch(now)
+            self.breaker.failure(now)
+
+    def _open(self, now = 0.0):
+        self._fail(now, 5)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_stays_closed_below_min_calls(self):
+        self._fail(0.0, 2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.available(0.0))
+
+    def test_opens_on_error_rate(self):
+        for i in range(10):
+            self.breaker.dispatch(0.0)
+            self.breaker.success(0.0, 1.0)
+        self._fail(0.0, 2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self._fail(0.0, 2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.available(5.0))
+
+    def test_slow_success_counts_as_failure(self):
+        for i in range(4):
+            self.breaker.dispatch(0.0)
+            self.breaker.success(0.0, 50.0, 1.0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.latency_ratio > self.policy.slow_ratio)
+
+    def test_timeouts_are_counted(self):
+        self.breaker.dispatch(0.0)
+        self.breaker.failure(0.0, timeout = True)
+        self.assertEqual(self.breaker.timeouts, 1)
+
+    def test_half_open_limits_probes(self):
+        self._open()
+        self.assertTrue(self.breaker.available(10.0))
+        self.breaker.dispatch(10.0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.available(10.0))
+        self.breaker.dispatch(10.0)
+        self.assertFalse(self.breaker.available(10.0))
+        # An outcome frees the probe slot.
+        self.breaker.success(10.0, 1.0)
+        self.assertTrue(self.breaker.available(10.0))
+
+    def test_closes_after_probes_succeed(self):
+        self._open()
+        for i in range(self.policy.probes):
+            self.breaker.dispatch(10.0)
+            self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+            self.breaker.success(10.0, 1.0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.error_rate, 0.0)
+        # The failures before opening are forgotten.
+        self._fail(11.0, 2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_doubles_open_time(self):
+        self._open()
+        self._fail(10.0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.available(29.0))
+        self.assertTrue(self.breaker.available(30.0))
+        self._fail(30.0)
+        # The open time is capped by the policy.
+        self.assertFalse(self.breaker.available(59.0))
+        self.assertTrue(self.breaker.available(60.0))
+
+    def test_close_resets_open_time(self):
+        self._open()
+        self._fail(10.0)
+        for i in range(self.policy.probes):
+            self.breaker.dispatch(30.0)
+            self.breaker.success(30.0, 1.0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self._open(40.0)
+        self.assertTrue(self.breaker.available(50.0))
+
+class TryDispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = HealthPolicy(error_threshold = 0.1, min_calls = 1, open_time = 0.0, probes = 2)
+        self.context = Context(timeout = 3600.0, health = self.policy)
+        # Open the breaker. As it stays open for no time it is half-open next.
+        self.assertTrue(self.context.try_dispatch('peer'))
+        self.context.record_failure('peer')
+        self.assertEqual(self.context.get_health('peer')['state'], CircuitBreaker.OPEN)
+
+    def test_claims_probes(self):
+        self.assertTrue(self.context.try_dispatch('peer'))
+        self.assertEqual(self.context.get_health('peer')['state'], CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.context.try_dispatch('peer'))
+        self.assertFalse(self.context.try_dispatch('peer'))
+        self.assertTrue('peer' in self.context.get_unavailable_peers())
+        self.context.record_success('peer', 1.0)
+        self.assertTrue(self.context.try_dispatch('peer'))
+
+    def test_concurrent_clients_share_probes(self):
+        claimed = []
+        def client():
+            for i in range(100):
+                if self.context.try_dispatch('peer'):
+                    claimed.append(True)
+        threads = [Thread(target=client) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(claimed), self.policy.probes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Stand-ins used by the tests and the benchmarks to exercise the scheduler
+modules without creating the Scavenger singleton or running any surrogates.
+Importing this module puts the scavenger and schedule source directories
+first on the path, so the scheduler modules can be imported directly.
+"""
+
+from __future__ import with_statement
+from contextlib import contextmanager
+from threading import Lock
+from time import sleep
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'scavenger')
+sys.path[0:0] = [os.path.join(SRC, 'schedule'), SRC]
+
+class FakeScavenger(object):
+    """
+    Stands in for the Scavenger class. Tasks are performed in-process by the
+    installed task code. If perform_time is set, every task is installed
+    everywhere and is 'performed' by sleeping that many seconds and
+    returning the name of the peer instead.
+    """
+    modules = {}
+    performed = []
+    perform_time = None
+
+    @classmethod
+    def reset(cls):
+        cls.modules.clear()
+        del cls.performed[:]
+
+    @classmethod
+    def local_cores(cls):
+        return 1
+
+    @classmethod
+    @contextmanager
+    def connection(cls, peer):
+        yield None
+
+    @classmethod
+    def has_task(cls, peer, task_name, connection = None, task_code = None):
+        if cls.perform_time != None:
+            return True
+        return cls.modules.has_key((peer.name, task_name))
+
+    @classmethod
+    def install_task(cls, peer, task_name, task_code, connection = None):
+        namespace = {}
+        exec task_code in namespace
+        cls.modules[(peer.name, task_name)] = namespace
+
+    @classmethod
+    def perform_scheduled_task(cls, peer, task, connection = None):
+        cls.performed.append((peer.name, task.input[0]))
+        if cls.perform_time != None:
+            sleep(cls.perform_time)
+            return peer.name
+        return cls.modules[(peer.name, task.name)]['perform'](*task.input)
+
+class LocalActivity(object):
+    """Stands in for the local activity counter of the Scavenger."""
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0
+    def increment(self):
+        with self._lock:
+            self.value += 1
+    def decrement(self):
+        with self._lock:
+            self.value -= 1
@@ -0,0 +1,159 @@
+"""
+Checks that the journaled profile data survives a crash at any point of
+writing it: the client is 'killed' by abandoning the files as they are left
+on disk, and the data is then loaded afresh. Profiles pickled before the
+backlogs were kept in ring buffers must load as well.
+"""
+
+from cPickle import dump
+import os
+import shutil
+import tempfile
+import unittest
+
+import fakes # Puts the scheduler modules on the path.
+from persistence import JournaledFile
+from profile_common import Profile, ProfileItem, ProfileBucket, RingBuffer
+
+def replay(data, record):
+    data.append(record)
+
+class JournaledFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'data.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def _load(self):
+        store = JournaledFile(self.filename)
+        data = store.load(replay, [])
+        return store, data
+
+    def _crash(self, store):
+        # The open journal is all that is flushed when the client dies.
+        store.close()
+
+    def test_replays_journal(self):
+        store, data = self._load()
+        for record in ('a', 'b'):
+            data.append(record)
+            store.append(record)
+        self._crash(store)
+        store, data = self._load()
+        self.assertEqual(data, ['a', 'b'])
+        # The replayed records were folded into a new snapshot.
+        self.assertEqual(store.records, 0)
+        store.close()
+
+    def test_crash_between_rotate_and_snapshot(self):
+        store, data = self._load()
+        for record in ('a', 'b'):
+            data.append(record)
+            store.append(record)
+        store.rotate(data)
+        data.append('c')
+        store.append('c')
+        self._crash(store)
+        self.assertTrue(os.path.exists(self.filename + '.journal.old'))
+        self.assertFalse(os.path.exists(self.filename))
+
+        store, data = self._load()
+        self.assertEqual(data, ['a', 'b', 'c'])
+        self.assertFalse(os.path.exists(self.filename + '.journal.old'))
+        store.close()
+
+    def test_crash_before_snapshot_rename(self):
+        store, data = self._load()
+        data.append('a')
+        store.append('a')
+        store.compact(data)
+        data.append('b')
+        store.append('b')
+        store.rotate(data)
+        data.append('c')
+        store.append('c')
+        # The new snapshot was only partially written to the temporary file.
+        with open(self.filename + '.tmp', 'wb') as outfile:
+            outfile.write('\x80\x02(U')
+        self._crash(store)
+
+        store, data = self._load()
+        self.assertEqual(data, ['a', 'b', 'c'])
+        store.close()
+
+    def test_crash_after_snapshot_rename(self):
+        store, data = self._load()
+        for record in ('a', 'b'):
+            data.append(record)
+            store.append(record)
+        snapshot = store.rotate(data)
+        data.append('c')
+        store.append('c')
+        # The snapshot is in place but the old journal was not removed.
+        shutil.copy(self.filename + '.journal.old', self.filename + '.copy')
+        store.write_snapshot(snapshot)
+        os.rename(self.filename + '.copy', self.filename + '.journal.old')
+        self._crash(store)
+
+        # The records of the old journal are in the snapshot already.
+        store, data = self._load()
+        self.assertEqual(data, ['a', 'b', 'c'])
+        store.close()
+
+    def test_partially_written_record(self):
+        store, data = self._load()
+        data.append('a')
+        store.append('a')
+        self._crash(store)
+        with open(self.filename + '.journal', 'ab') as outfile:
+            outfile.write('\x80\x02U')
+
+        store, data = self._load()
+        self.assertEqual(data, ['a'])
+        store.close()
+
+class OldProfileTest(unittest.TestCase):
+    def setUp(self):
+        self._home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+        os.mkdir(os.path.join(os.environ['HOME'], '.scavenger'))
+
+    def tearDown(self):
+        shutil.rmtree(os.environ['HOME'], True)
+        if self._home != None:
+            os.environ['HOME'] = self._home
+
+    def test_loads_list_backlogs(self):
+        # A one-dimensional item and a two-dimensional item as they were
+        # pickled before the ring buffers, with a plain list as backlog and
+        # the buckets kept in the backlog.
+        flat = ProfileItem(10)
+        flat.__dict__ = {'_backlog_size' : 10, '_backlog' : [1.0, 2.0, 3.0]}
+        bucket = ProfileBucket(100, 10)
+        bucket.__dict__ = {'_key' : 100, '_backlog_size' : 10, '_backlog' : [4.0, 6.0]}
+        sized = ProfileItem(10)
+        sized.__dict__ = {'_backlog_size' : 10, '_backlog' : [bucket]}
+        with open(os.path.join(os.environ['HOME'], '.scavenger', 'old.dat'), 'wb') as outfile:
+            dump({'flat' : flat, 'sized' : sized}, outfile, -1)
+
+        profile = Profile(filename = 'old.dat')
+        try:
+            self.assertEqual(profile.get_complexity('flat'), 2.0)
+            self.assertEqual(profile.get_complexity('sized', input_complexity = 100), 5.0)
+            item = profile._data['sized']
+            self.assertEqual(item._keys, [100])
+            self.assertTrue(isinstance(item._buckets[0]._backlog, RingBuffer))
+            # New measurements are journaled on top of the converted data.
+            profile.register('flat', 6.0)
+        finally:
+            profile.close()
+        profile = Profile(filename = 'old.dat')
+        try:
+            self.assertEqual(profile.get_complexity('flat'), 3.0)
+        finally:
+            profile.close()
+
+if __name__ == '__main__':
+    unittest.main()
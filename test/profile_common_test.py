@@ -0,0 +1,139 @@
+"""
+Checks the profile backlogs and predictions of profile_common.
+"""
+
+import random
+import unittest
+
+import fakes # Puts the scheduler modules on the path.
+from profile_common import RingBuffer, ProfileItem, ScalingModel
+
+class RingBufferTest(unittest.TestCase):
+    def _assertClose(self, value, expected):
+        self.assertTrue(abs(value - expected) <= 1e-9 * max(1.0, abs(expected)),
+                        '%r != %r'%(value, expected))
+
+    def _check(self, ring, values):
+        n = len(values)
+        mean = sum(values) / float(n)
+        self.assertEqual(ring.values(), values)
+        self._assertClose(ring.mean, mean)
+        self._assertClose(ring.variance, sum([(x - mean) ** 2 for x in values]) / n)
+
+    def test_sums_before_wrapping(self):
+        ring = RingBuffer(5)
+        for value in (1.0, 2.0, 4.0):
+            ring.append(value)
+        self.assertEqual(len(ring), 3)
+        self._check(ring, [1.0, 2.0, 4.0])
+
+    def test_sums_after_wrapping(self):
+        ring = RingBuffer(3)
+        for value in (1.0, 2.0, 4.0, 8.0, 16.0):
+            ring.append(value)
+        self.assertEqual(len(ring), 3)
+        self._check(ring, [4.0, 8.0, 16.0])
+
+    def test_sums_stay_accurate(self):
+        # Enough wrap-arounds for the sums to be recomputed a few times, with
+        # values of very different magnitudes that leave rounding errors.
+        random.seed(0)
+        ring = RingBuffer(7)
+        values = [random.choice([1e-3, 1.0, 1e6]) * random.random() for i in range(7 * 50 + 3)]
+        for value in values:
+            ring.append(value)
+        self._check(ring, values[-7:])
+
+    def test_constant_values_have_no_variance(self):
+        ring = RingBuffer(4)
+        for i in range(10):
+            ring.append(0.1)
+        self.assertTrue(ring.variance >= 0.0)
+        self.assertAlmostEqual(ring.variance, 0.0)
+
+    def test_ewma(self):
+        ring = RingBuffer(2)
+        self.assertEqual(ring.ewma, None)
+        ring.append(10.0)
+        self.assertEqual(ring.ewma, 10.0)
+        ring.append(20.0)
+        self.assertAlmostEqual(ring.ewma, 10.0 + RingBuffer.EWMA_WEIGHT * 10.0)
+
+    def test_from_list_keeps_newest(self):
+        ring = RingBuffer.from_list(2, [1.0, 2.0, 3.0])
+        self._check(ring, [2.0, 3.0])
+        ring.append(5.0)
+        self._check(ring, [3.0, 5.0])
+
+class ProfileItemTest(unittest.TestCase):
+    def _item(self, curve, sizes):
+        item = ProfileItem(10)
+        for size in sizes:
+            item.register(curve(size), size)
+        return item
+
+    def test_one_bucket_per_size(self):
+        item = self._item(lambda x: 10.0 * x, [10, 20, 40])
+        self.assertEqual(item._keys, [10, 20, 40])
+        # Close to a bucket in complexity, so the measurement joins it.
+        item.register(205.0, 25)
+        self.assertEqual(item._keys, [10, 20, 40])
+        self.assertEqual(len(item._buckets[1]._backlog), 2)
+
+    def test_direct_hit(self):
+        item = self._item(lambda x: 10.0 * x, [10, 20, 40])
+        self.assertEqual(item.get_complexity(20), 200.0)
+
+    def test_interpolates_between_buckets(self):
+        item = self._item(lambda x: x * x, [10, 20])
+        self.assertAlmostEqual(item.get_complexity(15), 250.0)
+        self.assertAlmostEqual(item.get_complexity(12), 160.0)
+        # The confidence is that of the neighbouring buckets.
+        _, confidence = item.get_prediction(15)
+        self.assertAlmostEqual(confidence, item.get_prediction(10)[1])
+
+    def test_extrapolates_fitted_curve(self):
+        item = self._item(lambda x: 5.0 + 3.0 * x * x, [10, 20, 30, 40])
+        self.assertEqual(item._get_model().name, 'quadratic')
+        self.assertAlmostEqual(item.get_complexity(100), 5.0 + 3.0 * 100 * 100)
+        item = self._item(lambda x: 2.0 * x, [10, 20, 40])
+        self.assertEqual(item._get_model().name, 'linear')
+        self.assertAlmostEqual(item.get_complexity(5), 10.0)
+        self.assertAlmostEqual(item.get_complexity(1000), 2000.0)
+
+    def test_extrapolates_single_bucket_as_is(self):
+        item = self._item(lambda x: 7.0, [10])
+        self.assertEqual(item.get_complexity(1000), 7.0)
+
+    def test_confidence_drops_with_distance(self):
+        item = self._item(lambda x: 2.0 * x, [10, 20])
+        at_bucket = item.get_prediction(20)[1]
+        near = item.get_prediction(40)[1]
+        far = item.get_prediction(400)[1]
+        self.assertTrue(at_bucket > near > far > 0.0)
+
+    def test_refits_after_register(self):
+        item = self._item(lambda x: 2.0 * x, [10, 20])
+        self.assertAlmostEqual(item.get_complexity(100), 200.0)
+        item.register(3200.0, 40)
+        self.assertEqual(item._get_model().name, 'quadratic')
+
+class ScalingModelTest(unittest.TestCase):
+    def test_constant(self):
+        model = ScalingModel([1, 2, 3], [4.0, 4.0, 4.0], [1, 1, 1])
+        self.assertEqual(model.name, 'constant')
+        self.assertAlmostEqual(model.predict(100), 4.0)
+
+    def test_weights(self):
+        # The heavily weighted points are on a line, the light one is not.
+        model = ScalingModel([1, 2, 3, 4], [1.0, 2.0, 3.0, 40.0], [1000, 1000, 1000, 1])
+        self.assertTrue(model.predict(4) < 10.0)
+
+    def test_rejects_falling_curves(self):
+        # Complexity does not drop as the input grows, and never below zero.
+        model = ScalingModel([1, 2, 3], [30.0, 20.0, 10.0], [1, 1, 1])
+        self.assertEqual(model.name, 'constant')
+        self.assertAlmostEqual(model.predict(100), 20.0)
+
+if __name__ == '__main__':
+    unittest.main()
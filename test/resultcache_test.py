@@ -0,0 +1,121 @@
+"""
+Checks the LRU eviction, the entry and byte limits, the time to live and
+the disk tier of the result cache. The clock of the cache is replaced, so
+no test has to wait for results to expire.
+"""
+
+from cPickle import dumps
+import os
+import shutil
+import tempfile
+import unittest
+
+import fakes # Puts the scavenger modules on the path.
+import resultcache
+from resultcache import ResultCache, fingerprint
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+        self.clock = Clock()
+        self._time = resultcache.time
+        resultcache.time = self.clock
+
+    def tearDown(self):
+        resultcache.time = self._time
+        shutil.rmtree(os.environ['HOME'], True)
+        if self._home != None:
+            os.environ['HOME'] = self._home
+
+    def _keys(self, cache, count):
+        return [cache.key('daimi.test.cache', (i,)) for i in range(count)]
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint({'a' : 1, 'b' : set([2, 3])}),
+                         fingerprint({'b' : set([3, 2]), 'a' : 1}))
+        self.assertNotEqual(fingerprint([1, 2]), fingerprint((1, 2)))
+        self.assertEqual(fingerprint(lambda x: x), None)
+        self.assertEqual(ResultCache().key('daimi.test.cache', (lambda x: x,)), None)
+
+    def test_evicts_least_recently_used(self):
+        cache = ResultCache(max_entries = 3)
+        keys = self._keys(cache, 4)
+        for i in range(3):
+            cache.put(keys[i], i)
+        # Using the oldest entry makes the second oldest the one to go.
+        self.assertEqual(cache.get(keys[0]), (True, 0))
+        cache.put(keys[3], 3)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get(keys[1]), (False, None))
+        for i in (0, 2, 3):
+            self.assertEqual(cache.get(keys[i]), (True, i))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (4, 1, 1))
+
+    def test_byte_limit(self):
+        value = 'x' * 100
+        size = len(dumps(value, -1))
+        cache = ResultCache(max_bytes = 3 * size)
+        keys = self._keys(cache, 5)
+        for i in range(4):
+            cache.put(keys[i], value)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.stats()['bytes'], 3 * size)
+        self.assertEqual(cache.get(keys[0]), (False, None))
+        # A result larger than the limit is not cached at all.
+        cache.put(keys[4], 'x' * (4 * size))
+        self.assertEqual(cache.get(keys[4]), (False, None))
+        self.assertEqual(len(cache), 3)
+
+    def test_replacing_keeps_byte_count(self):
+        cache = ResultCache()
+        key = self._keys(cache, 1)[0]
+        cache.put(key, 'x' * 10)
+        cache.put(key, 'x' * 20)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()['bytes'], len(dumps('x' * 20, -1)))
+
+    def test_ttl(self):
+        cache = ResultCache(ttl = 10.0)
+        key = self._keys(cache, 1)[0]
+        cache.put(key, 'result')
+        self.clock.now += 9.0
+        self.assertEqual(cache.get(key), (True, 'result'))
+        self.clock.now += 1.0
+        self.assertEqual(cache.get(key), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_disk_tier(self):
+        cache = ResultCache(max_entries = 1, ttl = 10.0, disk = True)
+        keys = self._keys(cache, 2)
+        cache.put(keys[0], 'first')
+        cache.put(keys[1], 'second')
+        # Evicted from memory, but still on disk - also for a new cache.
+        self.assertEqual(cache.get(keys[0]), (True, 'first'))
+        cache = ResultCache(disk = True)
+        self.assertEqual(cache.get(keys[1]), (True, 'second'))
+        # Expired results are removed from disk as well.
+        self.clock.now += 10.0
+        cache = ResultCache(disk = True)
+        self.assertEqual(cache.get(keys[0]), (False, None))
+        self.assertEqual(len(os.listdir(cache._directory)), 1)
+
+    def test_corrupt_disk_entry_is_a_miss(self):
+        cache = ResultCache(disk = True)
+        key = self._keys(cache, 1)[0]
+        cache.put(key, 'result')
+        with open(cache._filename(key), 'wb') as outfile:
+            outfile.write('\x80\x02(U')
+        cache = ResultCache(disk = True)
+        self.assertEqual(cache.get(key), (False, None))
+        self.assertFalse(os.path.exists(cache._filename(key)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+Checks that concurrent schedulers do not over-commit a peer: however many
+threads schedule tasks at once, a peer is never given more tasks than a
+scheduler that saw all of them would have given it. The peers are synthetic
+and HOME points at a temporary directory, see fakes.py.
+"""
+
+from __future__ import with_statement
+from threading import Thread, Lock
+import os
+import shutil
+import tempfile
+import unittest
+
+from fakes import FakeScavenger, LocalActivity
+from context import Context, ScavengerPeer
+from adaptiveprofilingscheduler import AdaptiveProfScheduler
+import adaptiveprofilingscheduler
+from scheduler import ScheduleError
+from task import AdaptiveProfTaskInvokation
+
+THREADS = 16
+TASKS_PER_THREAD = 25
+
+class CountingScavenger(FakeScavenger):
+    """Tasks are 'performed' by sleeping, and the largest number of tasks
+    that were performed at once at each peer is recorded."""
+    perform_time = 0.01
+    lock = Lock()
+    running = {}
+    peak = {}
+
+    @classmethod
+    def perform_scheduled_task(cls, peer, task, connection = None):
+        with cls.lock:
+            cls.running[peer.name] = cls.running.get(peer.name, 0) + 1
+            cls.peak[peer.name] = max(cls.peak.get(peer.name, 0), cls.running[peer.name])
+        try:
+            return super(CountingScavenger, cls).perform_scheduled_task(peer, task, connection)
+        finally:
+            with cls.lock:
+                cls.running[peer.name] -= 1
+
+class IdleLocalActivity(LocalActivity):
+    """Local tasks are taken to be done at once, so the local estimate does
+    not change while the threads run."""
+    def __init__(self):
+        super(IdleLocalActivity, self).__init__()
+        self.performed = 0
+    def increment(self):
+        with self._lock:
+            self.performed += 1
+
+class ScheduleContentionTest(unittest.TestCase):
+    def setUp(self):
+        self._home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+        os.mkdir(os.path.join(os.environ['HOME'], '.scavenger'))
+        CountingScavenger.reset()
+        CountingScavenger.running.clear()
+        CountingScavenger.peak.clear()
+        self.context = Context(timeout = 3600.0)
+        # A single core that is four times as strong as the local one.
+        self.context.add(ScavengerPeer('peer', ('127.0.0.1', 10000), 100.0, 1, 0, 500000))
+        self.scheduler = AdaptiveProfScheduler(self.context, CountingScavenger, engine = 'python')
+        self.scheduler.gprofile.register('daimi.test.contention', 100.0)
+
+    def tearDown(self):
+        self.scheduler.lprofile.close()
+        self.scheduler.gprofile.close()
+        self.scheduler.links.close()
+        shutil.rmtree(os.environ['HOME'], True)
+        if self._home != None:
+            os.environ['HOME'] = self._home
+
+    def _task(self, i):
+        return AdaptiveProfTaskInvokation('daimi.test.contention', (i,), output_size = '1')
+
+    def _capacity(self):
+        """Finds the number of tasks the peer is given by a single client."""
+        activity = IdleLocalActivity()
+        capacity = 0
+        try:
+            while True:
+                self.scheduler.select(self._task(0), 25.0, 500000, activity, False)
+                capacity += 1
+        except ScheduleError:
+            pass
+        for i in range(capacity):
+            self.context.decrement_peer_activity('peer')
+        return capacity
+
+    def _schedule_concurrently(self):
+        capacity = self._capacity()
+        self.assertEqual(capacity, 3)
+
+        activity = IdleLocalActivity()
+        def client():
+            for i in range(TASKS_PER_THREAD):
+                try:
+                    self.scheduler.schedule(self._task(i), 25.0, 500000, activity, False)
+                except ScheduleError:
+                    pass
+        threads = [Thread(target=client) for i in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        remote = len(CountingScavenger.performed)
+        self.assertEqual(remote + activity.performed, THREADS * TASKS_PER_THREAD)
+        self.assertTrue(remote > 0)
+        self.assertTrue(CountingScavenger.peak['peer'] <= capacity)
+        # Every reserved slot has been released.
+        self.assertEqual(self.context.get_local_activity().get('peer', 0), 0)
+
+    def test_peer_is_not_overcommitted(self):
+        self._schedule_concurrently()
+
+    def test_peer_is_not_overcommitted_without_replanning(self):
+        # Every failed reservation is now the last attempt.
+        max_replans = adaptiveprofilingscheduler.MAX_REPLANS
+        adaptiveprofilingscheduler.MAX_REPLANS = 0
+        try:
+            self._schedule_concurrently()
+        finally:
+            adaptiveprofilingscheduler.MAX_REPLANS = max_replans
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Checks that generator tasks are streamed from the peer chosen by the
+scheduler. The scheduler modules are imported directly and HOME points at a
+temporary directory, so neither the Scavenger singleton nor the profiles of
+the user are touched, and no surrogates need to be running.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fakes import FakeScavenger, LocalActivity
+from context import Context, ScavengerPeer
+from adaptiveprofilingscheduler import AdaptiveProfScheduler
+from scheduler import ScheduleError
+from streaming import stream, stream_source
+from task import AdaptiveProfTaskInvokation
+
+SQUARES = stream_source("""
+def _generate(n):
+    for i in range(n):
+        yield i * i
+""")
+
+class StreamScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self._home = os.environ.get('HOME')
+        os.environ['HOME'] = tempfile.mkdtemp()
+        os.mkdir(os.path.join(os.environ['HOME'], '.scavenger'))
+        FakeScavenger.reset()
+        self.context = Context(timeout = 3600.0)
+        self.scheduler = AdaptiveProfScheduler(self.context, FakeScavenger, engine = 'python')
+        self.activity = LocalActivity()
+
+    def tearDown(self):
+        self.scheduler.lprofile.close()
+        self.scheduler.gprofile.close()
+        self.scheduler.links.close()
+        shutil.rmtree(os.environ['HOME'], True)
+        if self._home != None:
+            os.environ['HOME'] = self._home
+
+    def _task(self, n):
+        # The task has been profiled, so performing it takes time.
+        self.scheduler.gprofile.register('daimi.test.squares', 10.0)
+        return AdaptiveProfTaskInvokation('daimi.test.squares', (n,), SQUARES, output_size = '1')
+
+    def test_select_prefers_strong_peer(self):
+        # A local fallback exists, but the peer is far stronger on the same link.
+        self.context.add(ScavengerPeer('fast', ('127.0.0.1', 10000), 1e9, 1, 0, 500000))
+        peer = self.scheduler.select(self._task(3), 1.0, 500000, self.activity, False)
+        self.assertEqual(peer.name, 'fast')
+        self.assertEqual(self.activity.value, 0)
+
+    def test_select_local_without_peers(self):
+        self.assertRaises(ScheduleError, self.scheduler.select, self._task(3),
+                          1.0, 500000, self.activity, False)
+        self.assertEqual(self.activity.value, 1)
+
+    def test_stream_from_selected_peer(self):
+        self.context.add(ScavengerPeer('fast', ('127.0.0.1', 10000), 1e9, 1, 0, 500000))
+        self.context.add(ScavengerPeer('slow', ('127.0.0.1', 10001), 1.0, 1, 0, 500000))
+        task = self._task(10)
+        peer = self.scheduler.select(task, 1.0, 500000, self.activity, False)
+        self.assertEqual(list(stream(self.scheduler, peer, task, 4, True)),
+                         [i * i for i in range(10)])
+        self.assertEqual(set([name for name, _ in FakeScavenger.performed]), set(['fast']))
+        self.assertEqual(FakeScavenger.performed[0][1], 'start')
+        # The reserved slot and those of the following chunks are released.
+        self.assertEqual(self.context.get_local_activity().get('fast', 0), 0)
+
+if __name__ == '__main__':
+    unittest.main()